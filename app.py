@@ -1,14 +1,41 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory, session, redirect, url_for, Response
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Flask, render_template, request, jsonify, send_file, send_from_directory, session, redirect, url_for, Response, g
+from flask import before_render_template, template_rendered
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 from werkzeug.middleware.proxy_fix import ProxyFix
 from functools import wraps
 import os
 import json
 from datetime import datetime
-import subprocess
 import uuid
 import time
+import atexit
+import shutil
+import tempfile
+import math
+import mimetypes
+import click
+from urllib.parse import quote
+
+from storage import open_store
+from counters import ViewCounter
+from catalog import Catalog
+from search import SearchIndex
+from danmu import DanmuBroadcaster, DanmuStore, parse_last_event_id
+from jobs import JobQueue
+from scanner import LibraryScanner, unique_id
+import media
+from streaming import send_video
+from uploads import UploadManager, UploadError, publish_file
+from pagecache import PageCache
+from social import SocialGraph
+from recommend import TrendingTracker, RelatedIndex, compute_related, save_related
+from export import StaticExporter
+from metrics import Registry, instrument
+from profiler import SamplingProfiler
+from auth import PasswordHasher, AuthBusy
+from sessions import SessionStore, ServerSessionInterface
+from thumbs import ThumbnailCache
 
 app = Flask(__name__)
 
@@ -29,81 +56,603 @@ app.config['ALLOWED_EXTENSIONS'] = {'mp4', 'webm', 'mkv'}
 app.config['SECRET_KEY'] = 'your_secret_key_here'
 app.config['USERS_FILE'] = os.path.join(BASE_DIR, 'users.json')
 app.config['SERVER_NAME'] = "www.liepin.ficlf.com:5062"
+# 存储后端: 'sqlite' (默认，首次启动时自动导入旧的 JSON 文件) 或 'json'
+app.config['STORAGE_BACKEND'] = 'sqlite'
+app.config['DATABASE_FILE'] = os.path.join(BASE_DIR, 'ts.db')
+# 目录的二进制快照，冷启动时代替逐行解析存储；None 表示不使用快照
+app.config['CATALOG_SNAPSHOT_FILE'] = os.path.join(BASE_DIR, 'catalog.snapshot')
+# 播放次数写回: 每隔多少秒或累积多少次播放后批量写入存储
+app.config['VIEW_FLUSH_INTERVAL'] = 5.0
+app.config['VIEW_FLUSH_THRESHOLD'] = 500
+# 搜索结果每页数量
+app.config['SEARCH_PAGE_SIZE'] = 24
+# 弹幕: 每个视频保留的历史条数 (用于回放和断线续传)、SSE 心跳间隔秒数
+app.config['DANMU_HISTORY'] = 500
+app.config['DANMU_HEARTBEAT'] = 15.0
+# 弹幕持久化: 按播放位置每 DANMU_SEGMENT_SECONDS 秒一个段文件，单次查询最多返回 DANMU_RANGE_LIMIT 条
+app.config['DANMU_FOLDER'] = os.path.join(BASE_DIR, 'danmu')
+app.config['DANMU_SEGMENT_SECONDS'] = 60
+app.config['DANMU_RANGE_LIMIT'] = 2000
+# 单次查询最多覆盖的段数、发送弹幕时允许的最大播放位置 (秒)
+app.config['DANMU_RANGE_MAX_SEGMENTS'] = 10
+app.config['DANMU_MAX_OFFSET'] = 24 * 3600
+# 后台媒体处理: 任务队列数据库、worker 线程数、ffprobe/ffmpeg 超时秒数
+app.config['JOBS_DATABASE_FILE'] = os.path.join(BASE_DIR, 'jobs.db')
+app.config['JOB_WORKERS'] = 2
+app.config['FFPROBE_TIMEOUT'] = 30
+app.config['FFMPEG_TIMEOUT'] = 120
+# 媒体分析缓存 (按文件内容哈希)，以及进度条预览雪碧图的行列数
+app.config['MEDIA_CACHE_FOLDER'] = os.path.join(BASE_DIR, 'media_cache')
+app.config['SPRITE_GRID'] = (10, 10)
+# 缩略图按宽度档位缩放 (/thumb/<宽度>/<文件名>)，浏览器支持时输出 WebP；
+# 缩放结果缓存在磁盘上，总大小超过上限时淘汰最久没有使用的
+app.config['THUMBNAIL_CACHE_FOLDER'] = os.path.join(BASE_DIR, 'thumb_cache')
+app.config['THUMBNAIL_WIDTHS'] = (160, 320, 640)
+app.config['THUMBNAIL_LIST_WIDTH'] = 320
+app.config['THUMBNAIL_CACHE_MAX_BYTES'] = 512 * 1024 * 1024
+app.config['THUMBNAIL_WORKERS'] = 2
+app.config['THUMBNAIL_TIMEOUT'] = 10.0
+app.config['THUMBNAIL_QUALITY'] = 80
+app.config['THUMBNAIL_CACHE_MAX_AGE'] = 365 * 24 * 3600
+# 视频文件缓存时间 (秒)；上传的文件名不会重复使用，可以长期缓存
+app.config['VIDEO_CACHE_MAX_AGE'] = 30 * 24 * 3600
+# 交给前端代理发送文件: nginx 设置为 internal location 的前缀 (例如 '/_videos/')，
+# Apache/lighttpd 设置 VIDEO_SENDFILE_HEADER = 'X-Sendfile'
+app.config['VIDEO_ACCEL_REDIRECT_PREFIX'] = None
+app.config['VIDEO_SENDFILE_HEADER'] = None
+# HLS 自适应码率: 输出目录、码率阶梯 [(高度, 视频码率 kbps)]、分片秒数、转码超时
+app.config['HLS_ENABLED'] = True
+app.config['HLS_FOLDER'] = os.path.join(BASE_DIR, 'static/hls')
+app.config['HLS_LADDER'] = [(1080, 5000), (720, 2800), (480, 1400), (360, 800)]
+app.config['HLS_SEGMENT_SECONDS'] = 6
+app.config['HLS_TIMEOUT'] = 3600
+# 分片上传: 未完成上传的临时目录 (需与 UPLOAD_FOLDER 在同一文件系统)、单个文件上限、
+# 建议的分片大小、多少秒没有写入后清理
+app.config['UPLOAD_TMP_FOLDER'] = os.path.join(BASE_DIR, 'upload_tmp')
+app.config['UPLOAD_MAX_SIZE'] = app.config['MAX_CONTENT_LENGTH']
+app.config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024
+app.config['UPLOAD_EXPIRE'] = 24 * 3600
+# 列表分页: 首页/个人主页/收藏每页视频数、每页评论数、?limit= 允许的最大值
+app.config['LIST_PAGE_SIZE'] = 24
+app.config['COMMENT_PAGE_SIZE'] = 20
+app.config['MAX_PAGE_SIZE'] = 100
+# 关注动态: 粉丝数超过 FEED_FANOUT_LIMIT 的作者改为读取时合并，每个用户的动态最多保留条数
+app.config['FEED_FANOUT_LIMIT'] = 10000
+app.config['FEED_SIZE'] = 500
+# 推荐: 热度半衰期秒数、热门榜长度、各种互动的权重；相关视频表文件、每个视频保留的相关视频数、
+# 相关视频表重新计算的间隔秒数
+app.config['TRENDING_HALF_LIFE'] = 6 * 3600
+app.config['TRENDING_TOP_K'] = 100
+app.config['TRENDING_WEIGHTS'] = {'view': 1.0, 'like': 5.0, 'favorite': 8.0, 'comment': 4.0}
+app.config['RELATED_FILE'] = os.path.join(BASE_DIR, 'related.json')
+app.config['RELATED_TOP_K'] = 20
+app.config['RELATED_REBUILD_INTERVAL'] = 3600
+# 静态导出 (flask --app app export): 输出目录、并行渲染的线程数 (None 为 CPU 核数)
+app.config['STATIC_EXPORT_FOLDER'] = os.path.join(BASE_DIR, 'static_export')
+app.config['STATIC_EXPORT_WORKERS'] = None
+# 密码哈希在独立线程池中计算: 线程数、排队上限 (超出时登录/注册返回 503)、最长等待秒数
+app.config['PASSWORD_HASH_WORKERS'] = 2
+app.config['PASSWORD_HASH_MAX_PENDING'] = 16
+app.config['PASSWORD_HASH_TIMEOUT'] = 10.0
+# 会话: 'cookie' 为 Flask 默认的签名 Cookie；'server' 时 Cookie 中只有随机的会话 id，
+# 会话数据保存在 SESSION_DATABASE_FILE，登出后立即失效
+app.config['SESSION_BACKEND'] = 'cookie'
+app.config['SESSION_DATABASE_FILE'] = os.path.join(BASE_DIR, 'sessions.db')
+# 监控: /metrics 输出 Prometheus 格式的指标，只允许 METRICS_ALLOWED_IPS 中的地址抓取 (None 为不限制)
+app.config['METRICS_ENABLED'] = True
+app.config['METRICS_ALLOWED_IPS'] = {'127.0.0.1', '::1'}
+# 慢请求采样分析 (默认关闭): 处理超过 PROFILE_SLOW_REQUEST 秒的请求，
+# 每 PROFILE_INTERVAL 秒采样一次的调用栈写到 PROFILE_FOLDER，可直接生成火焰图
+app.config['PROFILE_ENABLED'] = False
+app.config['PROFILE_FOLDER'] = os.path.join(BASE_DIR, 'profiles')
+app.config['PROFILE_SLOW_REQUEST'] = 1.0
+app.config['PROFILE_INTERVAL'] = 0.005
+# 页面缓存: 首页、搜索、个人主页和收藏页的渲染结果缓存秒数、最多缓存的页面数
+app.config['PAGE_CACHE_ENABLED'] = True
+app.config['PAGE_CACHE_TTL'] = 10.0
+app.config['PAGE_CACHE_MAX_ENTRIES'] = 1000
+# /update 媒体库扫描: manifest 文件、进程数 (None 为 CPU 核数)、每批提交的视频数
+app.config['SCAN_MANIFEST_FILE'] = os.path.join(BASE_DIR, 'scan_manifest.json')
+app.config['SCAN_WORKERS'] = None
+app.config['SCAN_BATCH_SIZE'] = 50
 
 # 确保目录存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['THUMBNAIL_FOLDER'], exist_ok=True)
+os.makedirs(app.config['HLS_FOLDER'], exist_ok=True)
+mimetypes.add_type('application/vnd.apple.mpegurl', '.m3u8')
+mimetypes.add_type('video/mp2t', '.ts')
+
+# 打开视频/用户存储
+store = open_store(app.config)
+# 进程内缓存，存储文件变化时才重新加载
+catalog = Catalog(store, snapshot_file=app.config['CATALOG_SNAPSHOT_FILE'])
+# 退出时写入快照 (在播放次数写回之后执行)
+atexit.register(catalog.save_snapshot)
+# 搜索倒排索引，随目录的重新加载和写入增量更新
+search_index = SearchIndex()
+catalog.add_listener(search_index.on_catalog_change)
+# 关注关系邻接表和关注动态，同样随目录变化更新
+social_graph = SocialGraph(catalog,
+                           fanout_limit=app.config['FEED_FANOUT_LIMIT'],
+                           feed_size=app.config['FEED_SIZE'])
+catalog.add_listener(social_graph.on_catalog_change)
+# 热门榜随互动增量更新；相关视频表由后台任务离线计算
+trending = TrendingTracker(half_life=app.config['TRENDING_HALF_LIFE'],
+                           top_k=app.config['TRENDING_TOP_K'],
+                           weights=app.config['TRENDING_WEIGHTS'])
+catalog.add_listener(trending.on_catalog_change)
+related_index = RelatedIndex(app.config['RELATED_FILE'])
 
-# 如果用户文件不存在则创建
-if not os.path.exists(app.config['USERS_FILE']):
-    with open(app.config['USERS_FILE'], 'w') as f:
-        json.dump([], f)
+# 播放次数先在内存中累加，由后台线程批量写入
+view_counter = ViewCounter(catalog.increment_views_many,
+                           interval=app.config['VIEW_FLUSH_INTERVAL'],
+                           threshold=app.config['VIEW_FLUSH_THRESHOLD'])
+atexit.register(view_counter.stop)
 
 
 
 # 添加代理支持
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
 
-# 存储弹幕
-video_danmus = {}
+# 弹幕发布/订阅
+danmu_broadcaster = DanmuBroadcaster(history=app.config['DANMU_HISTORY'],
+                                     heartbeat=app.config['DANMU_HEARTBEAT'])
+danmu_store = DanmuStore(app.config['DANMU_FOLDER'],
+                         bucket_seconds=app.config['DANMU_SEGMENT_SECONDS'])
+
+# 上传后的 ffprobe/ffmpeg 处理放到后台任务中执行
+job_queue = JobQueue(app.config['JOBS_DATABASE_FILE'], workers=app.config['JOB_WORKERS'])
+media_analyzer = media.MediaAnalyzer(app.config['MEDIA_CACHE_FOLDER'],
+                                     sprite_cols=app.config['SPRITE_GRID'][0],
+                                     sprite_rows=app.config['SPRITE_GRID'][1],
+                                     probe_timeout=app.config['FFPROBE_TIMEOUT'],
+                                     ffmpeg_timeout=app.config['FFMPEG_TIMEOUT'])
+
+# 缩略图的缩放版本在第一次请求时生成
+thumbnail_cache = ThumbnailCache(app.config['THUMBNAIL_FOLDER'], app.config['THUMBNAIL_CACHE_FOLDER'],
+                                 widths=app.config['THUMBNAIL_WIDTHS'],
+                                 max_bytes=app.config['THUMBNAIL_CACHE_MAX_BYTES'],
+                                 workers=app.config['THUMBNAIL_WORKERS'],
+                                 timeout=app.config['THUMBNAIL_TIMEOUT'],
+                                 quality=app.config['THUMBNAIL_QUALITY'])
+
+# 渲染结果缓存，目录写入后 catalog.version 变化，旧页面不再命中
+page_cache = PageCache(max_entries=app.config['PAGE_CACHE_MAX_ENTRIES'],
+                       ttl=app.config['PAGE_CACHE_TTL'])
+
+# 登录/注册的密码哈希不在请求线程中计算，并发数和排队数有上限
+password_hasher = PasswordHasher(workers=app.config['PASSWORD_HASH_WORKERS'],
+                                 max_pending=app.config['PASSWORD_HASH_MAX_PENDING'],
+                                 timeout=app.config['PASSWORD_HASH_TIMEOUT'])
+if app.config['SESSION_BACKEND'] == 'server':
+    app.session_interface = ServerSessionInterface(SessionStore(app.config['SESSION_DATABASE_FILE']))
+
+# 断点续传的分片上传
+upload_manager = UploadManager(app.config['UPLOAD_TMP_FOLDER'],
+                               max_size=app.config['UPLOAD_MAX_SIZE'],
+                               expire_after=app.config['UPLOAD_EXPIRE'])
+
+# 监控指标: 请求耗时、存储操作、ffprobe/ffmpeg 子进程、模板渲染，以及抓取时读取的弹幕/任务/缓存状态
+metrics = Registry()
+request_seconds = metrics.histogram('ts_request_duration_seconds',
+                                    '请求处理耗时，流式响应只计到返回响应头', ('endpoint', 'method'))
+request_total = metrics.counter('ts_requests_total', '请求数', ('endpoint', 'method', 'status'))
+storage_seconds = metrics.histogram('ts_storage_operation_seconds', '存储操作耗时', ('operation',))
+storage_errors = metrics.counter('ts_storage_errors_total', '存储操作抛出异常的次数', ('operation',))
+subprocess_seconds = metrics.histogram('ts_subprocess_duration_seconds', 'ffprobe/ffmpeg 调用耗时', ('call',),
+                                       buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900, 3600))
+subprocess_failures = metrics.counter('ts_subprocess_failures_total', 'ffprobe/ffmpeg 调用失败或超时的次数', ('call',))
+template_seconds = metrics.histogram('ts_template_render_seconds', '模板渲染耗时', ('template',))
+metrics.gauge('ts_danmu_streams', '当前连接的弹幕 SSE 数', collect=danmu_broadcaster.subscriber_count)
+metrics.gauge('ts_danmu_queued', '所有订阅者队列中等待发送的弹幕数',
+              collect=lambda: sum(danmu_broadcaster.queue_depths()))
+metrics.gauge('ts_danmu_queue_max_depth', '单个订阅者队列中等待发送的最大弹幕数',
+              collect=lambda: max(danmu_broadcaster.queue_depths(), default=0))
+metrics.gauge('ts_jobs', '各状态的后台任务数', ('status',),
+              collect=lambda: {(status,): n for status, n in job_queue.counts().items()})
+metrics.gauge('ts_page_cache_entries', '页面缓存中的页面数', collect=lambda: len(page_cache))
+metrics.counter('ts_page_cache_requests_total', '页面缓存查询次数', ('result',),
+                collect=lambda: {('hit',): page_cache.hits, ('miss',): page_cache.misses})
+metrics.gauge('ts_password_hash_pending', '正在计算或排队的密码哈希数', collect=password_hasher.pending)
+metrics.counter('ts_password_hash_rejected_total', '因排队已满或超时被拒绝的登录/注册数',
+                collect=lambda: password_hasher.rejected)
+metrics.gauge('ts_view_flush_pending', '尚未写入存储的播放次数', collect=lambda: view_counter.pending_total())
+metrics.gauge('ts_thumbnail_cache_bytes', '缩略图缓存的总字节数', collect=thumbnail_cache.size)
+metrics.counter('ts_thumbnail_cache_requests_total', '缩略图缓存查询次数', ('result',),
+                collect=lambda: {('hit',): thumbnail_cache.hits, ('miss',): thumbnail_cache.misses})
+metrics.counter('ts_thumbnail_failures_total', '缩略图缩放失败次数', collect=lambda: thumbnail_cache.failures)
+
+instrument(store, [name for name in ('_load', '_save', 'signature', 'list_videos', 'get_video',
+                                     'add_videos', 'update_video', 'increment_views_many', 'add_comment',
+                                     'page_comments', 'first_comments',
+                                     'list_users', 'get_user', 'get_user_by_name', 'add_user', 'update_user',
+                                     'toggle_member', 'has_member', 'list_members')
+                   if hasattr(store, name)],
+           storage_seconds, storage_errors)
+# 子进程调用失败时这些函数返回 None/False/空列表
+instrument(media, ['probe', 'extract_frames', 'extract_sprite', 'package_hls', 'resize_image'],
+           subprocess_seconds, subprocess_failures, is_failure=lambda result: not result)
+
+profiler = None
+if app.config['PROFILE_ENABLED']:
+    profiler = SamplingProfiler(app.config['PROFILE_FOLDER'],
+                                threshold=app.config['PROFILE_SLOW_REQUEST'],
+                                interval=app.config['PROFILE_INTERVAL'])
+
+@app.before_request
+def start_job_workers():
+    # 定时任务由 worker 线程调度；fork 出来的 worker 进程在第一个请求时启动自己的线程
+    job_queue.start()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if profiler is not None:
+        g.profile_ident = profiler.begin()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        duration = time.perf_counter() - started
+        endpoint = request.endpoint or 'unmatched'
+        request_seconds.observe(duration, endpoint, request.method)
+        request_total.inc(endpoint, request.method, response.status_code)
+        ident = g.pop('profile_ident', None)
+        if ident is not None:
+            profiler.end(ident, duration, f"{request.method}_{endpoint}")
+    return response
+
+@app.teardown_request
+def stop_request_profile(exc):
+    # 出现未处理的异常时 after_request 可能没有执行，在这里取消登记
+    ident = g.pop('profile_ident', None)
+    if ident is not None:
+        profiler.end(ident, 0, '')
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    g.setdefault('template_started', []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def record_template_metrics(sender, template, context, **extra):
+    started = g.get('template_started')
+    if started:
+        template_seconds.observe(time.perf_counter() - started.pop(), template.name or 'string')
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-def get_video_duration(file_path):
-    try:
-        result = subprocess.check_output(
-            ['ffprobe', '-v', 'error', '-show_entries', 
-             'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', 
-             file_path],
-            stderr=subprocess.STDOUT
-        )
-        total_seconds = float(result)
-        minutes = int(total_seconds // 60)
-        seconds = int(total_seconds % 60)
-        return f"{minutes}:{seconds:02d}"
-    except:
-        return "0:00"
+def analyze_video(video_path, vid):
+    # 时长/分辨率/编码 + 缩略图 + 雪碧图，返回要写入视频记录的字段，ffprobe 失败时返回 None
+    info = media_analyzer.analyze(video_path)
+    if info is None:
+        return None
+    return media_analyzer.install(info, vid, app.config['THUMBNAIL_FOLDER'])
+
+def default_thumbnail(index):
+    return app.config['DEFAULT_THUMBNAILS'][index % len(app.config['DEFAULT_THUMBNAILS'])]
+
+def new_video_record(vid, title, filename, author, duration="0:00", thumbnail=None):
+    return {
+        "id": vid,
+        "title": title,
+        "filename": filename,
+        "upload_date": datetime.now().strftime("%Y-%m-%d"),
+        "views": 0,
+        "duration": duration,
+        "thumbnail": thumbnail or default_thumbnail(catalog.count_videos()),
+        "author": author,
+        "likes": 0,
+        "favorites": 0,
+        "comment_count": 0
+    }
+
+def process_video(payload):
+    # 后台任务: 分析视频并生成缩略图，失败时抛出异常由任务队列重试
+    vid = payload['vid']
+    video_path = os.path.join(app.config['UPLOAD_FOLDER'], payload['filename'])
+    if not os.path.exists(video_path):
+        raise FileNotFoundError(video_path)
+    
+    fields = analyze_video(video_path, vid)
+    if fields is None:
+        raise RuntimeError(f"视频分析失败: {payload['filename']}")
+    
+    video = catalog.get_video(vid, for_update=True)
+    if video:
+        video.update(fields)
+        catalog.update_video(video)
+        schedule_hls(vid, payload['filename'])
+    
+    if 'thumbnail' not in fields:
+        raise RuntimeError(f"缩略图生成失败: {payload['filename']}")
+    return {"duration": fields['duration'], "thumbnail": fields['thumbnail']}
 
-def generate_thumbnail(video_path, thumbnail_path):
+job_queue.register('process_video', process_video)
+
+def schedule_hls(vid, filename, force=False):
+    # 每个视频只打包一次，除非文件内容变化 (force)
+    if not app.config['HLS_ENABLED']:
+        return None
+    if not force and job_queue.latest(vid, kind='package_hls'):
+        return None
+    return job_queue.enqueue('package_hls', {"vid": vid, "filename": filename}, key=vid, max_attempts=2)
+
+def package_video_hls(payload):
+    # 后台任务: 转码为多档 HLS，完成前播放页继续使用原始文件
+    vid = payload['vid']
+    video = catalog.get_video(vid)
+    video_path = os.path.join(app.config['UPLOAD_FOLDER'], payload['filename'])
+    if not video or not os.path.exists(video_path):
+        return {"skipped": True}
+    
+    renditions = media.select_renditions(app.config['HLS_LADDER'], video.get('height'))
+    hls_root = app.config['HLS_FOLDER']
+    output_dir = os.path.join(hls_root, vid)
+    os.makedirs(hls_root, exist_ok=True)
+    # 清理之前崩溃的尝试留下的工作目录；仍在转码的尝试不会超过 HLS_TIMEOUT
+    for name in os.listdir(hls_root):
+        path = os.path.join(hls_root, name)
+        try:
+            if name.startswith(f".{vid}.") and time.time() - os.path.getmtime(path) > app.config['HLS_TIMEOUT']:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+    # 每次尝试使用自己的工作目录，重新排队的任务不会删掉另一次尝试正在写的文件。
+    # 转码期间任务队列的心跳会刷新租约，超过 stale_after 的转码不会被当作崩溃
+    job_queue.report_progress({"stage": "packaging"})
+    work_dir = tempfile.mkdtemp(prefix=f".{vid}.", dir=hls_root)
     try:
-        subprocess.call([
-            'ffmpeg', '-i', video_path,
-            '-ss', '00:00:01',
-            '-vframes', '1',
-            thumbnail_path
-        ])
-        return os.path.exists(thumbnail_path)
-    except:
-        return False
+        ok = media.package_hls(video_path, work_dir, renditions,
+                               segment_seconds=app.config['HLS_SEGMENT_SECONDS'],
+                               has_audio=bool(video.get('audio_codec')),
+                               timeout=app.config['HLS_TIMEOUT'])
+        if not ok:
+            raise RuntimeError(f"HLS 打包失败: {payload['filename']}")
+        # mkdtemp 创建的目录只有属主可读，改为和其他静态目录一致
+        os.chmod(work_dir, 0o755)
+        # 整个目录完成后再替换，播放器不会读到一半的播放列表
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.rename(work_dir, output_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    video = catalog.get_video(vid, for_update=True)
+    if video:
+        video['hls'] = f"hls/{vid}/master.m3u8"
+        video['renditions'] = [f"{height}p" for height, _ in renditions]
+        catalog.update_video(video)
+    return {"renditions": [height for height, _ in renditions]}
+
+job_queue.register('package_hls', package_video_hls)
+
+def rebuild_related(payload=None):
+    # 后台任务: 根据共同点赞/收藏重新计算相关视频表
+    usernames = {u['id']: u['username'] for u in store.list_users()}
+    pairs = list(store.list_members('like'))
+    pairs += [(vid, usernames[user_id]) for vid, user_id in store.list_members('favorite')
+              if user_id in usernames]
+    table = compute_related(pairs, top_k=app.config['RELATED_TOP_K'])
+    save_related(app.config['RELATED_FILE'], table)
+    return {"videos": len(table)}
+
+job_queue.register('rebuild_related', rebuild_related)
+
+def related_table_stale():
+    age = related_index.age()
+    return age is None or age >= app.config['RELATED_REBUILD_INTERVAL']
+
+# 相关视频表由任务队列的 worker 定时重新计算，播放页和静态导出只读取已有的表
+job_queue.every('rebuild_related', app.config['RELATED_REBUILD_INTERVAL'], key='related',
+                due=related_table_stale)
+
+def related_videos(vid, limit=10):
+    # 相关视频表中没有的 (新视频或互动太少) 用热门视频补足
+    ids = related_index.related(vid, limit)
+    if len(ids) < limit:
+        ids = list(dict.fromkeys(ids + [v for v in trending.trending(limit + 1) if v != vid]))[:limit]
+    return view_counter.apply([v for v in map(catalog.peek_video, ids) if v])
+
+@app.cli.command('recommend')
+def recommend_command():
+    """重新计算相关视频表"""
+    result = rebuild_related()
+    print(f"生成了 {result['videos']} 个视频的相关视频")
+
+def static_pages():
+    # 静态导出的页面: 首页、每个视频页和每个用户主页，以匿名用户身份渲染
+    # 源数据不包含播放次数，只有播放次数变化的页面不重新生成
+    def render(path, view, *args):
+        def render_page():
+            with app.test_request_context(path):
+                return app.make_response(view(*args)).get_data()
+        return render_page
+    
+    def without_views(video):
+        return {k: v for k, v in video.items() if k != 'views'}
+    
+    def safe_name(name):
+        return name and '/' not in name and '\\' not in name and not name.startswith('.')
+    
+    first_page, _ = catalog.page_videos(limit=app.config['LIST_PAGE_SIZE'])
+    pages = [('index.html', [without_views(v) for v in first_page], render('/', index))]
+    
+    for video in catalog.list_videos():
+        if not safe_name(video['id']):
+            continue
+        author = catalog.get_user_by_name(video.get('author', ''))
+        data = [without_views(video),
+                author.get('followers', 0) if author else None,
+                related_index.related(video['id'])]
+        pages.append((f"video/{video['id']}/index.html", data,
+                      render(f"/video/{video['id']}", render_video_page, video)))
+    
+    for user in store.list_users():
+        username = user['username']
+        if not safe_name(username):
+            continue
+        videos, _ = catalog.page_videos(limit=app.config['LIST_PAGE_SIZE'], author=username)
+        data = [user.get('followers', 0), user.get('avatar'), [without_views(v) for v in videos]]
+        pages.append((f"user/{username}/index.html", data,
+                      render(f"/user/{quote(username)}", user_profile, username)))
+    return pages
+
+@app.cli.command('export')
+@click.option('--workers', type=int, default=None, help='并行渲染的线程数')
+@click.option('--force', is_flag=True, help='忽略 manifest，重新生成所有页面')
+def export_command(workers, force):
+    """把首页、视频页和用户主页导出为静态 HTML，只重新生成源数据变化过的页面"""
+    exporter = StaticExporter(app.config['STATIC_EXPORT_FOLDER'],
+                              workers=workers or app.config['STATIC_EXPORT_WORKERS'])
+    def progress(done, total):
+        print(f"\r{done}/{total}", end='', flush=True)
+    result = exporter.run(static_pages(), force=force, progress=progress)
+    if result['written']:
+        print()
+    print(f"生成 {result['written']} 个页面，跳过 {result['skipped']} 个，删除 {result['removed']} 个")
+
+def library_scanner(workers=None):
+    return LibraryScanner(app.config['UPLOAD_FOLDER'],
+                          app.config['SCAN_MANIFEST_FILE'],
+                          app.config['ALLOWED_EXTENSIONS'],
+                          analyze_video,
+                          workers=workers or app.config['SCAN_WORKERS'],
+                          batch_size=app.config['SCAN_BATCH_SIZE'])
+
+def commit_scan_results(results):
+    # 新文件批量加入目录，改动过的已有文件更新时长和缩略图，整批在一个事务中提交；
+    # 返回跳过的文件名
+    with catalog.transaction():
+        new_videos, skipped = commit_scan_batch(results)
+    for video in new_videos:
+        if 'duration_seconds' in video:
+            schedule_hls(video['id'], video['filename'])
+    return skipped
+
+def commit_scan_batch(results):
+    new_videos = []
+    skipped = []
+    for result in results:
+        if result['new']:
+            if catalog.get_video(result['vid']) is not None:
+                # 扫描期间上传的视频占用了这个 id，跳过这个文件，下次扫描重新分配
+                app.logger.warning(f"扫描跳过 {result['filename']}: 视频 id {result['vid']} 已被使用")
+                skipped.append(result['filename'])
+                continue
+            # 记录中保存磁盘上的实际文件名，下次扫描按文件名识别已有的视频
+            video = new_video_record(result['vid'],
+                                     result['vid'].replace('_', ' '),
+                                     result['filename'],
+                                     "系统",
+                                     thumbnail=default_thumbnail(catalog.count_videos() + len(new_videos)))
+            video.update(result['fields'])
+            new_videos.append(video)
+        else:
+            video = catalog.get_video(result['vid'], for_update=True)
+            if video:
+                video.update(result['fields'])
+                catalog.update_video(video)
+                if result['fields']:
+                    schedule_hls(video['id'], video['filename'], force=True)
+    if new_videos:
+        catalog.add_videos(new_videos)
+    return new_videos, skipped
+
+def scan_library(payload=None, progress=None):
+    known = {v['filename']: v['id'] for v in catalog.list_videos()}
+    workers = (payload or {}).get('workers')
+    total = library_scanner(workers).run(known, commit_scan_results, progress)
+    return {"processed": total}
+
+job_queue.register('scan_library', lambda payload: scan_library(
+    payload, lambda done, total: job_queue.report_progress({"done": done, "total": total})))
+
+@app.cli.command('snapshot')
+def snapshot_command():
+    """把视频/用户目录写入 CATALOG_SNAPSHOT_FILE，加快各 worker 的冷启动"""
+    if not app.config['CATALOG_SNAPSHOT_FILE']:
+        print("没有配置 CATALOG_SNAPSHOT_FILE")
+        return
+    catalog.refresh()
+    if catalog.save_snapshot():
+        print(f"已写入 {app.config['CATALOG_SNAPSHOT_FILE']}: {catalog.count_videos()} 个视频")
+
+@app.cli.command('scan')
+def scan_command():
+    """扫描 UPLOAD_FOLDER，把新增和改动过的视频加入数据库"""
+    def progress(done, total):
+        print(f"\r{done}/{total}", end='', flush=True)
+    result = scan_library(progress=progress)
+    print(f"\n处理了 {result['processed']} 个文件")
 
 def scan_videos():
-    try:
-        with open(app.config['DATA_FILE'], 'r') as f:
-            return json.load(f)
-    except:
-        return []
+    return view_counter.apply(catalog.list_videos())
+
+def video_popularity(vid):
+    video = catalog.peek_video(vid)
+    if not video:
+        return 0, 0
+    return video.get('views', 0) + view_counter.pending(vid), video.get('likes', 0)
+
+def page_args(default_limit):
+    # 游标分页参数: ?cursor=上一页最后一项的 id&limit=每页数量
+    cursor = request.args.get('cursor') or None
+    limit = request.args.get('limit', default_limit, type=int)
+    return cursor, max(1, min(limit, app.config['MAX_PAGE_SIZE']))
+
+def video_summary(video):
+    # 列表 API 返回的视频字段，不包含评论等大字段
+    return {
+        "id": video['id'],
+        "title": video.get('title'),
+        "author": video.get('author'),
+        "upload_date": video.get('upload_date'),
+        "duration": video.get('duration'),
+        "views": video.get('views', 0),
+        "likes": video.get('likes', 0),
+        "favorites": video.get('favorites', 0),
+        "thumbnail": thumbnail_url(video.get('thumbnail')),
+        "url": url_for('play_video', vid=video['id'])
+    }
+
+@app.template_global()
+def thumbnail_url(name, width=None):
+    # 列表中的缩略图使用缩放版本，URL 带原图版本号，可以长期缓存；原图不存在时使用原地址
+    if not name:
+        return None
+    version = thumbnail_cache.version(name)
+    if version is None:
+        return url_for('static', filename='thumbnails/' + name)
+    width = thumbnail_cache.bucket(width or app.config['THUMBNAIL_LIST_WIDTH'])
+    return url_for('thumbnail', width=width, name=name, v=version)
+
+def accepts_webp():
+    # 只看明确列出的 image/webp，*/* 不代表浏览器能解码 WebP
+    return any(value == 'image/webp' and quality > 0 for value, quality in request.accept_mimetypes)
+
+def video_page_json(videos, next_cursor):
+    return jsonify({
+        "status": "success",
+        "videos": [video_summary(v) for v in view_counter.apply(videos)],
+        "next_cursor": next_cursor
+    })
 
 def load_users():
-    try:
-        with open(app.config['USERS_FILE'], 'r') as f:
-            return json.load(f)
-    except:
-        return []
+    return store.list_users()
 
 def save_users(users):
-    with open(app.config['USERS_FILE'], 'w') as f:
-        json.dump(users, f, indent=2)
+    store.save_users(users)
+    catalog.invalidate()
 
 def get_user_following(user_id):
-    users = load_users()
-    user = next((u for u in users if u['id'] == user_id), None)
-    return user.get('following', []) if user else []
+    user = catalog.get_user(user_id)
+    return social_graph.following(user['username']) if user else frozenset()
 
 def get_user_favorites(user_id):
-    users = load_users()
-    user = next((u for u in users if u['id'] == user_id), None)
+    user = catalog.get_user(user_id)
     return user.get('favorites', []) if user else []
 
 # 登录检查装饰器
@@ -115,26 +664,136 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# 页面缓存装饰器: 按路由、参数、目录版本和当前用户缓存
+# 登录用户的页面包含导航栏和关注状态，按用户分别缓存；匿名用户共用一份
+def cached_page(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not app.config['PAGE_CACHE_ENABLED']:
+            return f(*args, **kwargs)
+        
+        catalog.refresh()
+        user_id = session.get('user_id')
+        key = (request.endpoint,
+               tuple(sorted(kwargs.items())),
+               tuple(sorted(request.args.items(multi=True))),
+               catalog.version,
+               user_id)
+        uncached = []
+        
+        def render():
+            response = app.make_response(f(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed:
+                uncached.append(response)
+                return None
+            return response.get_data(), response.mimetype
+        
+        page = page_cache.get_or_render(key, render)
+        if page is None:
+            return uncached[0] if uncached else f(*args, **kwargs)
+        
+        response = Response(page.body, mimetype=page.mimetype)
+        response.set_etag(page.etag)
+        response.headers['Cache-Control'] = 'private, no-cache' if user_id else 'public, no-cache'
+        return response.make_conditional(request)
+    return decorated_function
+
 @app.route('/')
+@cached_page
 def index():
-    videos = scan_videos()
-    return render_template('index.html', videos=videos, domain=app.config['SERVER_NAME'])
+    videos, next_cursor = catalog.page_videos(*page_args(app.config['LIST_PAGE_SIZE']))
+    videos = view_counter.apply(videos)
+    return render_template('index.html', videos=videos, next_cursor=next_cursor, domain=app.config['SERVER_NAME'])
+
+# 无限滚动用的 JSON 接口，next_cursor 为 null 表示没有更多
+@app.route('/api/videos')
+def api_videos():
+    return video_page_json(*catalog.page_videos(*page_args(app.config['LIST_PAGE_SIZE'])))
+
+@app.route('/api/user/<username>/videos')
+def api_user_videos(username):
+    if not catalog.get_user_by_name(username):
+        return jsonify({"status": "error", "message": "用户不存在"}), 404
+    cursor, limit = page_args(app.config['LIST_PAGE_SIZE'])
+    return video_page_json(*catalog.page_videos(cursor, limit, author=username))
+
+@app.route('/api/favorites')
+@login_required
+def api_favorites():
+    cursor, limit = page_args(app.config['LIST_PAGE_SIZE'])
+    return video_page_json(*catalog.page_favorites(session['user_id'], cursor, limit))
+
+@app.route('/feed')
+@login_required
+@cached_page
+def feed_page():
+    # 关注的人上传的视频，使用首页模板
+    videos, next_cursor = social_graph.feed(session['username'], *page_args(app.config['LIST_PAGE_SIZE']))
+    videos = view_counter.apply(videos)
+    return render_template('index.html', videos=videos, next_cursor=next_cursor, feed=True, domain=app.config['SERVER_NAME'])
+
+@app.route('/api/feed')
+@login_required
+def api_feed():
+    catalog.refresh()
+    return video_page_json(*social_graph.feed(session['username'], *page_args(app.config['LIST_PAGE_SIZE'])))
+
+@app.route('/api/trending')
+def api_trending():
+    catalog.refresh()
+    limit = page_args(app.config['LIST_PAGE_SIZE'])[1]
+    videos = [v for v in map(catalog.peek_video, trending.trending(limit)) if v]
+    return jsonify({"status": "success", "videos": [video_summary(v) for v in view_counter.apply(videos)]})
+
+@app.route('/video/<vid>/related')
+def api_related(vid):
+    if not catalog.get_video(vid):
+        return jsonify({"status": "error", "message": "视频不存在"}), 404
+    limit = page_args(10)[1]
+    return jsonify({"status": "success", "videos": [video_summary(v) for v in related_videos(vid, limit)]})
+
+@app.route('/video/<vid>/comments')
+def video_comments(vid):
+    if not catalog.get_video(vid):
+        return jsonify({"status": "error", "message": "视频不存在"}), 404
+    comments, next_cursor = catalog.page_comments(vid, *page_args(app.config['COMMENT_PAGE_SIZE']))
+    return jsonify({"status": "success", "comments": comments, "next_cursor": next_cursor})
+
+@app.route('/api/comments')
+def first_comments():
+    # 批量读取多个视频的第一页评论: ?ids=视频id,视频id,...
+    vids = [vid for vid in request.args.get('ids', '').split(',') if vid][:app.config['MAX_PAGE_SIZE']]
+    limit = page_args(app.config['COMMENT_PAGE_SIZE'])[1]
+    catalog.refresh()
+    vids = [vid for vid in vids if catalog.peek_video(vid)]
+    pages = catalog.first_comments(vids, limit)
+    return jsonify({"status": "success", "videos": {
+        vid: {"comments": comments,
+              "comment_count": catalog.peek_video(vid).get('comment_count', 0),
+              "next_cursor": next_cursor}
+        for vid, (comments, next_cursor) in pages.items()
+    }})
 
 # 添加搜索路由
 @app.route('/search')
+@cached_page
 def search():
     query = request.args.get('q', '').strip().lower()
-    videos = scan_videos()
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = app.config['SEARCH_PAGE_SIZE']
     
-    if query:
-        filtered_videos = [
-            v for v in videos 
-            if query in v['title'].lower() or query in v['filename'].lower()
-        ]
-    else:
-        filtered_videos = videos
+    catalog.refresh()
+    vids, total = search_index.search(query, page=page, per_page=per_page, popularity=video_popularity)
+    filtered_videos = view_counter.apply([v for v in map(catalog.peek_video, vids) if v])
     
-    return render_template('search.html', videos=filtered_videos, query=query, domain=app.config['SERVER_NAME'])
+    return render_template('search.html',
+                          videos=filtered_videos,
+                          query=query,
+                          page=page,
+                          per_page=per_page,
+                          total=total,
+                          has_next=page * per_page < total,
+                          domain=app.config['SERVER_NAME'])
 
 @app.route('/upload')
 @login_required
@@ -143,98 +802,150 @@ def upload_page():
 
 @app.route('/video/<vid>')
 def play_video(vid):
-    videos = scan_videos()
-    video = next((v for v in videos if v['id'] == vid), None)
+    video = catalog.get_video(vid)
     if video:
-        video['safe_filename'] = secure_filename(video['filename'])
-        video['views'] += 1
-        with open(app.config['DATA_FILE'], 'w') as f:
-            json.dump(videos, f, indent=2)
-        
-        # 检查当前用户是否点赞/收藏
-        liked = False
-        favorited = False
-        if 'user_id' in session:
-            liked = session['username'] in video.get('liked_by', [])
-            favorited = vid in get_user_favorites(session['user_id'])
-        
-        # 获取作者粉丝数
-        author_followers = 0
-        users = load_users()
-        author_user = next((u for u in users if u['username'] == video.get('author', '')), None)
-        if author_user:
-            author_followers = author_user.get('followers', 0)
-        
+        view_counter.add(vid)
+        trending.record(vid, 'view')
+        return render_video_page(video)
+    return "Video not found", 404
+
+def render_video_page(video):
+    vid = video['id']
+    video = dict(video, views=video['views'] + view_counter.pending(vid))
+    video['safe_filename'] = secure_filename(video['filename'])
+    
+    # 检查当前用户是否点赞/收藏
+    liked = False
+    favorited = False
+    if 'user_id' in session:
+        liked = catalog.has_liked(vid, session['username'])
+        favorited = catalog.is_favorite(session['user_id'], vid)
+    
+    # 获取作者粉丝数
+    author_followers = 0
     author_avatar = 'default_avatar.jpg'  # 默认值
+    author_user = catalog.get_user_by_name(video.get('author', ''))
     if author_user:
+        author_followers = author_user.get('followers', 0)
         author_avatar = author_user.get('avatar', 'default_avatar.jpg')
 
-        # 获取当前用户关注列表
-        current_user_following = []
-        if 'user_id' in session:
-            current_user_following = get_user_following(session['user_id'])
-        
-        # 弹幕区域高度百分比 (25%)
-        danmu_height = 25
-        
-        return render_template('video.html', 
-                              video=video, 
-                              domain=app.config['SERVER_NAME'],
-                              liked=liked,
-                              favorited=favorited,
-                              author_followers=author_followers,
-                              current_user_following=current_user_following,
-                              comments=video.get('comments', []),
-                              danmu_height=danmu_height,
-                              author_avatar=author_avatar)
-    return "Video not found", 404
+    # 获取当前用户关注列表
+    current_user_following = []
+    if 'user_id' in session:
+        current_user_following = get_user_following(session['user_id'])
+    
+    # 相关视频
+    related = related_videos(vid)
+    
+    # 只渲染最新一页评论，更早的评论通过 /video/<vid>/comments 加载
+    comments, next_comment_cursor = catalog.page_comments(vid, limit=app.config['COMMENT_PAGE_SIZE'])
+    
+    # 弹幕区域高度百分比 (25%)
+    danmu_height = 25
+    
+    # HLS 打包完成后播放自适应码率，否则播放原始文件
+    hls_url = url_for('static', filename=video['hls']) if video.get('hls') else None
+    
+    return render_template('video.html', 
+                          video=video, 
+                          domain=app.config['SERVER_NAME'],
+                          liked=liked,
+                          favorited=favorited,
+                          author_followers=author_followers,
+                          current_user_following=current_user_following,
+                          comments=comments,
+                          comment_count=video.get('comment_count', 0),
+                          next_comment_cursor=next_comment_cursor,
+                          danmu_height=danmu_height,
+                          author_avatar=author_avatar,
+                          hls_url=hls_url,
+                          related_videos=related)
 
-@app.route('/update')
-def manual_update():
-    video_files = [f for f in os.listdir(app.config['UPLOAD_FOLDER']) 
-                  if f.split('.')[-1] in app.config['ALLOWED_EXTENSIONS']]
+# 缩略图按宽度档位缩小，其他宽度重定向到不小于它的档位
+@app.route('/thumb/<int:width>/<name>')
+def thumbnail(width, name):
+    bucket = thumbnail_cache.bucket(width)
+    if bucket != width:
+        # 只转发版本参数，查询串中的其他参数 (包括 name/width) 不参与
+        return redirect(url_for('thumbnail', width=bucket, name=name, v=request.args.get('v')), 301)
     
-    try:
-        with open(app.config['DATA_FILE'], 'r') as f:
-            videos = json.load(f)
-    except:
-        videos = []
+    path, version = thumbnail_cache.get(name, width, webp=accepts_webp())
+    if version is None:
+        return "Thumbnail not found", 404
+    if path is None:
+        # 缩放失败或等待超时时返回原图，只短时间缓存
+        response = send_from_directory(app.config['THUMBNAIL_FOLDER'], name, max_age=60)
+    else:
+        response = send_file(path, mimetype='image/webp' if path.endswith('.webp') else 'image/jpeg',
+                             conditional=True, max_age=60)
+        # URL 中的版本与原图一致时内容不会再变
+        if request.args.get('v') == version:
+            response.headers['Cache-Control'] = \
+                f"public, max-age={app.config['THUMBNAIL_CACHE_MAX_AGE']}, immutable"
+    response.vary.add('Accept')
+    return response
+
+# 覆盖默认的 /static 处理，视频文件支持 Range、条件请求和 sendfile
+@app.route('/static/videos/<path:filename>')
+def stream_video(filename):
+    path = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    if path is None or not os.path.isfile(path):
+        return "Video not found", 404
     
-    existing_files = {v['filename'] for v in videos}
+    accel_redirect = None
+    if app.config['VIDEO_ACCEL_REDIRECT_PREFIX']:
+        accel_redirect = app.config['VIDEO_ACCEL_REDIRECT_PREFIX'] + quote(filename)
     
-    for filename in video_files:
-        if filename not in existing_files:
-            vid = filename.split('.')[0]
-            safe_filename = secure_filename(filename)
-            duration = get_video_duration(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            
-            thumbnail_filename = f"{vid}.jpg"
-            thumbnail_path = os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_filename)
-            if not generate_thumbnail(os.path.join(app.config['UPLOAD_FOLDER'], filename), thumbnail_path):
-                idx = len(videos) % len(app.config['DEFAULT_THUMBNAILS'])
-                thumbnail_filename = app.config['DEFAULT_THUMBNAILS'][idx]
-            
-            video_data = {
-                "id": vid,
-                "title": filename.split('.')[0].replace('_', ' '),
-                "filename": safe_filename,
-                "upload_date": datetime.now().strftime("%Y-%m-%d"),
-                "views": 0,
-                "duration": duration,
-                "thumbnail": thumbnail_filename,
-                "author": "系统",
-                "likes": 0,
-                "favorites": 0,
-                "liked_by": [],
-                "favorited_by": [],
-                "comments": []
-            }
-            videos.append(video_data)
-    
-    with open(app.config['DATA_FILE'], 'w') as f:
-        json.dump(videos, f, indent=2)
-    
-    return "Database updated successfully"
+    return send_video(request, path,
+                      max_age=app.config['VIDEO_CACHE_MAX_AGE'],
+                      accel_redirect=accel_redirect,
+                      sendfile_header=app.config['VIDEO_SENDFILE_HEADER'])
+
+@app.route('/video/<vid>/status')
+def video_status(vid):
+    video = catalog.get_video(vid)
+    if not video:
+        return jsonify({"status": "error", "message": "视频不存在"}), 404
+    
+    job = job_queue.latest(vid, kind='process_video')
+    return jsonify({
+        "status": "success",
+        "video_id": vid,
+        # 没有任务记录的是旧视频或 /update 导入的视频，视为已处理
+        "processing": job['status'] if job else "done",
+        "attempts": job['attempts'] if job else 0,
+        "error": job['error'] if job else None,
+        "duration": video.get('duration'),
+        "thumbnail": video.get('thumbnail')
+    })
+
+@app.route('/update')
+def manual_update():
+    # 扫描在后台任务中进行，已有扫描任务未结束时直接返回该任务
+    job = job_queue.active('library', 'scan_library')
+    job_id = job['id'] if job else job_queue.enqueue('scan_library', {}, key='library', max_attempts=1)
+    return jsonify({"status": "success", "message": "数据库更新已开始", "job_id": job_id})
+
+@app.route('/update/status')
+def update_status():
+    job = job_queue.latest('library', kind='scan_library')
+    if not job:
+        return jsonify({"status": "success", "processing": None})
+    return jsonify({
+        "status": "success",
+        "job_id": job['id'],
+        "processing": job['status'],
+        "progress": job['progress'],
+        "result": job['result'],
+        "error": job['error']
+    })
+
+@app.route('/metrics')
+def metrics_page():
+    allowed = app.config['METRICS_ALLOWED_IPS']
+    if not app.config['METRICS_ENABLED'] or (allowed is not None and request.remote_addr not in allowed):
+        return "Not Found", 404
+    return Response(metrics.render(), content_type=Registry.CONTENT_TYPE)
 
 @app.route('/upload_video', methods=['POST'])
 @login_required
@@ -249,70 +960,16 @@ def upload_video():
             return jsonify({"status": "error", "message": "没有选择文件"}), 400
         
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            vid = filename.split('.')[0]
-            
-            counter = 1
-            original_filename = filename
-            while os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
-                name, ext = os.path.splitext(original_filename)
-                filename = f"{name}_{counter}{ext}"
-                vid = filename.split('.')[0]
-                counter += 1
-            
-            video_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(video_path)
-            os.chmod(video_path, 0o644)
-            
-            duration = get_video_duration(video_path)
-            
-            thumbnail_filename = f"{vid}.jpg"
-            thumbnail_path = os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_filename)
-            if not generate_thumbnail(video_path, thumbnail_path):
-                try:
-                    with open(app.config['DATA_FILE'], 'r') as f:
-                        videos = json.load(f)
-                except:
-                    videos = []
-                idx = len(videos) % len(app.config['DEFAULT_THUMBNAILS'])
-                thumbnail_filename = app.config['DEFAULT_THUMBNAILS'][idx]
-            
-            title = request.form.get('title', filename.split('.')[0].replace('_', ' '))
-            if not title.strip():
-                title = filename.split('.')[0].replace('_', ' ')
-            
-            video_data = {
-                "id": vid,
-                "title": title,
-                "filename": filename,
-                "upload_date": datetime.now().strftime("%Y-%m-%d"),
-                "views": 0,
-                "duration": duration,
-                "thumbnail": thumbnail_filename,
-                "author": session['username'],
-                "likes": 0,
-                "favorites": 0,
-                "liked_by": [],
-                "favorited_by": [],
-                "comments": []
-            }
-            
+            # 先保存到临时目录，再以不重复的文件名链接到上传目录
+            tmp_path = os.path.join(app.config['UPLOAD_TMP_FOLDER'], uuid.uuid4().hex + '.upload')
             try:
-                with open(app.config['DATA_FILE'], 'r') as f:
-                    videos = json.load(f)
-            except:
-                videos = []
-            
-            videos.append(video_data)
-            
-            with open(app.config['DATA_FILE'], 'w') as f:
-                json.dump(videos, f, indent=2)
+                file.save(tmp_path)
+                filename = publish_file(tmp_path, app.config['UPLOAD_FOLDER'], secure_filename(file.filename))
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
             
-            return jsonify({
-                "status": "success", 
-                "message": "视频上传成功",
-                "video_id": vid
-            })
+            return jsonify(register_upload(filename, request.form.get('title')))
         else:
             return jsonify({
                 "status": "error", 
@@ -321,6 +978,149 @@ def upload_video():
     
     return jsonify({"status": "error", "message": "无效请求"}), 400
 
+def register_upload(filename, title):
+    # 文件已放入上传目录: 加入目录并交给后台任务处理
+    base = filename.split('.')[0]
+    if not title or not title.strip():
+        title = base.replace('_', ' ')
+
+    # 时长和缩略图由后台任务补上，处理完成前先使用默认缩略图。
+    # clip.mp4 和 clip.webm、clip.v2.mp4 的 id 相同，加入目录失败时换下一个序号，
+    # 由存储的唯一约束保证并发上传不会取得同一个 id
+    try:
+        video_data = new_video_record(base, title, filename, session['username'])
+        taken = set()
+        while not catalog.add_video(video_data):
+            taken.add(video_data['id'])
+            video_data['id'] = unique_id(base, taken)
+    except:
+        # 没有加入目录的文件不留在上传目录中
+        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        raise
+    vid = video_data['id']
+    job_id = job_queue.enqueue('process_video', {"vid": vid, "filename": filename}, key=vid)
+    
+    return {
+        "status": "success", 
+        "message": "视频上传成功",
+        "video_id": vid,
+        "job_id": job_id,
+        "processing": "pending"
+    }
+
+def upload_error(e):
+    body = {"status": "error", "message": e.message}
+    headers = {}
+    if e.offset is not None:
+        body["offset"] = e.offset
+        headers['Upload-Offset'] = str(e.offset)
+    return jsonify(body), e.status, headers
+
+def owned_upload(upload_id):
+    state = upload_manager.get(upload_id)
+    if state['owner'] != session['user_id']:
+        raise UploadError("上传不存在", 404)
+    return state
+
+# 分片上传: POST /uploads 创建，PATCH /uploads/<id> 按 Upload-Offset 追加数据，
+# HEAD/GET /uploads/<id> 查询已保存的偏移，POST /uploads/<id>/finish 完成
+@app.route('/uploads', methods=['POST'])
+@login_required
+def create_upload():
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get('filename') or '')
+    if not filename or not allowed_file(filename):
+        return jsonify({
+            "status": "error", 
+            "message": "不支持的文件类型，仅支持MP4、WebM、MKV"
+        }), 400
+    
+    try:
+        state = upload_manager.create(filename, data.get('size'), session['user_id'],
+                                      checksum=data.get('checksum'),
+                                      metadata={"title": data.get('title')})
+    except UploadError as e:
+        return upload_error(e)
+    
+    location = url_for('upload_status', upload_id=state['id'])
+    return jsonify({
+        "status": "success",
+        "upload_id": state['id'],
+        "offset": 0,
+        "size": state['size'],
+        "chunk_size": app.config['UPLOAD_CHUNK_SIZE'],
+        "location": location
+    }), 201, {'Location': location}
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    try:
+        state = owned_upload(upload_id)
+    except UploadError as e:
+        return upload_error(e)
+    headers = {
+        'Upload-Offset': str(state['offset']),
+        'Upload-Length': str(state['size']),
+        'Cache-Control': 'no-store'
+    }
+    return jsonify({
+        "status": "success",
+        "upload_id": state['id'],
+        "offset": state['offset'],
+        "size": state['size']
+    }), 200, headers
+
+@app.route('/uploads/<upload_id>', methods=['PATCH'])
+@login_required
+def upload_chunk(upload_id):
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return jsonify({"status": "error", "message": "缺少 Upload-Offset"}), 400
+    
+    try:
+        owned_upload(upload_id)
+        offset = upload_manager.write(upload_id, offset, request.stream, request.content_length)
+    except UploadError as e:
+        return upload_error(e)
+    return '', 204, {'Upload-Offset': str(offset)}
+
+@app.route('/uploads/<upload_id>/finish', methods=['POST'])
+@login_required
+def finish_upload(upload_id):
+    try:
+        owned_upload(upload_id)
+        filename, state = upload_manager.complete(upload_id, app.config['UPLOAD_FOLDER'])
+    except UploadError as e:
+        return upload_error(e)
+    return jsonify(register_upload(filename, state['metadata'].get('title')))
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def abort_upload(upload_id):
+    try:
+        owned_upload(upload_id)
+        upload_manager.abort(upload_id)
+    except UploadError as e:
+        return upload_error(e)
+    return '', 204
+
+def start_session(user):
+    # 登录/注册成功: 清掉旧会话中的数据，服务端会话同时更换会话 id
+    # 关注列表等用户数据不放进会话，需要时从关注关系图读取
+    session.clear()
+    if hasattr(session, 'regenerate'):
+        session.regenerate()
+    session['user_id'] = user['id']
+    session['username'] = user['username']
+
+def auth_busy(template):
+    response = app.make_response((render_template(template, error='请求过多，请稍后重试',
+                                                  domain=app.config['SERVER_NAME']), 503))
+    response.headers['Retry-After'] = '1'
+    return response
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -334,25 +1134,29 @@ def register():
         if password != confirm_password:
             return render_template('register.html', error='两次输入的密码不一致', domain=app.config['SERVER_NAME'])
         
-        users = load_users()
-        if any(user['username'] == username for user in users):
+        if catalog.get_user_by_name(username):
             return render_template('register.html', error='用户名已存在', domain=app.config['SERVER_NAME'])
         
+        try:
+            password_hash = password_hasher.hash(password)
+        except AuthBusy:
+            return auth_busy('register.html')
+        
         new_user = {
             'id': str(uuid.uuid4()),
             'username': username,
-            'password': generate_password_hash(password),
+            'password': password_hash,
             'register_date': datetime.now().strftime("%Y-%m-%d"),
             'followers': 0,
             'following': [],
             'favorites': []
         }
         
-        users.append(new_user)
-        save_users(users)
+        # 同名用户并发注册时由存储的唯一索引保证只有一个成功
+        if not catalog.add_user(new_user):
+            return render_template('register.html', error='用户名已存在', domain=app.config['SERVER_NAME'])
         
-        session['user_id'] = new_user['id']
-        session['username'] = new_user['username']
+        start_session(new_user)
         return redirect(url_for('index'))
     
     return render_template('register.html', domain=app.config['SERVER_NAME'])
@@ -363,59 +1167,43 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
         
-        users = load_users()
-        user = next((u for u in users if u['username'] == username), None)
+        user = catalog.get_user_by_name(username)
         
-        if not user or not check_password_hash(user['password'], password):
+        try:
+            valid = user is not None and password_hasher.verify(user['password'], password)
+        except AuthBusy:
+            return auth_busy('login.html')
+        if not valid:
             return render_template('login.html', error='用户名或密码错误', domain=app.config['SERVER_NAME'])
         
-        session['user_id'] = user['id']
-        session['username'] = user['username']
+        start_session(user)
         return redirect(url_for('index'))
     
     return render_template('login.html', domain=app.config['SERVER_NAME'])
 
 @app.route('/logout')
 def logout():
-    session.pop('user_id', None)
-    session.pop('username', None)
+    # 服务端会话清空后删除记录
+    session.clear()
     return redirect(url_for('index'))
 
 @app.route('/follow/<username>', methods=['POST'])
 @login_required
 def follow_user(username):
     try:
-        users = load_users()
-        current_user = next((u for u in users if u['id'] == session['user_id']), None)
-        target_user = next((u for u in users if u['username'] == username), None)
-        
-        if not target_user:
-            return jsonify({"status": "error", "message": "用户不存在"}), 404
-        
         if username == session['username']:
             return jsonify({"status": "error", "message": "不能关注自己"}), 400
         
-        # 确保 following 字段存在
-        if 'following' not in current_user:
-            current_user['following'] = []
-        
-        if username in current_user['following']:
-            current_user['following'].remove(username)
-            target_user['followers'] = max(0, target_user.get('followers', 0) - 1)
-            action = "unfollow"
-        else:
-            current_user['following'].append(username)
-            target_user['followers'] = target_user.get('followers', 0) + 1
-            action = "follow"
-        
-        # 更新会话中的关注列表
-        session['following'] = current_user['following']
+        # 关注关系和粉丝数在同一个事务中切换
+        added, followers = catalog.toggle('follow', username, session['username'])
+        if added is None:
+            return jsonify({"status": "error", "message": "用户不存在"}), 404
+        action = "follow" if added else "unfollow"
         
-        save_users(users)
         return jsonify({
             "status": "success", 
             "action": action, 
-            "followers": target_user['followers']
+            "followers": followers
         })
     except Exception as e:
         app.logger.error(f"关注操作失败: {str(e)}")
@@ -424,118 +1212,109 @@ def follow_user(username):
 @app.route('/video/<vid>/like', methods=['POST'])
 @login_required
 def like_video(vid):
-    videos = scan_videos()
-    video = next((v for v in videos if v['id'] == vid), None)
+    # 已点赞则取消，否则点赞
+    added, likes = catalog.toggle('like', vid, session['username'])
     
-    if not video:
+    if added is None:
         return jsonify({"status": "error", "message": "视频不存在"}), 404
     
-    username = session['username']
-    
-    if username in video['liked_by']:
-        # 取消点赞
-        video['liked_by'].remove(username)
-        video['likes'] -= 1
-        action = "unlike"
-    else:
-        # 点赞
-        video['liked_by'].append(username)
-        video['likes'] += 1
-        action = "like"
-    
-    with open(app.config['DATA_FILE'], 'w') as f:
-        json.dump(videos, f, indent=2)
-    
-    return jsonify({"status": "success", "action": action, "likes": video['likes']})
+    action = "like" if added else "unlike"
+    if added:
+        trending.record(vid, 'like')
+    return jsonify({"status": "success", "action": action, "likes": likes})
 
 @app.route('/video/<vid>/favorite', methods=['POST'])
 @login_required
 def favorite_video(vid):
-    videos = scan_videos()
-    video = next((v for v in videos if v['id'] == vid), None)
+    # 用户的收藏列表和视频的收藏数在同一个事务中切换
+    added, favorites = catalog.toggle('favorite', vid, session['user_id'])
     
-    if not video:
+    if added is None:
         return jsonify({"status": "error", "message": "视频不存在"}), 404
     
-    users = load_users()
-    user = next((u for u in users if u['id'] == session['user_id']), None)
-    username = session['username']
-    
-    if vid in user['favorites']:
-        # 取消收藏
-        user['favorites'].remove(vid)
-        if username in video['favorited_by']:
-            video['favorited_by'].remove(username)
-        video['favorites'] -= 1
-        action = "unfavorite"
-    else:
-        # 收藏
-        user['favorites'].append(vid)
-        video['favorited_by'].append(username)
-        video['favorites'] += 1
-        action = "favorite"
-    
-    save_users(users)
-    with open(app.config['DATA_FILE'], 'w') as f:
-        json.dump(videos, f, indent=2)
-    
-    return jsonify({"status": "success", "action": action, "favorites": video['favorites']})
+    action = "favorite" if added else "unfavorite"
+    if added:
+        trending.record(vid, 'favorite')
+    return jsonify({"status": "success", "action": action, "favorites": favorites})
 
 @app.route('/favorites')
 @login_required
+@cached_page
 def favorites_page():
-    users = load_users()
-    user = next((u for u in users if u['id'] == session['user_id']), None)
+    user = catalog.get_user(session['user_id'])
     
     if not user:
         return redirect(url_for('login'))
     
-    videos = scan_videos()
-    favorite_videos = [v for v in videos if v['id'] in user['favorites']]
+    favorite_videos, next_cursor = catalog.page_favorites(user['id'], *page_args(app.config['LIST_PAGE_SIZE']))
+    favorite_videos = view_counter.apply(favorite_videos)
     
-    return render_template('favorites.html', videos=favorite_videos, domain=app.config['SERVER_NAME'])
+    return render_template('favorites.html', videos=favorite_videos, next_cursor=next_cursor, domain=app.config['SERVER_NAME'])
 
 @app.route('/video/<vid>/danmu', methods=['POST'])
 def send_danmu(vid):
+    if not catalog.get_video(vid):
+        return jsonify({"status": "error", "message": "视频不存在"}), 404
+    
     data = request.get_json()
     text = data.get('text', '')
     
     if not text:
         return jsonify({"status": "error", "message": "弹幕内容不能为空"}), 400
     
-    if vid not in video_danmus:
-        video_danmus[vid] = []
+    # 弹幕在视频中的播放位置 (秒)
+    try:
+        offset = float(data.get('offset', 0))
+    except (TypeError, ValueError):
+        offset = 0.0
+    # inf / nan / 1e308 不能换算成段号，在广播之前拒绝
+    if not math.isfinite(offset) or offset > app.config['DANMU_MAX_OFFSET']:
+        return jsonify({"status": "error", "message": "播放位置无效"}), 400
+    offset = max(0.0, offset)
     
-    # 存储弹幕
+    # 存储并广播弹幕
     danmu = {
         'text': text,
         'time': time.time(),
+        'offset': offset,
         'author': session.get('username', '匿名')
     }
     
-    video_danmus[vid].append(danmu)
-    return jsonify({"status": "success"})
+    event_id = danmu_broadcaster.publish(vid, danmu)
+    danmu_store.append(vid, dict(danmu, id=event_id))
+    return jsonify({"status": "success", "id": event_id})
+
+@app.route('/video/<vid>/danmu', methods=['GET'])
+def danmu_range(vid):
+    # 按播放位置取弹幕，例如 ?start=120&end=180
+    start = request.args.get('start', 0, type=float)
+    # inf / nan 不能换算成段号，也不能写进 JSON
+    if not math.isfinite(start):
+        return jsonify({"status": "error", "message": "时间范围无效"}), 400
+    start = max(0.0, start)
+    end = request.args.get('end', start + app.config['DANMU_SEGMENT_SECONDS'], type=float)
+    if not math.isfinite(end) or end <= start:
+        return jsonify({"status": "error", "message": "时间范围无效"}), 400
+    if end - start > app.config['DANMU_SEGMENT_SECONDS'] * app.config['DANMU_RANGE_MAX_SEGMENTS']:
+        return jsonify({"status": "error", "message": "时间范围过大"}), 400
+    
+    danmus = danmu_store.range(vid, start, end, limit=app.config['DANMU_RANGE_LIMIT'])
+    return jsonify({"status": "success", "start": start, "end": end, "danmus": danmus})
 
 @app.route('/video/<vid>/danmu_stream')
 def danmu_stream(vid):
-    def event_stream():
-        last_id = 0
-        while True:
-            if vid in video_danmus and len(video_danmus[vid]) > last_id:
-                for danmu in video_danmus[vid][last_id:]:
-                    yield f"data: {json.dumps(danmu)}\n\n"
-                    last_id += 1
-            time.sleep(0.5)
+    # EventSource 重连时会带 Last-Event-ID 头，首次连接也可以用查询参数指定
+    last_event_id = parse_last_event_id(
+        request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
     
-    return Response(event_stream(), mimetype="text/event-stream")
+    return Response(danmu_broadcaster.stream(vid, last_event_id),
+                    mimetype="text/event-stream",
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/video/<vid>/comment', methods=['POST'])
 @login_required
 def post_comment(vid):
-    videos = scan_videos()
-    video = next((v for v in videos if v['id'] == vid), None)
-    
-    if not video:
+    if not catalog.get_video(vid):
         return jsonify({"status": "error", "message": "视频不存在"}), 404
     
     data = request.get_json()
@@ -552,26 +1331,24 @@ def post_comment(vid):
         'time': datetime.now().strftime("%Y-%m-%d %H:%M")
     }
     
-    if 'comments' not in video:
-        video['comments'] = []
-    
-    video['comments'].append(comment)
-    
-    with open(app.config['DATA_FILE'], 'w') as f:
-        json.dump(videos, f, indent=2)
+    # 追加到评论表并更新评论数，只写一行评论和一行视频记录
+    if catalog.add_comment(vid, comment) is None:
+        return jsonify({"status": "error", "message": "视频不存在"}), 404
+    trending.record(vid, 'comment')
     
     return jsonify({"status": "success", "comment": comment})
 
 @app.route('/user/<username>')
+@cached_page
 def user_profile(username):
-    users = load_users()
-    user = next((u for u in users if u['username'] == username), None)
+    user = catalog.get_user_by_name(username)
     
     if not user:
         return "用户不存在", 404
     
-    videos = scan_videos()
-    user_videos = [v for v in videos if v.get('author') == username]
+    cursor, limit = page_args(app.config['LIST_PAGE_SIZE'])
+    user_videos, next_cursor = catalog.page_videos(cursor, limit, author=username)
+    user_videos = view_counter.apply(user_videos)
     
     # 获取当前用户关注列表
     current_user_following = []
@@ -581,22 +1358,15 @@ def user_profile(username):
     return render_template('profile.html', 
                           user=user, 
                           videos=user_videos, 
+                          next_cursor=next_cursor,
+                          video_count=catalog.count_videos(author=username),
                           domain=app.config['SERVER_NAME'],
                           current_user_following=current_user_following)
 
-def export_static_pages():
-    with app.test_client() as client:
-        response = client.get('/')
-        with open('index_exported.html', 'wb') as f:
-            f.write(response.data)
-
-@app.route('/')
-def home():
-    return render_template('index.html')
-
-export_static_pages()
-
 if __name__ == '__main__':
+    # 继续处理上次退出时未完成的任务
+    job_queue.start()
+    
     # 使用域名对应的SSL证书
     ssl_context = (
         os.path.join(BASE_DIR, 'cert.pem'),
@@ -0,0 +1,80 @@
+"""ASGI 入口: 弹幕 SSE 由 asyncio 直接处理，其余请求交给 Flask
+
+大量观众同时连接弹幕流时，每个连接不再占用一个线程:
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5062 \
+        --ssl-certfile cert.pem --ssl-keyfile key.pem
+
+需要额外安装 asgiref 和 uvicorn。弹幕广播器是进程内的，发送和订阅必须在同一进程，
+因此只运行一个 worker。
+"""
+import asyncio
+import re
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app, danmu_broadcaster
+from danmu import parse_last_event_id
+
+
+_DANMU_STREAM_RE = re.compile(r'^/video/([^/]+)/danmu_stream$')
+
+flask_application = WsgiToAsgi(app)
+
+
+async def _wait_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def danmu_stream(scope, receive, send, vid):
+    headers = dict(scope['headers'])
+    query = parse_qs(scope.get('query_string', b'').decode())
+    last_event_id = parse_last_event_id(
+        headers.get(b'last-event-id', b'').decode() or query.get('last_event_id', [''])[0])
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ],
+    })
+    disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+    stream = danmu_broadcaster.astream(vid, last_event_id)
+    try:
+        while True:
+            # 同时等待下一条弹幕和客户端断开，断开时立即释放订阅
+            next_frame = asyncio.ensure_future(stream.__anext__())
+            await asyncio.wait({next_frame, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_frame.done():
+                next_frame.cancel()
+                await asyncio.gather(next_frame, return_exceptions=True)
+                break
+            try:
+                frame = next_frame.result()
+            except StopAsyncIteration:
+                break
+            await send({'type': 'http.response.body', 'body': frame.encode(), 'more_body': True})
+        if not disconnected.done():
+            await send({'type': 'http.response.body', 'body': b''})
+    except OSError:
+        # 客户端已断开
+        pass
+    finally:
+        disconnected.cancel()
+        await stream.aclose()
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        match = _DANMU_STREAM_RE.match(scope['path'])
+        if match:
+            await danmu_stream(scope, receive, send, match.group(1))
+            return
+    await flask_application(scope, receive, send)
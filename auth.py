@@ -0,0 +1,77 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class AuthBusy(Exception):
+    """密码哈希的排队已满或等待超时，应返回 503 让客户端稍后重试"""
+
+
+class PasswordHasher:
+    """在独立的有界线程池中计算和校验密码哈希
+
+    scrypt/pbkdf2 计算期间释放 GIL，放到固定大小的线程池里后，同时进行的哈希计算
+    最多 workers 个，不会占满所有请求线程。已提交但未完成的任务最多 max_pending 个，
+    超出时直接拒绝 (AuthBusy)，登录高峰时其他路由的请求不受影响。
+    """
+
+    def __init__(self, workers=2, max_pending=16, timeout=10.0, method=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.method = method
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._pool = None
+        self._pid = None
+        self.rejected = 0
+
+    def _executor(self):
+        # fork 出来的 worker 进程没有父进程的线程，按 pid 重新创建线程池
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix='password-hash')
+                    self._pending = 0
+                    self._pid = os.getpid()
+        return self._pool
+
+    def _run(self, fn, *args):
+        pool = self._executor()
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise AuthBusy()
+            self._pending += 1
+        try:
+            future = pool.submit(fn, *args)
+        except:
+            self._release()
+            raise
+        # 计算完成时才释放名额，等待超时的请求不会让排队的任务越积越多
+        future.add_done_callback(self._release)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            with self._lock:
+                self.rejected += 1
+            raise AuthBusy()
+
+    def _release(self, future=None):
+        with self._lock:
+            self._pending -= 1
+
+    def pending(self):
+        """正在计算或排队的哈希任务数"""
+        return self._pending
+
+    def hash(self, password):
+        if self.method:
+            return self._run(generate_password_hash, password, self.method)
+        return self._run(generate_password_hash, password)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
@@ -0,0 +1,119 @@
+"""生成基准测试用的 videos.json / users.json
+
+    python bench/datagen.py --rows 100k --out /tmp/ts-data
+
+格式与 app.py 写入的记录相同，首次启动时由 SQLite 后端一次性导入。相同的 rows 和 seed
+总是生成相同的数据 (密码哈希的盐除外)。所有用户的密码都是 PASSWORD。
+"""
+import argparse
+import json
+import os
+import random
+from datetime import date, timedelta
+
+from werkzeug.security import generate_password_hash
+
+
+PASSWORD = 'bench-password'
+
+PRESETS = {'1k': 1000, '100k': 100000, '1m': 1000000}
+
+WORDS = ('游戏 音乐 教程 旅行 美食 科技 动画 体育 电影 新闻 测评 编程 Python Flask 直播 '
+         '猫 狗 日常 挑战 翻唱 舞蹈 手工 摄影 汽车 历史 科普 搞笑 vlog 开箱 合集 '
+         'minecraft guitar piano tutorial review travel cooking linux rust video').split()
+
+
+def parse_rows(value):
+    value = str(value).lower()
+    if value in PRESETS:
+        return PRESETS[value]
+    return int(value)
+
+
+def user_count(rows):
+    return max(100, rows // 10)
+
+
+def _write_list(path, records):
+    # 逐条写出，100 万行时也不需要把整个 JSON 字符串放在内存里
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write('[')
+        for i, record in enumerate(records):
+            if i:
+                f.write(',\n')
+            json.dump(record, f, ensure_ascii=False)
+        f.write(']')
+    os.replace(tmp_path, path)
+
+
+def generate_users(n, rng, password_hash):
+    names = [f"user{i:07d}" for i in range(n)]
+    # 先生成关注关系，粉丝数与之一致
+    following = [[t for t in rng.sample(names, min(n, rng.randrange(0, 20))) if t != name] for name in names]
+    followers = dict.fromkeys(names, 0)
+    for targets in following:
+        for target in targets:
+            followers[target] += 1
+    start = date(2023, 1, 1)
+    for i, name in enumerate(names):
+        yield {
+            'id': f"u{i:07d}",
+            'username': name,
+            'password': password_hash,
+            'register_date': (start + timedelta(days=rng.randrange(700))).strftime("%Y-%m-%d"),
+            'followers': followers[name],
+            'following': following[i],
+            'favorites': [],
+        }
+
+
+def generate_videos(n, users, rng):
+    start = date(2023, 1, 1)
+    thumbnails = ['default.jpg', 'default1.jpg', 'default2.jpg']
+    for i in range(n):
+        minutes, seconds = rng.randrange(60), rng.randrange(60)
+        comments = [{
+            'id': f"c{i:07d}-{j}",
+            'author': f"user{rng.randrange(users):07d}",
+            'text': ' '.join(rng.choices(WORDS, k=5)),
+            'time': "2024-01-01 00:00",
+        } for j in range(rng.choice((0, 0, 0, 1, 3, 10)))]
+        yield {
+            'id': f"v{i:07d}",
+            'title': ' '.join(rng.choices(WORDS, k=rng.randint(2, 6))),
+            'filename': f"v{i:07d}.mp4",
+            'upload_date': (start + timedelta(days=i * 700 // max(n, 1))).strftime("%Y-%m-%d"),
+            'views': int(rng.paretovariate(1.2) * 10),
+            'duration': f"{minutes}:{seconds:02d}",
+            'thumbnail': thumbnails[i % len(thumbnails)],
+            'author': f"user{rng.randrange(users):07d}",
+            'likes': rng.randrange(100),
+            'favorites': rng.randrange(50),
+            'comments': comments,
+        }
+
+
+def generate(out_dir, rows, seed=1):
+    """在 out_dir 中生成 rows 个视频和 user_count(rows) 个用户，返回 (视频数, 用户数)"""
+    os.makedirs(out_dir, exist_ok=True)
+    users = user_count(rows)
+    # 所有用户共用一个密码哈希，生成 100 万行时不需要计算 10 万次哈希
+    password_hash = generate_password_hash(PASSWORD)
+    _write_list(os.path.join(out_dir, 'users.json'), generate_users(users, random.Random(seed), password_hash))
+    _write_list(os.path.join(out_dir, 'videos.json'), generate_videos(rows, users, random.Random(seed + 1)))
+    return rows, users
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成基准测试数据')
+    parser.add_argument('--rows', default='1k', help='视频数: 1k / 100k / 1m 或具体数字')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', required=True, help='输出目录')
+    args = parser.parse_args()
+    videos, users = generate(args.out, parse_rows(args.rows), args.seed)
+    print(f"生成 {videos} 个视频、{users} 个用户 -> {args.out}")
+
+
+if __name__ == '__main__':
+    main()
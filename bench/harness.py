@@ -0,0 +1,169 @@
+"""基准测试环境: 在临时目录中运行一份 app.py
+
+app.py 的所有数据路径都相对于它自己的文件位置，因此把仓库里的源码复制到临时目录，
+写入生成的 videos.json / users.json 后从那里导入，不会碰到仓库中的数据。
+PATH 前面加上 bench/fakebin，后台任务调用的是假的 ffmpeg/ffprobe。
+仓库中没有 templates/ 时用只输出视频和评论列表的占位模板，渲染耗时会偏低。
+"""
+import glob
+import importlib
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import datagen
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FAKEBIN_DIR = os.path.join(BENCH_DIR, 'fakebin')
+
+TEMPLATE_NAMES = ('index.html', 'video.html', 'search.html', 'profile.html', 'favorites.html',
+                  'upload.html', 'login.html', 'register.html')
+PLACEHOLDER_TEMPLATE = (
+    '{% for v in videos or [] %}<a href="/video/{{ v.id }}">{{ v.title }}</a> {{ v.views }}\n{% endfor %}'
+    '{% if video %}<h1>{{ video.title }}</h1>{% endif %}'
+    '{% for c in comments or [] %}<p>{{ c.author }}: {{ c.text }}</p>\n{% endfor %}'
+)
+
+
+def percentile(sorted_values, p):
+    # 最近秩法
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, elapsed=None, errors=0):
+    """latencies 为秒数列表，返回毫秒为单位的统计"""
+    values = sorted(latencies)
+    result = {'count': len(values), 'errors': errors}
+    if values:
+        result.update({
+            'mean_ms': round(sum(values) / len(values) * 1000, 3),
+            'p50_ms': round(percentile(values, 50) * 1000, 3),
+            'p90_ms': round(percentile(values, 90) * 1000, 3),
+            'p99_ms': round(percentile(values, 99) * 1000, 3),
+            'max_ms': round(values[-1] * 1000, 3),
+        })
+    if elapsed:
+        result['ops_per_s'] = round(len(values) / elapsed, 1)
+    return result
+
+
+def git_revision():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                             cwd=REPO_DIR, stderr=subprocess.DEVNULL).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+class Environment:
+    """prepare() 生成数据并复制源码，load_app() 导入 app 模块，close() 清理临时目录"""
+
+    def __init__(self, workdir=None, keep=False):
+        self.keep = keep or workdir is not None
+        self.workdir = workdir or tempfile.mkdtemp(prefix='ts-bench-')
+        self.app_module = None
+        self.placeholder_templates = False
+        self.rows = 0
+        self.users = 0
+        self.timings = {}
+
+    def prepare(self, rows, seed=1):
+        os.makedirs(self.workdir, exist_ok=True)
+        for path in glob.glob(os.path.join(REPO_DIR, '*.py')):
+            shutil.copy2(path, self.workdir)
+        templates = os.path.join(REPO_DIR, 'templates')
+        target = os.path.join(self.workdir, 'templates')
+        if os.path.isdir(templates):
+            shutil.copytree(templates, target, dirs_exist_ok=True)
+        else:
+            self.placeholder_templates = True
+            os.makedirs(target, exist_ok=True)
+            for name in TEMPLATE_NAMES:
+                with open(os.path.join(target, name), 'w') as f:
+                    f.write(PLACEHOLDER_TEMPLATE)
+
+        started = time.perf_counter()
+        self.rows, self.users = datagen.generate(self.workdir, rows, seed)
+        self.timings['generate_seconds'] = round(time.perf_counter() - started, 3)
+
+    def load_app(self):
+        os.environ['PATH'] = FAKEBIN_DIR + os.pathsep + os.environ.get('PATH', '')
+        sys.path.insert(0, self.workdir)
+        sys.modules.pop('app', None)
+
+        # 导入时打开存储，SQLite 后端会在这里导入 JSON 文件
+        started = time.perf_counter()
+        self.app_module = importlib.import_module('app')
+        self.timings['import_seconds'] = round(time.perf_counter() - started, 3)
+        # 第一次读取时建立内存索引 (搜索、关注关系、热度)
+        started = time.perf_counter()
+        self.app_module.catalog.refresh()
+        self.timings['first_load_seconds'] = round(time.perf_counter() - started, 3)
+        # 新的 Catalog 从第一次加载时写入的快照启动，相当于其他 worker 的冷启动
+        catalog = self.app_module.catalog
+        if catalog.snapshot_file:
+            started = time.perf_counter()
+            type(catalog)(catalog.store, catalog.snapshot_file).refresh()
+            self.timings['snapshot_load_seconds'] = round(time.perf_counter() - started, 3)
+
+        self.app_module.job_queue.start()
+        return self.app_module
+
+    @property
+    def app(self):
+        return self.app_module.app
+
+    def login(self, client, index):
+        """让 test client 以第 index 个生成的用户登录，不经过密码校验"""
+        with client.session_transaction() as sess:
+            sess['user_id'] = f"u{index:07d}"
+            sess['username'] = f"user{index:07d}"
+
+    def session_cookie(self, index):
+        """返回第 index 个用户的 Cookie 请求头，供 HTTP 压测使用"""
+        from flask import request
+        app = self.app
+        with app.test_request_context():
+            sess = app.session_interface.open_session(app, request)
+            sess['user_id'] = f"u{index:07d}"
+            sess['username'] = f"user{index:07d}"
+            response = app.response_class()
+            app.session_interface.save_session(app, sess, response)
+        return response.headers['Set-Cookie'].split(';', 1)[0]
+
+    def meta(self):
+        commit, dirty = git_revision()
+        return {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'git_commit': commit,
+            'git_dirty': dirty,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'rows': self.rows,
+            'users': self.users,
+            'storage_backend': self.app.config.get('STORAGE_BACKEND') if self.app_module else None,
+            'placeholder_templates': self.placeholder_templates,
+        }
+
+    def close(self):
+        if self.app_module is not None:
+            self.app_module.job_queue.stop()
+            self.app_module.view_counter.stop()
+            # 运行目录随后删除，退出时不再写快照
+            self.app_module.catalog.snapshot_file = None
+        if not self.keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
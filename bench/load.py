@@ -0,0 +1,216 @@
+"""并发压测: 在本机端口上启动多线程 WSGI 服务器，用真实的 HTTP 连接压测
+
+- 弹幕: subscribers 个 SSE 连接订阅 danmu_stream，同时发送 danmu 条弹幕，
+  统计发送延迟、从发送到各订阅者收到的延迟，以及没有送达的弹幕数。
+- 点赞/收藏: likers 个用户并发给 targets 个视频各点赞、收藏一次，
+  结束后从存储重新读取计数，与成功的请求数比较得到丢失的更新数。
+"""
+import http.client
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server
+
+from harness import summarize
+
+
+class Server:
+    def __init__(self, app):
+        # 不逐条打印访问日志
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.port = self.server.server_port
+        self.host = app.config.get('SERVER_NAME') or f"127.0.0.1:{self.port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, name='bench-server', daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+
+    def connect(self, timeout=30):
+        return http.client.HTTPConnection('127.0.0.1', self.port, timeout=timeout)
+
+    def request(self, method, path, body=None, headers=None):
+        """返回 (状态码, 响应体, 耗时秒数)，连接失败时状态码为 None"""
+        headers = dict(headers or {}, Host=self.host)
+        started = time.perf_counter()
+        conn = self.connect()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            status, data = None, b''
+        finally:
+            conn.close()
+        return status, data, time.perf_counter() - started
+
+
+def _subscribe(server, vid, received, ready, stop):
+    # 读取 SSE 流，记录每条弹幕 (按内容中的序号) 的到达时间
+    # 服务端每个心跳周期至少发送一行，停止标志在收到下一行时检查
+    conn = server.connect(timeout=10.0)
+    try:
+        conn.request('GET', f"/video/{vid}/danmu_stream", headers={'Host': server.host})
+        response = conn.getresponse()
+        ready.release()
+        while not stop.is_set():
+            line = response.fp.readline()
+            if not line:
+                break
+            if line.startswith(b'data: '):
+                now = time.perf_counter()
+                seq = json.loads(line[6:]).get('text', '').rpartition(' ')[2]
+                if seq.isdigit():
+                    received.append((int(seq), now))
+    except (OSError, http.client.HTTPException):
+        ready.release()
+    finally:
+        conn.close()
+
+
+def run_danmu(env, server, subscribers, count, concurrency, videos=1, timeout=30.0):
+    broadcaster = env.app_module.danmu_broadcaster
+    # 客户端断开后服务端在下一次心跳时才发现，压测时缩短心跳
+    broadcaster.heartbeat = 1.0
+    vids = [f"v{i:07d}" for i in range(min(videos, env.rows))]
+    before = broadcaster.subscriber_count()
+
+    stop = threading.Event()
+    ready = threading.Semaphore(0)
+    inboxes = []
+    threads = []
+    for i in range(subscribers):
+        received = []
+        vid = vids[i % len(vids)]
+        inboxes.append((vid, received))
+        thread = threading.Thread(target=_subscribe, args=(server, vid, received, ready, stop), daemon=True)
+        thread.start()
+        threads.append(thread)
+    for _ in range(subscribers):
+        ready.acquire(timeout=timeout)
+    deadline = time.time() + timeout
+    while broadcaster.subscriber_count() - before < subscribers and time.time() < deadline:
+        time.sleep(0.01)
+    connected = broadcaster.subscriber_count() - before
+
+    sent = {}
+    post_latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def send(seq):
+        nonlocal errors
+        vid = vids[seq % len(vids)]
+        body = json.dumps({'text': f"bench {seq}", 'offset': seq % 600})
+        started = time.perf_counter()
+        status, _, latency = server.request('POST', f"/video/{vid}/danmu", body,
+                                            {'Content-Type': 'application/json'})
+        with lock:
+            if status == 200:
+                sent[seq] = started
+                post_latencies.append(latency)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, range(count)))
+    send_elapsed = time.perf_counter() - started
+
+    # 每个订阅者应收到发往其视频的所有弹幕
+    expected = sum(1 for vid, _ in inboxes for seq in sent if vids[seq % len(vids)] == vid)
+    deadline = time.perf_counter() + timeout
+    while sum(len(r) for _, r in inboxes) < expected and time.perf_counter() < deadline:
+        time.sleep(0.05)
+    delivery_elapsed = time.perf_counter() - started
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=5.0)
+
+    delivery_latencies = [at - sent[seq] for _, received in inboxes for seq, at in received if seq in sent]
+    delivered = len(delivery_latencies)
+    return {
+        'subscribers': subscribers,
+        'connected': connected,
+        'sent': len(sent),
+        'post': summarize(post_latencies, send_elapsed, errors),
+        'delivery': summarize(delivery_latencies, delivery_elapsed),
+        'expected_deliveries': expected,
+        'lost_deliveries': expected - delivered,
+    }
+
+
+def run_likes(env, server, likers, targets, concurrency, seed=1):
+    store = env.app_module.store
+    rng = random.Random(seed)
+    users = rng.sample(range(env.users), min(likers, env.users))
+    vids = [f"v{i:07d}" for i in rng.sample(range(env.rows), min(targets, env.rows))]
+    baseline = {vid: store.get_video(vid) for vid in vids}
+    cookies = {user: env.session_cookie(user) for user in users}
+
+    tasks = [(user, vid, kind) for user in users for vid in vids for kind in ('like', 'favorite')]
+    rng.shuffle(tasks)
+    latencies = []
+    errors = 0
+    # 每个视频计数的净变化；之前的测试可能已经点过赞，这时请求变成取消点赞，计数减一
+    applied = {(vid, kind): 0 for vid in vids for kind in ('like', 'favorite')}
+    added = set()
+    lock = threading.Lock()
+
+    def toggle(task):
+        nonlocal errors
+        user, vid, kind = task
+        status, data, latency = server.request('POST', f"/video/{vid}/{kind}", b'',
+                                               {'Cookie': cookies[user]})
+        with lock:
+            if status != 200:
+                errors += 1
+                return
+            latencies.append(latency)
+            if json.loads(data).get('action') == kind:
+                applied[(vid, kind)] += 1
+                added.add(task)
+            else:
+                applied[(vid, kind)] -= 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(toggle, tasks))
+    elapsed = time.perf_counter() - started
+
+    # 从存储重新读取，不经过进程内缓存
+    lost = {'likes': 0, 'favorites': 0}
+    for vid in vids:
+        current = store.get_video(vid)
+        lost['likes'] += baseline[vid].get('likes', 0) + applied[(vid, 'like')] - current.get('likes', 0)
+        lost['favorites'] += (baseline[vid].get('favorites', 0) + applied[(vid, 'favorite')]
+                              - current.get('favorites', 0))
+    members = {'like': lambda user: f"user{user:07d}", 'favorite': lambda user: f"u{user:07d}"}
+    missing_members = sum(1 for user, vid, kind in added
+                          if not store.has_member(kind, vid, members[kind](user)))
+    return {
+        'likers': len(users),
+        'targets': len(vids),
+        'requests': summarize(latencies, elapsed, errors),
+        'lost_updates': lost,
+        'missing_members': missing_members,
+    }
+
+
+def run(env, subscribers=200, danmu=500, likers=50, targets=5, concurrency=16, seed=1):
+    with Server(env.app) as server:
+        results = {}
+        results['danmu'] = run_danmu(env, server, subscribers, danmu, concurrency)
+        print(f"  danmu: {results['danmu']}", flush=True)
+        results['likes'] = run_likes(env, server, likers, targets, concurrency, seed)
+        print(f"  likes: {results['likes']}", flush=True)
+    return results
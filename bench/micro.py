@@ -0,0 +1,83 @@
+"""单线程微基准: 通过 Flask test client 逐个调用路由，不经过网络"""
+import io
+import random
+import time
+
+import datagen
+from harness import summarize
+
+
+def measure(setup, call, iterations, max_seconds, warmup=5):
+    """执行 iterations 次 (最多 max_seconds 秒)，setup(i) 的耗时不计入，call(i) 返回 False 表示出错"""
+    for i in range(warmup):
+        setup(-1 - i)
+        call(-1 - i)
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + max_seconds
+    elapsed = 0.0
+    for i in range(iterations):
+        setup(i)
+        started = time.perf_counter()
+        ok = call(i)
+        duration = time.perf_counter() - started
+        elapsed += duration
+        latencies.append(duration)
+        if ok is False:
+            errors += 1
+        if started + duration > deadline:
+            break
+    return summarize(latencies, elapsed, errors)
+
+
+def run(env, iterations=200, max_seconds=10.0, seed=1):
+    m = env.app_module
+    client = env.app.test_client()
+    rng = random.Random(seed)
+    rows, users = env.rows, env.users
+
+    def no_setup(i):
+        pass
+
+    def login_random(i):
+        env.login(client, rng.randrange(users))
+
+    def status_ok(response, expected=200):
+        response.close()
+        return response.status_code == expected
+
+    def search(i):
+        words = rng.sample(datagen.WORDS, rng.choice((1, 1, 2)))
+        return status_ok(client.get('/search', query_string={'q': ' '.join(words), 'page': rng.randint(1, 3)}))
+
+    def play(i):
+        return status_ok(client.get(f"/video/v{rng.randrange(rows):07d}"))
+
+    def toggle(kind):
+        def call(i):
+            return status_ok(client.post(f"/video/v{rng.randrange(rows):07d}/{kind}"))
+        return call
+
+    def comment(i):
+        return status_ok(client.post(f"/video/v{rng.randrange(rows):07d}/comment", json={'text': f"bench comment {i}"}))
+
+    payload = b'\0' * 64 * 1024
+
+    def upload(i):
+        data = {'title': f"bench upload {i}", 'video_file': (io.BytesIO(payload), f"bench_{i}.mp4")}
+        return status_ok(client.post('/upload_video', data=data, content_type='multipart/form-data'))
+
+    benchmarks = [
+        ('scan_videos', no_setup, lambda i: bool(m.scan_videos()) or rows == 0),
+        ('search', no_setup, search),
+        ('play_video', no_setup, play),
+        ('like_video', login_random, toggle('like')),
+        ('favorite_video', login_random, toggle('favorite')),
+        ('post_comment', login_random, comment),
+        ('upload_video', login_random, upload),
+    ]
+    results = {}
+    for name, setup, call in benchmarks:
+        results[name] = measure(setup, call, iterations, max_seconds)
+        print(f"  {name}: {results[name]}", flush=True)
+    return results
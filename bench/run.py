@@ -0,0 +1,135 @@
+"""基准测试入口
+
+    python bench/run.py --rows 1k                    # 微基准 + 并发压测，结果写入 bench/results/
+    python bench/run.py --rows 100k --suite micro --output before.json
+    python bench/run.py compare before.json after.json [--threshold 10]
+
+不需要网络和真实的 ffmpeg。相同的参数和 seed 使用相同的数据和请求序列，
+不同版本的结果可以用 compare 比较，超过阈值的退化会列出并以非零状态退出。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import datagen
+import load
+import micro
+from harness import BENCH_DIR, Environment
+
+
+# 指标名后缀 -> 数值变大是否表示退化，None 表示不比较 (最大值波动太大，数据生成与应用无关)
+DIRECTIONS = {'max_ms': None, 'generate_seconds': None,
+              '_ms': True, 'lost_deliveries': True, 'likes': True, 'favorites': True,
+              'missing_members': True, 'errors': True, '_seconds': True, 'ops_per_s': False}
+
+
+def run_benchmarks(args):
+    env = Environment(args.workdir, keep=args.keep)
+    try:
+        rows = datagen.parse_rows(args.rows)
+        print(f"生成数据: {rows} 个视频 -> {env.workdir}", flush=True)
+        env.prepare(rows, args.seed)
+        env.load_app()
+        if args.no_page_cache:
+            env.app.config['PAGE_CACHE_ENABLED'] = False
+        results = {'meta': dict(env.meta(), seed=args.seed, args=vars(args)), 'startup': env.timings}
+        print(f"  startup: {env.timings}", flush=True)
+        suites = args.suite.split(',')
+        if 'micro' in suites:
+            print("微基准:", flush=True)
+            results['micro'] = micro.run(env, args.iterations, args.max_seconds, args.seed)
+        if 'load' in suites:
+            print("并发压测:", flush=True)
+            results['load'] = load.run(env, args.subscribers, args.danmu, args.likers, args.targets,
+                                       args.concurrency, args.seed)
+    finally:
+        env.close()
+
+    output = args.output
+    if not output:
+        commit = (results['meta']['git_commit'] or 'unknown')[:10]
+        output = os.path.join(BENCH_DIR, 'results',
+                              f"{time.strftime('%Y%m%d-%H%M%S')}-{commit}-{args.rows}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存: {output}")
+
+
+def _flatten(data, prefix=''):
+    for key, value in data.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from _flatten(value, path)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield path, value
+
+
+def _higher_is_worse(path):
+    for suffix, worse in DIRECTIONS.items():
+        if path.endswith(suffix):
+            return worse
+    return None
+
+
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    for name in ('rows', 'seed', 'placeholder_templates'):
+        if old['meta'].get(name) != new['meta'].get(name):
+            print(f"注意: 两次测试的 {name} 不同 ({old['meta'].get(name)} / {new['meta'].get(name)})")
+
+    old_values = dict(_flatten({k: v for k, v in old.items() if k != 'meta'}))
+    regressions = []
+    for path, value in _flatten({k: v for k, v in new.items() if k != 'meta'}):
+        worse = _higher_is_worse(path)
+        if worse is None or path not in old_values:
+            continue
+        before = old_values[path]
+        if before:
+            change = (value - before) / abs(before) * 100
+        else:
+            change = 0.0 if value == before else float('inf')
+        regressed = (change > args.threshold) if worse else (change < -args.threshold)
+        mark = '  <-- 退化' if regressed else ''
+        print(f"{path:55} {before:>12} -> {value:>12} ({change:+.1f}%){mark}")
+        if regressed:
+            regressions.append(path)
+    if regressions:
+        print(f"\n{len(regressions)} 项指标退化超过 {args.threshold}%")
+        return 1
+    return 0
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        parser = argparse.ArgumentParser(prog='run.py compare', description='比较两次基准测试结果')
+        parser.add_argument('old')
+        parser.add_argument('new')
+        parser.add_argument('--threshold', type=float, default=10.0, help='视为退化的变化百分比')
+        sys.exit(compare(parser.parse_args(sys.argv[2:])))
+
+    parser = argparse.ArgumentParser(description='离线基准测试')
+    parser.add_argument('--rows', default='1k', help='视频数: 1k / 100k / 1m 或具体数字')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--suite', default='micro,load', help='micro、load，逗号分隔')
+    parser.add_argument('--iterations', type=int, default=200, help='每个微基准的调用次数')
+    parser.add_argument('--max-seconds', type=float, default=10.0, help='每个微基准最多运行的秒数')
+    parser.add_argument('--no-page-cache', action='store_true', help='关闭页面缓存')
+    parser.add_argument('--subscribers', type=int, default=200, help='弹幕 SSE 连接数')
+    parser.add_argument('--danmu', type=int, default=500, help='发送的弹幕条数')
+    parser.add_argument('--likers', type=int, default=50, help='并发点赞/收藏的用户数')
+    parser.add_argument('--targets', type=int, default=5, help='被点赞/收藏的视频数')
+    parser.add_argument('--concurrency', type=int, default=16, help='并发请求的线程数')
+    parser.add_argument('--workdir', help='运行目录 (默认临时目录，结束后删除)')
+    parser.add_argument('--keep', action='store_true', help='保留运行目录')
+    parser.add_argument('--output', help='结果文件 (默认 bench/results/<时间>-<提交>-<rows>.json)')
+    run_benchmarks(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,529 @@
+import copy
+import logging
+import sys
+import threading
+from contextlib import contextmanager
+
+from storage import (VIDEO_MANAGED_FIELDS, VIDEO_MEMBER_FIELDS, VIDEO_COMMENT_FIELD, USER_MANAGED_FIELDS,
+                     MEMBER_COUNTERS)
+from records import VideoRecord, load_snapshot, save_snapshot
+
+
+logger = logging.getLogger(__name__)
+
+
+def _toggled(items, item, added):
+    if added:
+        return items if item in items else items + [item]
+    return [i for i in items if i != item]
+
+
+def _rindex(items, item, key=None):
+    # 从末尾向前查找，翻页时游标通常离末尾不远
+    for i in range(len(items) - 1, -1, -1):
+        if (items[i] if key is None else key(items[i])) == item:
+            return i
+    return None
+
+
+def _bisect_position(ids, position, positions):
+    # ids 按全局上传顺序排列，返回第一个位置不小于 position 的下标
+    lo, hi = 0, len(ids)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if positions[ids[mid]] < position:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _page_before(items, end, limit):
+    """items 从旧到新排列，返回 end 之前的 limit 个 (从新到旧) 以及是否还有更旧的"""
+    start = max(0, end - limit)
+    return items[start:end][::-1], start > 0
+
+
+class Catalog:
+    """视频/用户目录的进程内缓存
+
+    按视频 id、作者、用户 id、用户名建立字典索引。存储文件的 (mtime, size) 发生变化
+    （其他进程写入）时，按存储的变更记录只重新读取变化过的视频和用户；通过本对象写入时直接更新索引。
+    其他进程只修改了播放次数的视频直接替换记录，不通知监听器也不增加 version。
+    变更记录不可用 (JSON 存储、落后太多或有删除) 时在后台线程整体重新加载，加载完成前继续使用旧数据。
+    视频保存为只读的 VideoRecord，需要修改时使用 for_update=True 取得普通字典副本。
+    用户记录是缓存中的字典，同样只能读取。
+
+    每次重新加载或写入都会增加 version，并通知 add_listener 注册的回调：
+    callback('reload', 全部视频列表) / callback('add', 视频) / callback('update', 视频) /
+    callback('follow', (关注者用户名, 被关注的用户名, 是否为关注))。
+
+    用户记录中的 favorites / following 列表由存储中的关系生成，只能通过 toggle 修改。
+    多个写入可以放在 with catalog.transaction(): 中，合并为存储的一次提交。
+
+    指定 snapshot_file 时，进程第一次加载先读取二进制快照，快照的变更代数与存储一致时
+    不再逐行解析存储；快照过期时从存储加载后重新写入快照。
+    """
+
+    def __init__(self, store, snapshot_file=None):
+        self.store = store
+        self.snapshot_file = snapshot_file
+        self._loaded = False
+        self._snapshot_generation = None
+        self._lock = threading.RLock()
+        self._signature = None
+        self._generation = None
+        self._reloading = False
+        self._videos = {}
+        self._order = []
+        self._position = {}
+        self._by_author = {}
+        self._users = {}
+        self._users_by_name = {}
+        self._favorites = {}
+        self._listeners = []
+        self._tx_depth = 0
+        self.version = 0
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def _notify(self, action, payload):
+        self.version += 1
+        for callback in self._listeners:
+            callback(action, payload)
+
+    # 加载与失效
+    def refresh(self):
+        signature = self.store.signature()
+        if signature != self._signature:
+            with self._lock:
+                if not self._loaded:
+                    self._reload()
+                elif self.store.signature() != self._signature:
+                    self._catch_up()
+
+    def _reload(self):
+        # 第一次加载在调用线程中进行，之后的整体重新加载由 _reload_in_background 发起
+        signature = self.store.signature()
+        generation = self.store.generation()
+        loaded = None
+        if self.snapshot_file:
+            loaded = load_snapshot(self.snapshot_file, generation)
+        if loaded is not None:
+            videos, users = loaded
+            self._snapshot_generation = generation
+        else:
+            videos, users = self._load_store()
+        self._install(videos, users, signature, generation)
+        if loaded is None and self.snapshot_file:
+            self._save_snapshot(generation, videos, users)
+
+    def _install(self, videos, users, signature, generation):
+        # 调用方持有锁
+        self._videos = {v['id']: v for v in videos}
+        self._order = [v['id'] for v in videos]
+        self._position = {vid: i for i, vid in enumerate(self._order)}
+        self._by_author = {}
+        for v in videos:
+            self._by_author.setdefault(v.get('author'), []).append(v['id'])
+        self._users = {}
+        self._users_by_name = {}
+        self._favorites = {}
+        for u in users:
+            self._index_user(u)
+        self._signature = signature
+        self._generation = generation
+        self._loaded = True
+        self._notify('reload', videos)
+
+    def _reload_in_background(self):
+        # 调用方持有锁；同时只有一个后台加载
+        if self._reloading:
+            return
+        self._reloading = True
+        threading.Thread(target=self._background_reload, name='catalog-reload', daemon=True).start()
+
+    def _background_reload(self):
+        try:
+            # 先读签名和代数再加载，加载期间的写入在之后的 refresh 中按变更记录补上
+            signature = self.store.signature()
+            generation = self.store.generation()
+            videos, users = self._load_store()
+            with self._lock:
+                self._install(videos, users, signature, generation)
+        except Exception:
+            logger.exception("目录重新加载失败")
+        finally:
+            self._reloading = False
+
+    def _catch_up(self):
+        # 调用方持有锁。先读签名，之后的变化会使下次 refresh 再次检查
+        signature = self.store.signature()
+        changes = None if self._reloading else self.store.changes(self._generation)
+        if changes is None or not self._apply_changes(changes[1]):
+            self._reload_in_background()
+            return
+        self._generation = changes[0]
+        self._signature = signature
+
+    def _apply_changes(self, changes):
+        """把其他进程的修改应用到索引，遇到删除时返回 False，由调用方整体重新加载"""
+        video_ids = []
+        user_ids = set()
+        followers = set()
+        for kind, key in changes:
+            if kind == 'video':
+                video_ids.append(key)
+            elif kind in ('user', 'favorite'):
+                user_ids.add(key)
+            elif kind == 'follow':
+                followers.add(key)
+            else:
+                return False
+
+        if not (video_ids or user_ids or followers):
+            return True
+        for video in map(self._record, self.store.get_videos(video_ids)):
+            vid = video['id']
+            old = self._videos.get(vid)
+            if old is None:
+                self._append_video(video)
+                self._notify('add', video)
+                continue
+            if old.get('author') != video.get('author'):
+                self._move_author(vid, old.get('author'), video.get('author'))
+            self._videos[vid] = video
+            # 播放次数每次写回都会变化，只改了播放次数的记录不通知
+            if old.replace(views=0) != video.replace(views=0):
+                self._notify('update', video)
+
+        for username in followers:
+            user = self._users_by_name.get(username)
+            if user is not None:
+                user_ids.add(user['id'])
+        for user in self.store.get_users(user_ids):
+            user['favorites'] = self.store.member_targets('favorite', user['id'])
+            following = [sys.intern(t) for t in self.store.member_targets('follow', user['username'])]
+            user['following'] = following
+            old = self._users.get(user['id'])
+            before = set(old.get('following', ())) if old is not None else set()
+            self._index_user(user)
+            for target in following:
+                if target not in before:
+                    self._notify('follow', (user['username'], target, True))
+            for target in before.difference(following):
+                self._notify('follow', (user['username'], target, False))
+            self.version += 1
+        return True
+
+    def _load_store(self):
+        videos = [self._record(v) for v in self.store.list_videos()]
+        # 收藏列表中的视频 id 使用视频记录中的同一个字符串对象
+        ids = {v['id']: v['id'] for v in videos}
+        favorites = {}
+        for vid, user_id in self.store.list_members('favorite'):
+            favorites.setdefault(user_id, []).append(ids.get(vid, vid))
+        following = {}
+        for target, follower in self.store.list_members('follow'):
+            following.setdefault(follower, []).append(sys.intern(target))
+        users = self.store.list_users()
+        for u in users:
+            u['favorites'] = favorites.get(u['id'], [])
+            u['following'] = following.get(u['username'], [])
+        return videos, users
+
+    def _record(self, video):
+        # 点赞/收藏的用户列表和评论内容不放进缓存，JSON 存储的记录里也一样，只保留计数
+        return VideoRecord((k, v) for k, v in video.items()
+                           if k not in VIDEO_MEMBER_FIELDS and k != VIDEO_COMMENT_FIELD)
+
+    def _save_snapshot(self, generation, videos, users):
+        try:
+            save_snapshot(self.snapshot_file, generation, videos, users)
+        except (OSError, ValueError, TypeError, OverflowError):
+            # 快照只是加速启动，写入失败时下次仍从存储加载
+            logger.exception("目录快照写入失败")
+            return False
+        self._snapshot_generation = generation
+        return True
+
+    def save_snapshot(self):
+        """把当前目录写入快照文件，快照已是最新时跳过；没有配置快照文件或尚未加载时返回 False"""
+        if not self.snapshot_file or not self._loaded:
+            return False
+        self.refresh()
+        with self._lock:
+            # 索引的内容不比 _generation 旧，加载快照后从这一代数开始补上之后的变化
+            generation = self._generation
+            if generation is None or self._reloading:
+                return False
+            if generation == self._snapshot_generation:
+                return True
+            users = list(self._users.values())
+            return self._save_snapshot(generation, [self._videos[vid] for vid in self._order], users)
+
+    def _index_user(self, user):
+        user['username'] = sys.intern(user['username'])
+        old = self._users.get(user['id'])
+        if old is not None and old['username'] != user['username']:
+            self._users_by_name.pop(old['username'], None)
+        self._users[user['id']] = user
+        self._users_by_name[user['username']] = user
+        self._favorites[user['id']] = set(user.get('favorites', []))
+
+    def invalidate(self):
+        # 下次访问时整体重新加载
+        with self._lock:
+            self._signature = None
+            self._generation = None
+
+    def _write(self, fn, *args):
+        # 写入前索引已是最新时，把代数推进到本次写入之后；否则留给下次 refresh 按变更记录补上
+        with self._lock:
+            if self._tx_depth:
+                return fn(*args)
+            with self.store.transaction():
+                fresh = self.store.generation() == self._generation
+                result = fn(*args)
+                generation = self.store.generation()
+            if fresh:
+                self._generation = generation
+            return result
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            outer = self._tx_depth == 0
+            self._tx_depth += 1
+            try:
+                with self.store.transaction():
+                    fresh = outer and self.store.generation() == self._generation
+                    yield
+                    generation = self.store.generation()
+            except:
+                # 存储已回滚，本地索引可能已经更新，下次访问时重新加载
+                self._signature = None
+                self._generation = None
+                raise
+            finally:
+                self._tx_depth -= 1
+            if fresh:
+                self._generation = generation
+
+    # 视频
+    def list_videos(self):
+        self.refresh()
+        with self._lock:
+            videos = self._videos
+            return [videos[vid] for vid in self._order]
+
+    def get_video(self, vid, for_update=False):
+        self.refresh()
+        video = self._videos.get(vid)
+        if video is not None and for_update:
+            return copy.deepcopy(video.to_dict())
+        return video
+
+    def peek_video(self, vid):
+        # 不检查存储是否变化，用于一次请求内的大量查找
+        return self._videos.get(vid)
+
+    def videos_by_author(self, author):
+        self.refresh()
+        with self._lock:
+            videos = self._videos
+            return [videos[vid] for vid in self._by_author.get(author, [])]
+
+    def position(self, vid):
+        # 视频在上传顺序中的位置，越大越新
+        return self._position.get(vid)
+
+    def recent_ids_by_author(self, author, limit):
+        self.refresh()
+        with self._lock:
+            return self._by_author.get(author, [])[-limit:]
+
+    def page_videos(self, cursor=None, limit=24, author=None):
+        """按上传时间从新到旧分页，返回 (视频列表, 下一页的 cursor)
+
+        cursor 为上一页最后一个视频的 id，每页的开销只与 limit 有关。
+        """
+        self.refresh()
+        with self._lock:
+            ids = self._order if author is None else self._by_author.get(author, [])
+            end = len(ids)
+            if cursor is not None:
+                position = self._position.get(cursor)
+                if position is None:
+                    return [], None
+                end = position if author is None else _bisect_position(ids, position, self._position)
+            page, more = _page_before(ids, end, limit)
+            videos = [self._videos[vid] for vid in page]
+        return videos, (page[-1] if more and page else None)
+
+    def page_comments(self, vid, cursor=None, limit=20):
+        """评论从新到旧分页，cursor 为上一页最后一条评论的 id；评论不缓存，直接读取存储"""
+        return self.store.page_comments(vid, cursor, limit)
+
+    def first_comments(self, vids, limit=20):
+        """多个视频的第一页评论，返回 {视频 id: (评论列表, 下一页的 cursor)}"""
+        return self.store.first_comments(vids, limit)
+
+    def count_videos(self, author=None):
+        self.refresh()
+        if author is not None:
+            return len(self._by_author.get(author, ()))
+        return len(self._order)
+
+    def add_video(self, video):
+        """id 已存在时返回 False"""
+        with self._lock:
+            if not self._write(self.store.add_video, video):
+                return False
+            video = self._record(video)
+            self._append_video(video)
+            self._notify('add', video)
+            return True
+
+    def add_videos(self, videos):
+        with self._lock:
+            self._write(self.store.add_videos, videos)
+            for video in map(self._record, videos):
+                self._append_video(video)
+                self._notify('add', video)
+
+    def _append_video(self, video):
+        self._videos[video['id']] = video
+        self._position[video['id']] = len(self._order)
+        self._order.append(video['id'])
+        self._by_author.setdefault(video.get('author'), []).append(video['id'])
+
+    def _move_author(self, vid, old_author, author):
+        self._by_author.get(old_author, []).remove(vid)
+        # 作者列表按上传顺序排列，分页时依赖这一点
+        ids = self._by_author.setdefault(author, [])
+        ids.insert(_bisect_position(ids, self._position[vid], self._position), vid)
+
+    def update_video(self, video):
+        with self._lock:
+            self._write(self.store.update_video, video)
+            old = self._videos.get(video['id'])
+            if old is not None and old.get('author') != video.get('author'):
+                self._move_author(video['id'], old.get('author'), video.get('author'))
+            # 播放次数、点赞、收藏和评论由各自的方法维护
+            if old is not None:
+                video = dict(video, **{k: old[k] for k in VIDEO_MANAGED_FIELDS if k in old})
+            video = self._record(video)
+            self._videos[video['id']] = video
+            self._notify('update', video)
+
+    def add_comment(self, vid, comment):
+        """返回新的评论数，视频不存在时返回 None"""
+        with self._lock:
+            count = self._write(self.store.add_comment, vid, comment)
+            if count is None:
+                return None
+            video = self._videos.get(vid)
+            if video is not None:
+                video = video.replace(comment_count=count)
+                self._videos[vid] = video
+                self._notify('update', video)
+            return count
+
+    def increment_views_many(self, deltas):
+        with self._lock:
+            self._write(self.store.increment_views_many, deltas)
+            for vid, n in deltas.items():
+                video = self._videos.get(vid)
+                if video is not None:
+                    self._videos[vid] = video.replace(views=video.get('views', 0) + n)
+
+    # 用户
+    def get_user(self, user_id, for_update=False):
+        self.refresh()
+        user = self._users.get(user_id)
+        if user is not None and for_update:
+            return copy.deepcopy(user)
+        return user
+
+    def get_user_by_name(self, username, for_update=False):
+        self.refresh()
+        user = self._users_by_name.get(username)
+        if user is not None and for_update:
+            return copy.deepcopy(user)
+        return user
+
+    def page_favorites(self, user_id, cursor=None, limit=24):
+        """收藏从最近收藏的开始分页，cursor 为上一页最后一个视频的 id"""
+        user = self.get_user(user_id)
+        favorites = user.get('favorites', []) if user else []
+        end = len(favorites)
+        if cursor is not None:
+            end = _rindex(favorites, cursor)
+            if end is None:
+                return [], None
+        page, more = _page_before(favorites, end, limit)
+        videos = [v for v in map(self._videos.get, page) if v is not None]
+        return videos, (page[-1] if more and page else None)
+
+    def is_favorite(self, user_id, vid):
+        self.refresh()
+        return vid in self._favorites.get(user_id, ())
+
+    def add_user(self, user):
+        """用户名已存在时返回 False"""
+        with self._lock:
+            if not self._write(self.store.add_user, user):
+                return False
+            self._index_user(user)
+            self.version += 1
+            return True
+
+    def update_user(self, user):
+        with self._lock:
+            self._write(self.store.update_user, user)
+            old = self._users.get(user['id'])
+            if old is not None:
+                user = dict(user, **{k: old[k] for k in USER_MANAGED_FIELDS if k in old})
+            self._index_user(user)
+            self.version += 1
+
+    # 点赞/收藏/关注
+    def toggle(self, kind, target, member):
+        """切换关系，返回 (是否为新增, 新的计数)；目标不存在时返回 (None, 0)
+
+        like: (视频 id, 用户名)，favorite: (视频 id, 用户 id)，follow: (被关注的用户名, 关注者用户名)
+        """
+        with self._lock:
+            added, count = self._write(self.store.toggle_member, kind, target, member)
+            if added is None:
+                return added, count
+            field = MEMBER_COUNTERS[kind]
+            if kind == 'follow':
+                followed = self._users_by_name.get(target)
+                if followed is not None:
+                    self._index_user(dict(followed, **{field: count}))
+                user = self._users_by_name.get(member)
+                if user is not None:
+                    self._index_user(dict(user, following=_toggled(user.get('following', []), target, added)))
+                self._notify('follow', (member, target, added))
+                return added, count
+            if kind == 'favorite':
+                user = self._users.get(member)
+                if user is not None:
+                    self._index_user(dict(user, favorites=_toggled(user.get('favorites', []), target, added)))
+            video = self._videos.get(target)
+            if video is not None:
+                video = video.replace(**{field: count})
+                self._videos[target] = video
+                self._notify('update', video)
+            return added, count
+
+    def follow_pairs(self):
+        """[(被关注的用户名, 关注者用户名)]，由用户记录中的 following 列表生成"""
+        with self._lock:
+            return [(target, u['username']) for u in self._users.values() for target in u.get('following', ())]
+
+    def has_liked(self, vid, username):
+        return self.store.has_member('like', vid, username)
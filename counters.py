@@ -0,0 +1,99 @@
+import logging
+import os
+import threading
+from collections import defaultdict
+
+
+logger = logging.getLogger(__name__)
+
+
+class ViewCounter:
+    """播放次数的写回缓冲
+
+    播放请求只在内存里累加增量，后台线程按时间间隔或累积数量把增量批量写入存储，
+    进程退出时调用 stop() 把剩余增量写完。
+    """
+
+    def __init__(self, flush_fn, interval=5.0, threshold=500):
+        self.flush_fn = flush_fn
+        self.interval = interval
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._pending = defaultdict(int)
+        self._total = 0
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._pid = None
+
+    def add(self, vid, n=1):
+        with self._lock:
+            self._pending[vid] += n
+            self._total += n
+            full = self._total >= self.threshold
+        self._ensure_thread()
+        if full:
+            self._wakeup.set()
+
+    def pending(self, vid):
+        with self._lock:
+            return self._pending.get(vid, 0)
+
+    def pending_total(self):
+        with self._lock:
+            return self._total
+
+    def apply(self, videos):
+        """返回加上尚未落盘增量的视频列表，不修改传入的记录"""
+        with self._lock:
+            if not self._pending:
+                return videos
+            pending = dict(self._pending)
+        return [
+            dict(v, views=v.get('views', 0) + pending[v['id']]) if v['id'] in pending else v
+            for v in videos
+        ]
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch = self._pending
+            self._pending = defaultdict(int)
+            self._total = 0
+        try:
+            self.flush_fn(dict(batch))
+        except Exception:
+            # 写入失败时把增量放回去，下次再试
+            logger.exception("播放次数写入失败")
+            with self._lock:
+                for vid, n in batch.items():
+                    self._pending[vid] += n
+                    self._total += n
+            return 0
+        return sum(batch.values())
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout=self.interval + 5)
+        self.flush()
+
+    def _ensure_thread(self):
+        # fork 出来的 worker 没有父进程的线程，按 pid 判断是否需要重新启动
+        if self._pid == os.getpid() or self._stopped:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='view-counter', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
@@ -0,0 +1,370 @@
+import asyncio
+import fcntl
+import json
+import math
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+def format_event(event_id, danmu):
+    return f"id: {event_id}\ndata: {json.dumps(danmu)}\n\n"
+
+
+KEEPALIVE = ": keepalive\n\n"
+
+
+class Subscription:
+    """线程方式的订阅者，每个 SSE 连接一个队列"""
+
+    def __init__(self, broadcaster, vid, maxsize):
+        self.broadcaster = broadcaster
+        self.vid = vid
+        self.queue = queue.Queue(maxsize)
+        self.closed = False
+
+    def deliver(self, event):
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except queue.Full:
+            return False
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def close(self):
+        self.closed = True
+        self.broadcaster.unsubscribe(self)
+
+
+class AsyncSubscription(Subscription):
+    """asyncio 方式的订阅者，发布方可能在其他线程，通过 call_soon_threadsafe 投递"""
+
+    def __init__(self, broadcaster, vid, maxsize, loop):
+        self.broadcaster = broadcaster
+        self.vid = vid
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+        self.closed = False
+        self._size = 0
+        self._maxsize = maxsize
+        self._size_lock = threading.Lock()
+
+    def deliver(self, event):
+        with self._size_lock:
+            if self._size >= self._maxsize:
+                return False
+            self._size += 1
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+        return True
+
+    async def get(self, timeout):
+        try:
+            event = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        with self._size_lock:
+            self._size -= 1
+        return event
+
+    def depth(self):
+        return self._size
+
+
+class DanmuBroadcaster:
+    """按视频分组的弹幕发布/订阅
+
+    send_danmu 发布时直接唤醒该视频的所有订阅者，不再轮询。每个视频保留最近
+    history 条弹幕的环形缓冲，用于新连接回放以及按 Last-Event-ID 断线续传；
+    最多为 max_videos 个视频保留缓冲，超出时淘汰最久未使用且无人订阅的视频。
+    订阅者队列满（客户端太慢）时断开该订阅者，客户端重连后从 Last-Event-ID 续传。
+    事件编号取毫秒时间戳并保证单调递增，服务重启后续传依然有效。
+    """
+
+    def __init__(self, history=500, queue_size=256, heartbeat=15.0, max_videos=1000):
+        self.history = history
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self.max_videos = max_videos
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._history = OrderedDict()
+        self._last_id = {}
+
+    def _evict(self):
+        for vid in list(self._history):
+            if len(self._history) <= self.max_videos:
+                break
+            if vid not in self._subscribers:
+                del self._history[vid]
+                self._last_id.pop(vid, None)
+
+    def publish(self, vid, danmu):
+        with self._lock:
+            event_id = max(int(time.time() * 1000), self._last_id.get(vid, 0) + 1)
+            self._last_id[vid] = event_id
+            event = (event_id, dict(danmu, id=event_id))
+            if vid not in self._history:
+                self._history[vid] = deque(maxlen=self.history)
+                self._evict()
+            self._history.move_to_end(vid)
+            self._history[vid].append(event)
+            subscribers = list(self._subscribers.get(vid, ()))
+        for sub in subscribers:
+            if not sub.deliver(event):
+                sub.closed = True
+                self.unsubscribe(sub)
+        return event_id
+
+    def backlog(self, vid, last_event_id=None):
+        with self._lock:
+            events = list(self._history.get(vid, ()))
+        if last_event_id is None:
+            return events
+        return [e for e in events if e[0] > last_event_id]
+
+    def subscribe(self, vid, loop=None):
+        if loop is None:
+            sub = Subscription(self, vid, self.queue_size)
+        else:
+            sub = AsyncSubscription(self, vid, self.queue_size, loop)
+        with self._lock:
+            self._subscribers.setdefault(vid, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subscribers.get(sub.vid)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.vid]
+
+    def subscriber_count(self, vid=None):
+        with self._lock:
+            if vid is not None:
+                return len(self._subscribers.get(vid, ()))
+            return sum(len(s) for s in self._subscribers.values())
+
+    def queue_depths(self):
+        """各订阅者队列中等待发送的弹幕数"""
+        with self._lock:
+            subscribers = [sub for subs in self._subscribers.values() for sub in subs]
+        return [sub.depth() for sub in subscribers]
+
+    def stream(self, vid, last_event_id=None):
+        """WSGI 用的 SSE 生成器
+
+        客户端断开后，服务器写入失败会关闭生成器，finally 中释放订阅；
+        心跳保证空闲连接最多 heartbeat 秒内被发现断开。
+        """
+        # 先订阅再取历史，避免两者之间发布的弹幕丢失
+        sub = self.subscribe(vid)
+        try:
+            yield "retry: 3000\n\n"
+            sent = last_event_id or 0
+            for event_id, danmu in self.backlog(vid, last_event_id):
+                yield format_event(event_id, danmu)
+                sent = event_id
+            while not sub.closed or not sub.queue.empty():
+                event = sub.get(self.heartbeat)
+                if event is None:
+                    yield KEEPALIVE
+                elif event[0] > sent:
+                    yield format_event(*event)
+                    sent = event[0]
+        finally:
+            sub.close()
+
+    async def astream(self, vid, last_event_id=None):
+        """asyncio 版本的 SSE 生成器，供 ASGI 服务使用，不占用线程"""
+        sub = self.subscribe(vid, loop=asyncio.get_running_loop())
+        try:
+            yield "retry: 3000\n\n"
+            sent = last_event_id or 0
+            for event_id, danmu in self.backlog(vid, last_event_id):
+                yield format_event(event_id, danmu)
+                sent = event_id
+            while not sub.closed or not sub.queue.empty():
+                event = await sub.get(self.heartbeat)
+                if event is None:
+                    yield KEEPALIVE
+                elif event[0] > sent:
+                    yield format_event(*event)
+                    sent = event[0]
+        finally:
+            sub.close()
+
+
+def parse_last_event_id(value):
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+_UNSAFE_RE = re.compile(r'[^\w.-]')
+
+
+class DanmuStore:
+    """按播放位置分段的弹幕持久化存储
+
+    每个视频一个目录，弹幕按播放位置 offset 落到 bucket_seconds 秒一段的
+    段文件中 (danmu/<vid>/<段号>.jsonl)，只追加写入，多进程通过文件锁共享。
+    查询某个时间范围只需读取覆盖该范围的几个段；解析后的段放在有界的 LRU 缓存中，
+    按文件 (mtime, size) 失效。段文件超过 max_segment_bytes 时压缩：
+    按 offset 排序并只保留最新的 max_per_segment 条。
+    """
+
+    def __init__(self, folder, bucket_seconds=60, max_per_segment=3000,
+                 max_segment_bytes=1024 * 1024, cache_segments=256):
+        self.folder = folder
+        self.bucket_seconds = bucket_seconds
+        self.max_per_segment = max_per_segment
+        self.max_segment_bytes = max_segment_bytes
+        self.cache_segments = cache_segments
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        os.makedirs(folder, exist_ok=True)
+
+    def _video_dir(self, vid):
+        return os.path.join(self.folder, _UNSAFE_RE.sub('_', vid).lstrip('.') or '_')
+
+    def _segment_path(self, vid, segment):
+        return os.path.join(self._video_dir(vid), f"{segment}.jsonl")
+
+    def segment_of(self, offset):
+        if not math.isfinite(offset):
+            raise ValueError(f"播放位置无效: {offset}")
+        return int(max(0.0, offset) // self.bucket_seconds)
+
+    def _open_locked(self, path):
+        # 压缩会用新文件替换段文件，加锁后确认打开的仍是当前文件
+        while True:
+            f = open(path, 'a+')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            f.close()
+
+    def append(self, vid, danmu):
+        segment = self.segment_of(danmu.get('offset', 0))
+        path = self._segment_path(vid, segment)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        line = json.dumps(danmu, ensure_ascii=False) + '\n'
+        f = self._open_locked(path)
+        try:
+            f.write(line)
+            f.flush()
+            size = os.fstat(f.fileno()).st_size
+            if size > self.max_segment_bytes:
+                self._compact_locked(f, path)
+        finally:
+            f.close()
+
+    def _read_segment(self, vid, segment):
+        path = self._segment_path(vid, segment)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return []
+        key = (vid, segment)
+        signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] == signature:
+                self._cache.move_to_end(key)
+                return cached[1]
+        entries = []
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # 写入中断留下的半行
+                    continue
+        entries.sort(key=lambda d: d.get('offset', 0))
+        with self._lock:
+            self._cache[key] = (signature, entries)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_segments:
+                self._cache.popitem(last=False)
+        return entries
+
+    def segments(self, vid):
+        """已有段文件的段号，从小到大"""
+        try:
+            names = os.listdir(self._video_dir(vid))
+        except OSError:
+            return []
+        return sorted(int(name[:-6]) for name in names
+                      if name.endswith('.jsonl') and name[:-6].isdigit())
+
+    def range(self, vid, start, end, limit=None):
+        """返回播放位置在 [start, end) 内的弹幕，按 offset 排序
+
+        只读取范围内已存在的段文件，start / end 必须是有限的数值。
+        """
+        if not (math.isfinite(start) and math.isfinite(end)):
+            raise ValueError("时间范围必须是有限的数值")
+        first, last = self.segment_of(start), self.segment_of(end)
+        result = []
+        for segment in self.segments(vid):
+            if segment < first:
+                continue
+            if segment > last:
+                break
+            for d in self._read_segment(vid, segment):
+                if start <= d.get('offset', 0) < end:
+                    result.append(d)
+                    if limit is not None and len(result) >= limit:
+                        return result
+        return result
+
+    def _compact_locked(self, f, path):
+        f.seek(0)
+        entries = []
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+        # 保留最新的 max_per_segment 条，再按播放位置排序
+        entries.sort(key=lambda d: d.get('id', 0))
+        entries = entries[-self.max_per_segment:]
+        entries.sort(key=lambda d: d.get('offset', 0))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as out:
+            for d in entries:
+                out.write(json.dumps(d, ensure_ascii=False) + '\n')
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, path)
+
+    def compact(self, vid):
+        """压缩一个视频的全部段文件"""
+        video_dir = self._video_dir(vid)
+        if not os.path.isdir(video_dir):
+            return
+        for name in os.listdir(video_dir):
+            if not name.endswith('.jsonl'):
+                continue
+            path = os.path.join(video_dir, name)
+            f = self._open_locked(path)
+            try:
+                self._compact_locked(f, path)
+            finally:
+                f.close()
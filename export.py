@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+def fingerprint(data):
+    return hashlib.blake2b(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str).encode(),
+                           digest_size=16).hexdigest()
+
+
+class StaticExporter:
+    """把页面导出为静态 HTML，供前端代理直接返回
+
+    每个页面由 (相对路径, 源数据, render()) 描述，manifest 记录上次导出时源数据的指纹，
+    指纹没有变化的页面跳过；需要重新生成的页面由线程池并行渲染，写入临时文件后改名。
+    上次导出过、这次不再存在的页面会被删除。
+    """
+
+    def __init__(self, output_dir, manifest_file=None, workers=None):
+        self.output_dir = output_dir
+        self.manifest_file = manifest_file or os.path.join(output_dir, '.manifest.json')
+        self.workers = workers or os.cpu_count() or 1
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_file, 'r') as f:
+                return json.load(f)
+        except:
+            return {}
+
+    def save_manifest(self, manifest):
+        tmp_path = self.manifest_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_file)
+
+    def _write(self, path, render):
+        target = os.path.join(self.output_dir, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        body = render()
+        tmp_path = target + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, target)
+
+    def run(self, pages, force=False, progress=None):
+        """pages 为 [(相对路径, 源数据, render)]，render() 返回页面的 bytes
+
+        返回 {"written": 重新生成的页面数, "skipped": 未变化的页面数, "removed": 删除的页面数}
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        old = {} if force else self.load_manifest()
+        manifest = {}
+        todo = []
+        for path, data, render in pages:
+            manifest[path] = fingerprint(data)
+            if old.get(path) != manifest[path] or not os.path.exists(os.path.join(self.output_dir, path)):
+                todo.append((path, render))
+
+        done = 0
+        if todo:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(todo))) as pool:
+                futures = [pool.submit(self._write, path, render) for path, render in todo]
+                for future in futures:
+                    future.result()
+                    done += 1
+                    if progress:
+                        progress(done, len(todo))
+
+        removed = 0
+        for path in set(old) - set(manifest):
+            try:
+                os.remove(os.path.join(self.output_dir, path))
+                removed += 1
+            except OSError:
+                pass
+
+        self.save_manifest(manifest)
+        return {"written": len(todo), "skipped": len(manifest) - len(todo), "removed": removed}
@@ -0,0 +1,309 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+PROCESSING = 'processing'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueue:
+    """持久化的后台任务队列
+
+    任务保存在 SQLite 中，进程重启后未完成的任务会继续执行；多个进程可以共享同一个队列，
+    领取任务时用 BEGIN IMMEDIATE 保证同一任务只被一个 worker 领取。
+    任务失败后按指数退避重试，超过 max_attempts 次标记为 failed。
+
+    处理中的任务持有租约: 每 heartbeat_interval 秒刷新一次 updated，超过 stale_after 秒没有刷新的
+    任务 (所在进程崩溃或被杀) 由 worker 定时放回 pending。租约以领取时的 attempts 为标识，
+    已被放回并重新领取的任务，原来的 worker 不再修改它的状态和进度。
+
+    every() 注册的定时任务由 worker 按同样的间隔检查并入队，请求处理中不需要调度。
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        key TEXT,
+        payload TEXT,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 3,
+        run_after REAL NOT NULL DEFAULT 0,
+        error TEXT,
+        result TEXT,
+        progress TEXT,
+        created REAL,
+        updated REAL
+    );
+    CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, run_after);
+    CREATE INDEX IF NOT EXISTS idx_jobs_key ON jobs(key);
+    """
+
+    def __init__(self, db_file, workers=2, poll_interval=1.0, retry_delay=5.0, stale_after=120,
+                 heartbeat_interval=None):
+        self.db_file = db_file
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.stale_after = stale_after
+        self.heartbeat_interval = heartbeat_interval or stale_after / 4
+        self._handlers = {}
+        self._schedules = []
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._halt = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        # 本进程正在处理的任务: id -> 领取时的 attempts
+        self._running = {}
+        self._next_requeue = 0
+        self._pid = None
+        self._stopped = False
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def register(self, kind, handler):
+        """handler(payload) 返回可 JSON 序列化的结果，抛出异常表示失败"""
+        self._handlers[kind] = handler
+
+    def every(self, kind, interval, key, payload=None, due=None, max_attempts=1):
+        """定时执行 kind 任务: 没有未结束的同 key 任务、且上一次在 interval 秒之前结束时入队
+
+        due() 返回 False 时本次跳过，例如任务的产物还足够新。多个进程共享队列时同一时刻只会入队一个。
+        """
+        self._schedules.append((kind, interval, key, payload or {}, due, max_attempts))
+
+    def _enqueue_due(self):
+        for kind, interval, key, payload, due, max_attempts in self._schedules:
+            if due is not None and not due():
+                continue
+            conn = self._conn()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    'SELECT status, updated FROM jobs WHERE key = ? AND kind = ? ORDER BY id DESC LIMIT 1',
+                    (key, kind)).fetchone()
+                now = time.time()
+                if row is None or (row['status'] not in (PENDING, PROCESSING) and now - row['updated'] >= interval):
+                    conn.execute(
+                        'INSERT INTO jobs (kind, key, payload, status, max_attempts, created, updated) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (kind, key, json.dumps(payload), PENDING, max_attempts, now, now))
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def enqueue(self, kind, payload, key=None, max_attempts=3):
+        now = time.time()
+        cursor = self._conn().execute(
+            'INSERT INTO jobs (kind, key, payload, status, max_attempts, created, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (kind, key, json.dumps(payload), PENDING, max_attempts, now, now))
+        self.start()
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def get(self, job_id):
+        row = self._conn().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._to_dict(row)
+
+    def latest(self, key, kind=None):
+        if kind is None:
+            row = self._conn().execute(
+                'SELECT * FROM jobs WHERE key = ? ORDER BY id DESC LIMIT 1', (key,)).fetchone()
+        else:
+            row = self._conn().execute(
+                'SELECT * FROM jobs WHERE key = ? AND kind = ? ORDER BY id DESC LIMIT 1',
+                (key, kind)).fetchone()
+        return self._to_dict(row)
+
+    def active(self, key, kind):
+        """返回 key 对应的尚未结束 (pending/processing) 的任务"""
+        row = self._conn().execute(
+            'SELECT * FROM jobs WHERE key = ? AND kind = ? AND status IN (?, ?) ORDER BY id LIMIT 1',
+            (key, kind, PENDING, PROCESSING)).fetchone()
+        return self._to_dict(row)
+
+    def report_progress(self, progress):
+        """在任务处理函数中调用，记录当前任务的进度"""
+        job = getattr(self._local, 'job', None)
+        if job is None:
+            return
+        self._conn().execute(
+            'UPDATE jobs SET progress = ?, updated = ? WHERE id = ? AND status = ? AND attempts = ?',
+            (json.dumps(progress), time.time(), job['id'], PROCESSING, job['attempts'] + 1))
+
+    def counts(self):
+        rows = self._conn().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')
+        return {status: n for status, n in rows}
+
+    def _to_dict(self, row):
+        if row is None:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload']) if job['payload'] else None
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        job['progress'] = json.loads(job['progress']) if job['progress'] else None
+        return job
+
+    # worker
+    def start(self):
+        # fork 出来的 worker 进程需要重新启动线程
+        if self._pid == os.getpid() or self._stopped:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._running = {}
+            self._next_requeue = 0
+            self._threads = [
+                threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True)
+                for i in range(self.workers)
+            ]
+            self._threads.append(threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True))
+            for thread in self._threads:
+                thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stopped = True
+        self._halt.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            if thread.is_alive():
+                thread.join(timeout)
+
+    def _requeue_stale(self):
+        # 处理任务的进程崩溃后租约不再刷新，任务会一直停在 processing。
+        # 已用完重试次数的标记为 failed，每次执行都会让进程崩溃的任务不会无限重试
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            failed = conn.execute(
+                'UPDATE jobs SET status = ?, error = ?, updated = ? '
+                'WHERE status = ? AND updated < ? AND attempts >= max_attempts',
+                (FAILED, '处理任务的进程在执行中退出，已达到最大重试次数', now,
+                 PROCESSING, now - self.stale_after)).rowcount
+            requeued = conn.execute(
+                'UPDATE jobs SET status = ?, updated = ? WHERE status = ? AND updated < ?',
+                (PENDING, now, PROCESSING, now - self.stale_after)).rowcount
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        if failed:
+            logger.warning("%d 个任务的租约已过期且用完重试次数，标记为失败", failed)
+        if requeued:
+            logger.warning("%d 个任务的租约已过期，重新排队", requeued)
+            self._wakeup.set()
+
+    def _housekeeping(self):
+        # 各 worker 线程共用一个计时，每 heartbeat_interval 秒检查一次过期的租约和到期的定时任务
+        now = time.time()
+        with self._lock:
+            if now < self._next_requeue:
+                return
+            self._next_requeue = now + self.heartbeat_interval
+        self._requeue_stale()
+        self._enqueue_due()
+
+    def _heartbeat(self):
+        # 刷新本进程处理中任务的 updated，长时间运行的任务不会被当作崩溃重新排队
+        while not self._halt.wait(self.heartbeat_interval):
+            with self._lock:
+                running = list(self._running.items())
+            if not running:
+                continue
+            try:
+                now = time.time()
+                self._conn().executemany(
+                    'UPDATE jobs SET updated = ? WHERE id = ? AND status = ? AND attempts = ?',
+                    [(now, job_id, PROCESSING, attempts) for job_id, attempts in running])
+            except Exception:
+                logger.exception("刷新任务租约出错")
+
+    def _claim(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT * FROM jobs WHERE status = ? AND run_after <= ? ORDER BY id LIMIT 1',
+                (PENDING, time.time())).fetchone()
+            if row is not None:
+                conn.execute(
+                    'UPDATE jobs SET status = ?, attempts = attempts + 1, updated = ? WHERE id = ?',
+                    (PROCESSING, time.time(), row['id']))
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return self._to_dict(row)
+
+    def _finish(self, job, status, result=None, error=None, run_after=0):
+        # 租约已失效 (任务被重新排队) 时不覆盖新的执行
+        cursor = self._conn().execute(
+            'UPDATE jobs SET status = ?, result = ?, error = ?, run_after = ?, updated = ? '
+            'WHERE id = ? AND status = ? AND attempts = ?',
+            (status, json.dumps(result) if result is not None else None, error,
+             run_after, time.time(), job['id'], PROCESSING, job['attempts'] + 1))
+        if not cursor.rowcount:
+            logger.warning("任务 %s (%s) 的租约已失效，丢弃本次结果", job['id'], job['kind'])
+
+    def run_one(self):
+        """领取并执行一个任务，没有可执行任务时返回 False"""
+        job = self._claim()
+        if job is None:
+            return False
+        attempts = job['attempts'] + 1
+        handler = self._handlers.get(job['kind'])
+        self._local.job = job
+        with self._lock:
+            self._running[job['id']] = attempts
+        try:
+            if handler is None:
+                raise LookupError(f"未注册的任务类型: {job['kind']}")
+            result = handler(job['payload'])
+        except Exception as e:
+            logger.exception("任务 %s (%s) 执行失败", job['id'], job['kind'])
+            if attempts < job['max_attempts']:
+                delay = self.retry_delay * 2 ** (attempts - 1)
+                self._finish(job, PENDING, error=str(e), run_after=time.time() + delay)
+            else:
+                self._finish(job, FAILED, error=str(e))
+            return True
+        finally:
+            self._local.job = None
+            with self._lock:
+                self._running.pop(job['id'], None)
+        self._finish(job, DONE, result=result)
+        return True
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                self._housekeeping()
+                if self.run_one():
+                    continue
+            except Exception:
+                logger.exception("任务队列出错")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
@@ -0,0 +1,283 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+
+def format_duration(total_seconds):
+    if not total_seconds:
+        return "0:00"
+    minutes = int(total_seconds // 60)
+    seconds = int(total_seconds % 60)
+    return f"{minutes}:{seconds:02d}"
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def probe(file_path, timeout=30):
+    """一次 ffprobe 调用取得时长、分辨率、编码和码率，失败时返回 None"""
+    try:
+        output = subprocess.check_output(
+            ['ffprobe', '-v', 'error', '-print_format', 'json',
+             '-show_format', '-show_streams', file_path],
+            stderr=subprocess.DEVNULL,
+            timeout=timeout
+        )
+        data = json.loads(output)
+    except:
+        return None
+
+    fmt = data.get('format', {})
+    streams = data.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'), {})
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), {})
+
+    def number(value, cast=float):
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            return None
+
+    return {
+        'duration': number(fmt.get('duration')) or number(video.get('duration')),
+        'width': number(video.get('width'), int),
+        'height': number(video.get('height'), int),
+        'video_codec': video.get('codec_name'),
+        'audio_codec': audio.get('codec_name'),
+        'bitrate': number(fmt.get('bit_rate'), int),
+    }
+
+
+def extract_frames(video_path, timestamps, output_paths, width=None, timeout=120):
+    """用一个 ffmpeg 进程按时间点各取一帧
+
+    -ss 放在 -i 之前做输入端快速定位，只解码目标位置附近的关键帧之后的数据。
+    返回成功生成的文件列表。
+    """
+    cmd = ['ffmpeg', '-v', 'error', '-y']
+    for t in timestamps:
+        cmd += ['-ss', f"{t:.3f}", '-i', video_path]
+    for i, path in enumerate(output_paths):
+        cmd += ['-map', f"{i}:v:0", '-frames:v', '1']
+        if width:
+            cmd += ['-vf', f"scale='min({width},iw)':-2"]
+        cmd.append(path)
+    try:
+        subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+    except:
+        pass
+    return [p for p in output_paths if os.path.exists(p)]
+
+
+def extract_sprite(video_path, duration, output_path, cols=10, rows=10, width=160, timeout=120):
+    """生成进度条悬停预览用的雪碧图，只解码关键帧"""
+    if not duration:
+        return False
+    fps = cols * rows / duration
+    try:
+        subprocess.call([
+            'ffmpeg', '-v', 'error', '-y',
+            '-skip_frame', 'nokey', '-i', video_path,
+            '-vf', f"fps={fps:.6f},scale={width}:-2,tile={cols}x{rows}",
+            '-frames:v', '1',
+            output_path
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+        return os.path.exists(output_path)
+    except:
+        return False
+
+
+def resize_image(image_path, output_path, width, quality=80, timeout=30):
+    """把图片缩放到不超过 width 的宽度，输出格式由扩展名决定 (.webp / .jpg)，成功时返回 True"""
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-i', image_path,
+           '-vf', f"scale='min({width},iw)':-2", '-frames:v', '1']
+    if output_path.endswith('.webp'):
+        cmd += ['-c:v', 'libwebp', '-quality', str(quality)]
+    else:
+        # JPEG 的 -q:v 为 2 (最好) 到 31，大致对应 quality 100 到 0
+        cmd += ['-q:v', str(max(2, min(31, round(31 - quality * 0.29))))]
+    cmd.append(output_path)
+    try:
+        subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+        return os.path.getsize(output_path) > 0
+    except:
+        return False
+
+
+def _link(src, dst):
+    # 优先硬链接，跨文件系统时复制
+    try:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class MediaAnalyzer:
+    """视频分析: 一次 ffprobe + 多张缩略图 + 雪碧图，结果按文件内容哈希缓存
+
+    缓存目录为 cache_folder/<哈希>/，包含 info.json 和生成的图片。
+    重复上传相同内容或重新扫描时直接使用缓存，不再调用 ffprobe/ffmpeg。
+    """
+
+    THUMBNAIL_POSITIONS = (0.1, 0.5, 0.9)
+
+    def __init__(self, cache_folder, thumbnail_width=640, sprite_cols=10, sprite_rows=10,
+                 sprite_width=160, probe_timeout=30, ffmpeg_timeout=120):
+        self.cache_folder = cache_folder
+        self.thumbnail_width = thumbnail_width
+        self.sprite_cols = sprite_cols
+        self.sprite_rows = sprite_rows
+        self.sprite_width = sprite_width
+        self.probe_timeout = probe_timeout
+        self.ffmpeg_timeout = ffmpeg_timeout
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def _load_cached(self, cache_dir):
+        try:
+            with open(os.path.join(cache_dir, 'info.json'), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def analyze(self, video_path):
+        """返回分析结果，ffprobe 失败时返回 None"""
+        digest = file_hash(video_path)
+        cache_dir = os.path.join(self.cache_folder, digest)
+        info = self._load_cached(cache_dir)
+        if info is not None:
+            info['cache_dir'] = cache_dir
+            return info
+
+        info = probe(video_path, self.probe_timeout)
+        if info is None:
+            return None
+        info['hash'] = digest
+
+        # 先生成到临时目录，完成后整体改名，避免并发分析同一文件时互相覆盖
+        work_dir = tempfile.mkdtemp(prefix=f".{digest}.", dir=self.cache_folder)
+        duration = info['duration']
+        if duration:
+            timestamps = [max(0.0, min(duration * p, duration - 0.5)) for p in self.THUMBNAIL_POSITIONS]
+        else:
+            timestamps = [1.0]
+        names = [f"thumb_{i}.jpg" for i in range(len(timestamps))]
+        created = extract_frames(video_path, timestamps,
+                                 [os.path.join(work_dir, n) for n in names],
+                                 width=self.thumbnail_width, timeout=self.ffmpeg_timeout)
+        info['thumbnails'] = [os.path.basename(p) for p in created]
+        if not created:
+            # 一张缩略图都没有生成时不写缓存，下次重新生成
+            shutil.rmtree(work_dir, ignore_errors=True)
+            info['cache_dir'] = None
+            return info
+        info['sprite'] = None
+        if extract_sprite(video_path, duration, os.path.join(work_dir, 'sprite.jpg'),
+                          self.sprite_cols, self.sprite_rows, self.sprite_width,
+                          timeout=self.ffmpeg_timeout):
+            info['sprite'] = {
+                'file': 'sprite.jpg',
+                'cols': self.sprite_cols,
+                'rows': self.sprite_rows,
+                'interval': duration / (self.sprite_cols * self.sprite_rows),
+            }
+        with open(os.path.join(work_dir, 'info.json'), 'w') as f:
+            json.dump(info, f)
+
+        try:
+            os.rename(work_dir, cache_dir)
+        except OSError:
+            # 其他进程已经生成了同一内容的缓存
+            shutil.rmtree(work_dir, ignore_errors=True)
+            cached = self._load_cached(cache_dir)
+            if cached is not None:
+                info = cached
+        info['cache_dir'] = cache_dir
+        return info
+
+    def install(self, info, vid, thumbnail_folder):
+        """把缓存中的图片链接到缩略图目录，返回要写入视频记录的字段"""
+        fields = {
+            'duration': format_duration(info.get('duration')),
+            'duration_seconds': info.get('duration'),
+            'width': info.get('width'),
+            'height': info.get('height'),
+            'video_codec': info.get('video_codec'),
+            'audio_codec': info.get('audio_codec'),
+            'bitrate': info.get('bitrate'),
+            'content_hash': info.get('hash'),
+            'thumbnails': [],
+        }
+        cache_dir = info.get('cache_dir')
+        if cache_dir is None:
+            return fields
+        for i, name in enumerate(info.get('thumbnails', [])):
+            target = f"{vid}.jpg" if i == 0 else f"{vid}_{i}.jpg"
+            _link(os.path.join(cache_dir, name), os.path.join(thumbnail_folder, target))
+            fields['thumbnails'].append(target)
+        if fields['thumbnails']:
+            fields['thumbnail'] = fields['thumbnails'][0]
+        sprite = info.get('sprite')
+        if sprite:
+            target = f"{vid}_sprite.jpg"
+            _link(os.path.join(cache_dir, sprite['file']), os.path.join(thumbnail_folder, target))
+            fields['sprite'] = dict(sprite, file=target)
+        return fields
+
+
+def select_renditions(ladder, source_height):
+    """从码率阶梯中选出不超过原始分辨率的档位，至少保留最低一档"""
+    ladder = sorted(ladder, key=lambda r: r[0], reverse=True)
+    if not source_height:
+        return ladder[-1:]
+    selected = [r for r in ladder if r[0] <= source_height]
+    return selected or ladder[-1:]
+
+
+def package_hls(video_path, output_dir, renditions, segment_seconds=6, has_audio=True, timeout=3600):
+    """用一个 ffmpeg 进程转码出多档 HLS 码流
+
+    renditions 为 [(高度, 视频码率 kbps)]，输出 output_dir/master.m3u8 和
+    output_dir/<高度>p/index.m3u8 + 分片。各档关键帧对齐，便于播放器切换码率。
+    """
+    n = len(renditions)
+    filters = [f"[0:v]split={n}" + ''.join(f"[s{i}]" for i in range(n))]
+    filters += [f"[s{i}]scale=-2:{height}[v{i}]" for i, (height, _) in enumerate(renditions)]
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-i', video_path,
+           '-filter_complex', ';'.join(filters)]
+    stream_map = []
+    for i, (height, kbps) in enumerate(renditions):
+        cmd += ['-map', f"[v{i}]",
+                f"-c:v:{i}", 'libx264', f"-b:v:{i}", f"{kbps}k",
+                f"-maxrate:v:{i}", f"{int(kbps * 1.07)}k", f"-bufsize:v:{i}", f"{int(kbps * 1.5)}k"]
+        entry = f"v:{i}"
+        if has_audio:
+            cmd += ['-map', 'a:0', f"-c:a:{i}", 'aac', f"-b:a:{i}", '128k', '-ac', '2']
+            entry += f",a:{i}"
+        stream_map.append(f"{entry},name:{height}p")
+    cmd += ['-preset', 'veryfast', '-sc_threshold', '0',
+            '-force_key_frames', f"expr:gte(t,n_forced*{segment_seconds})",
+            '-f', 'hls',
+            '-hls_time', str(segment_seconds),
+            '-hls_playlist_type', 'vod',
+            '-hls_flags', 'independent_segments',
+            '-hls_segment_filename', os.path.join(output_dir, '%v', 'seg_%05d.ts'),
+            '-master_pl_name', 'master.m3u8',
+            '-var_stream_map', ' '.join(stream_map),
+            os.path.join(output_dir, '%v', 'index.m3u8')]
+    os.makedirs(output_dir, exist_ok=True)
+    try:
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       timeout=timeout, check=True)
+    except:
+        return False
+    return os.path.exists(os.path.join(output_dir, 'master.m3u8'))
@@ -0,0 +1,101 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class CachedPage:
+    __slots__ = ('body', 'mimetype', 'etag', 'expires')
+
+    def __init__(self, body, mimetype, expires):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.expires = expires
+
+
+class PageCache:
+    """渲染结果的内存缓存，按 TTL 过期，超过条数或总字节数时淘汰最久未使用的页面
+
+    同一个 key 同时未命中时只有一个线程渲染，其他线程等待它的结果，
+    首页缓存过期的瞬间不会有大量请求同时重新渲染。
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024, ttl=10.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()
+        self._bytes = 0
+        self._rendering = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key, now):
+        page = self._pages.get(key)
+        if page is None:
+            return None
+        if page.expires <= now:
+            self._remove(key)
+            return None
+        self._pages.move_to_end(key)
+        return page
+
+    def _remove(self, key):
+        page = self._pages.pop(key)
+        self._bytes -= len(page.body)
+
+    def _put(self, key, page):
+        if key in self._pages:
+            self._remove(key)
+        self._pages[key] = page
+        self._bytes += len(page.body)
+        while self._pages and (len(self._pages) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._pages)))
+
+    def get_or_render(self, key, render, timeout=10.0):
+        """返回缓存的页面，没有时调用 render() 得到 (body, mimetype) 并缓存
+
+        render() 返回 None 表示结果不可缓存 (例如 404 或重定向)，此时返回 None。
+        """
+        with self._lock:
+            page = self._get(key, time.time())
+            if page is not None:
+                self.hits += 1
+                return page
+            self.misses += 1
+            event = self._rendering.get(key)
+            owner = event is None
+            if owner:
+                event = self._rendering[key] = threading.Event()
+
+        if not owner:
+            event.wait(timeout)
+            with self._lock:
+                page = self._get(key, time.time())
+            if page is not None:
+                return page
+
+        try:
+            result = render()
+            if result is None:
+                return None
+            body, mimetype = result
+            page = CachedPage(body, mimetype, time.time() + self.ttl)
+            with self._lock:
+                self._put(key, page)
+            return page
+        finally:
+            if owner:
+                with self._lock:
+                    self._rendering.pop(key, None)
+                event.set()
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._pages)
@@ -0,0 +1,96 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+def _collapse(frame):
+    # 从栈底到栈顶拼成 "函数 (文件:行);..." 形式，与 flamegraph.pl / speedscope 的 collapsed 格式一致
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    """慢请求的采样分析
+
+    请求开始时 begin() 登记当前线程，后台线程每 interval 秒用 sys._current_frames()
+    取一次所有已登记线程的调用栈并累加。请求结束时 end() 取回样本，总耗时超过
+    threshold 秒时写成 output_dir/<时间>_<名称>.folded，每行 "栈 次数"，可以直接交给
+    flamegraph.pl 或 speedscope。没有登记的线程时采样线程空闲等待。
+    """
+
+    def __init__(self, output_dir, threshold=1.0, interval=0.005, max_files=1000):
+        self.output_dir = output_dir
+        self.threshold = threshold
+        self.interval = interval
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._active = {}
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.dumped = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _ensure_thread(self):
+        # fork 之后线程不会被继承，在子进程中重新启动
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+
+    def begin(self):
+        """登记当前线程，返回传给 end() 的标识"""
+        ident = threading.get_ident()
+        with self._lock:
+            self._active[ident] = Counter()
+        self._ensure_thread()
+        self._wakeup.set()
+        return ident
+
+    def end(self, ident, duration, name):
+        """取消登记，duration 超过阈值时写出样本，返回文件路径或 None"""
+        with self._lock:
+            samples = self._active.pop(ident, None)
+        if not samples or duration < self.threshold:
+            return None
+        return self.dump(samples, duration, name)
+
+    def dump(self, samples, duration, name):
+        if self.dumped >= self.max_files:
+            return None
+        safe = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)[:80]
+        path = os.path.join(self.output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}_{int(duration * 1000)}ms_{safe}.folded")
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        os.replace(tmp_path, path)
+        self.dumped += 1
+        return path
+
+    def _run(self):
+        while True:
+            with self._lock:
+                idle = not self._active
+                if idle:
+                    self._wakeup.clear()
+            if idle:
+                self._wakeup.wait()
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, samples in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[_collapse(frame)] += 1
+            time.sleep(self.interval)
@@ -0,0 +1,247 @@
+import heapq
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+DEFAULT_WEIGHTS = {'view': 1.0, 'like': 5.0, 'favorite': 8.0, 'comment': 4.0}
+
+
+class TrendingTracker:
+    """按时间衰减的热度分数，每次互动增量更新
+
+    分数保存为 "放大到 epoch 时刻之后" 的值: 在 t 时刻的一次互动记为 w * exp(rate * (t - epoch))，
+    这样所有视频的衰减因子相同，不需要逐个衰减就可以直接比较；数值过大时整体缩小并移动 epoch。
+    热门榜是每隔 refresh_interval 秒重新选出的前 top_k 个，读取时直接返回。
+    """
+
+    def __init__(self, half_life=6 * 3600, top_k=100, refresh_interval=5.0, weights=None):
+        self.rate = math.log(2) / half_life
+        self.top_k = top_k
+        self.refresh_interval = refresh_interval
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self._lock = threading.Lock()
+        self._epoch = time.time()
+        self._scores = {}
+        self._top = []
+        self._top_time = 0.0
+
+    def _boost(self, now):
+        boost = math.exp(self.rate * (now - self._epoch))
+        if boost > 1e12:
+            # 重新设定 epoch，避免浮点溢出
+            for vid in self._scores:
+                self._scores[vid] /= boost
+            self._epoch = now
+            boost = 1.0
+        return boost
+
+    def record(self, vid, signal, n=1, now=None):
+        weight = self.weights.get(signal, 0.0) * n
+        if not weight:
+            return
+        now = now or time.time()
+        with self._lock:
+            self._scores[vid] = self._scores.get(vid, 0.0) + weight * self._boost(now)
+
+    def seed(self, videos, now=None):
+        """用已有的累计数据给还没有分数的视频一个初始分数，按上传时间衰减"""
+        now = now or time.time()
+        with self._lock:
+            boost = self._boost(now)
+            for video in videos:
+                if video['id'] in self._scores:
+                    continue
+                total = (self.weights['view'] * video.get('views', 0)
+                         + self.weights['like'] * video.get('likes', 0)
+                         + self.weights['favorite'] * video.get('favorites', 0)
+                         + self.weights['comment'] * video.get('comment_count', 0))
+                try:
+                    uploaded = datetime.strptime(video.get('upload_date', ''), "%Y-%m-%d").timestamp()
+                except ValueError:
+                    uploaded = now
+                age = max(0.0, now - uploaded)
+                self._scores[video['id']] = total * math.exp(-self.rate * age) * boost
+            self._top_time = 0.0
+
+    def score(self, vid, now=None):
+        now = now or time.time()
+        with self._lock:
+            return self._scores.get(vid, 0.0) / self._boost(now)
+
+    def trending(self, limit=20):
+        """返回热度最高的视频 id 列表"""
+        now = time.time()
+        with self._lock:
+            if now - self._top_time >= self.refresh_interval:
+                self._top = [vid for vid, score in heapq.nlargest(
+                    self.top_k, self._scores.items(), key=lambda item: item[1]) if score > 0]
+                self._top_time = now
+            return self._top[:limit]
+
+    def on_catalog_change(self, action, payload):
+        # 作为 Catalog 的监听器使用
+        if action == 'reload':
+            self.seed(payload)
+        elif action == 'add':
+            self.seed([payload])
+
+
+def _gather(starts, lengths, values):
+    # 把 values[starts[k]:starts[k]+lengths[k]] 依次拼接，不使用 Python 循环
+    total = int(lengths.sum())
+    if not total:
+        return values[:0]
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+    return values[offsets]
+
+
+def _related_numpy(pairs, top_k, max_user_items, batch_cells):
+    items, item_idx = np.unique(np.array([p[0] for p in pairs], dtype=object), return_inverse=True)
+    users, user_idx = np.unique(np.array([p[1] for p in pairs], dtype=object), return_inverse=True)
+    n = len(items)
+
+    # 去重后按用户排序，每个用户最多保留 max_user_items 个视频，避免刷量账号让计算量平方增长
+    keys = np.unique(user_idx.astype(np.int64) * n + item_idx)
+    user_idx, item_idx = keys // n, keys % n
+    first = np.searchsorted(user_idx, user_idx)
+    keep = np.arange(len(user_idx)) - first < max_user_items
+    user_idx, item_idx = user_idx[keep], item_idx[keep]
+
+    user_ptr = np.concatenate(([0], np.cumsum(np.bincount(user_idx, minlength=len(users)))))
+    order = np.argsort(item_idx, kind='stable')
+    item_users = user_idx[order]
+    degree = np.bincount(item_idx, minlength=n)
+    item_ptr = np.concatenate(([0], np.cumsum(degree)))
+    norm = np.sqrt(np.maximum(degree, 1)).astype(np.float32)
+
+    table = {}
+    batch = max(1, batch_cells // max(n, 1))
+    for start in range(0, n, batch):
+        rows = np.arange(start, min(n, start + batch))
+        # 本批视频的 (行, 用户)，再展开为这些用户互动过的所有 (行, 视频)
+        lengths = degree[rows]
+        local = np.repeat(np.arange(len(rows)), lengths)
+        row_users = _gather(item_ptr[rows], lengths, item_users)
+        user_lengths = user_ptr[row_users + 1] - user_ptr[row_users]
+        pair_rows = np.repeat(local, user_lengths)
+        pair_items = _gather(user_ptr[row_users], user_lengths, item_idx)
+
+        counts = np.bincount(pair_rows * n + pair_items, minlength=len(rows) * n)
+        counts = counts.reshape(len(rows), n).astype(np.float32)
+        counts[np.arange(len(rows)), rows] = 0
+        sims = counts / norm[rows][:, None] / norm[None, :]
+
+        k = min(top_k, n - 1)
+        if k <= 0:
+            break
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        top_sims = np.take_along_axis(sims, top, axis=1)
+        ranked = np.argsort(-top_sims, axis=1)
+        top = np.take_along_axis(top, ranked, axis=1)
+        top_sims = np.take_along_axis(top_sims, ranked, axis=1)
+        for r, row in enumerate(rows):
+            related = [(items[j], round(float(s), 4)) for j, s in zip(top[r], top_sims[r]) if s > 0]
+            if related:
+                table[items[row]] = related
+    return table
+
+
+def _related_python(pairs, top_k, max_user_items):
+    item_users = {}
+    user_items = {}
+    # 与 NumPy 版本一致: 按 (用户, 视频) 排序后每个用户保留 id 最小的 max_user_items 个视频
+    for item, user in sorted(set(pairs), key=lambda p: (p[1], p[0])):
+        items = user_items.setdefault(user, [])
+        if len(items) < max_user_items:
+            items.append(item)
+            item_users.setdefault(item, []).append(user)
+
+    table = {}
+    for item, users in item_users.items():
+        counts = Counter()
+        for user in users:
+            counts.update(user_items[user])
+        del counts[item]
+        degree = len(users)
+        related = heapq.nlargest(top_k, (
+            (count / math.sqrt(degree * len(item_users[other])), other)
+            for other, count in counts.items()))
+        if related:
+            table[item] = [(other, round(score, 4)) for score, other in related]
+    return table
+
+
+def compute_related(pairs, top_k=20, max_user_items=500, batch_cells=4 * 1024 * 1024):
+    """根据共同点赞/收藏计算相关视频表
+
+    pairs 为 [(视频 id, 用户)]。相似度为余弦相似度 |U(a) ∩ U(b)| / sqrt(|U(a)| * |U(b)|)。
+    安装了 NumPy 时按批次向量化计算，每批 batch_cells / 视频数 行；否则用纯 Python 计算。
+    返回 {视频 id: [(相关视频 id, 相似度)]}。
+    """
+    pairs = list(pairs)
+    if not pairs:
+        return {}
+    if np is not None:
+        return _related_numpy(pairs, top_k, max_user_items, batch_cells)
+    return _related_python(pairs, top_k, max_user_items)
+
+
+def save_related(path, table):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'generated': time.time(), 'related': table}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class RelatedIndex:
+    """读取离线生成的相关视频表，文件更新后自动重新加载"""
+
+    def __init__(self, path, check_interval=5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._table = {}
+        self._signature = None
+        self._generated = 0.0
+        self._checked = 0.0
+
+    def _maybe_reload(self):
+        now = time.time()
+        if now - self._checked < self.check_interval:
+            return
+        with self._lock:
+            self._checked = now
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                return
+            signature = (st.st_mtime_ns, st.st_size)
+            if signature == self._signature:
+                return
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                return
+            self._table = {vid: [r[0] for r in related] for vid, related in data.get('related', {}).items()}
+            self._generated = data.get('generated', 0.0)
+            self._signature = signature
+
+    def age(self):
+        """距离上次生成的秒数，没有生成过时为 None"""
+        self._maybe_reload()
+        return time.time() - self._generated if self._generated else None
+
+    def related(self, vid, limit=10):
+        self._maybe_reload()
+        return self._table.get(vid, [])[:limit]
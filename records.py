@@ -0,0 +1,217 @@
+import marshal
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from collections.abc import Mapping
+
+
+# 常用字段放在 __slots__ 中，其余字段 (hls、sprite、分辨率等) 放在 _extra 字典里
+VIDEO_FIELDS = ('id', 'title', 'filename', 'upload_date', 'duration', 'thumbnail', 'author',
+                'views', 'likes', 'favorites', 'comment_count')
+# 计数字段总是存在，缺失时为 0；快照中按列保存为 int64 数组
+VIDEO_COUNTERS = ('views', 'likes', 'favorites', 'comment_count')
+# 大量记录共用的短字符串，驻留后只保存一份
+INTERNED_FIELDS = ('author', 'upload_date', 'duration', 'thumbnail')
+
+_FIELD_SET = frozenset(VIDEO_FIELDS)
+_COUNTER_SET = frozenset(VIDEO_COUNTERS)
+
+
+def intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class VideoRecord(Mapping):
+    """只读的紧凑视频记录
+
+    按字典的方式读取 (video['title'] / video.get('views', 0) / dict(video))，
+    模板中也可以用 video.title。记录本身不到等价 dict 的一半大小。
+    不能原地修改，replace(**changes) 返回修改后的新记录，to_dict() 返回普通字典。
+    """
+
+    __slots__ = VIDEO_FIELDS + ('_extra',)
+
+    def __init__(self, data=()):
+        extra = None
+        for key, value in (data.items() if isinstance(data, Mapping) else data):
+            if key in _FIELD_SET:
+                if key in INTERNED_FIELDS:
+                    value = intern(value)
+                object.__setattr__(self, key, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        for key in VIDEO_COUNTERS:
+            if not hasattr(self, key):
+                object.__setattr__(self, key, 0)
+        object.__setattr__(self, '_extra', extra)
+
+    def __setattr__(self, name, value):
+        raise TypeError('VideoRecord 是只读的，使用 replace() 修改')
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in _FIELD_SET:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for key in VIDEO_FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for key in VIDEO_FIELDS if hasattr(self, key)) + len(self._extra or ())
+
+    def __repr__(self):
+        return f"VideoRecord({self.to_dict()!r})"
+
+    def __reduce__(self):
+        return VideoRecord, (self.to_dict(),)
+
+    def replace(self, **changes):
+        return VideoRecord({**self, **changes})
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+class Interner:
+    """字符串与连续整数 id 的双向映射，集合中保存整数 id 代替字符串
+
+    不加锁，由调用方在自己的锁内使用。
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._names = []
+
+    def id(self, name):
+        ident = self._ids.get(name)
+        if ident is None:
+            ident = self._ids[name] = len(self._names)
+            self._names.append(sys.intern(name))
+        return ident
+
+    def lookup(self, name):
+        # 不存在时返回 None，不分配新的 id
+        return self._ids.get(name)
+
+    def name(self, ident):
+        return self._names[ident]
+
+    def names(self, idents):
+        names = self._names
+        return [names[i] for i in idents]
+
+    def __len__(self):
+        return len(self._names)
+
+
+# 快照文件: 魔数 + 格式版本 + 代数的长度，之后是 marshal 编码的变更代数和数据。
+# 格式变化时增加版本号，旧快照直接忽略
+SNAPSHOT_MAGIC = b'VCATSNAP'
+SNAPSHOT_VERSION = 3
+_HEADER = struct.Struct('<8sHI')
+# 快照中缺失字段的占位值
+_MISSING = ...
+
+
+def _encode_videos(videos):
+    # 按列保存: 字符串等字段各一个列表，计数字段为 int64 数组的原始字节
+    columns = {}
+    for key in VIDEO_FIELDS:
+        if key in _COUNTER_SET:
+            columns[key] = array('q', (v[key] for v in videos)).tobytes()
+        else:
+            columns[key] = [v.get(key, _MISSING) for v in videos]
+    extra = [v._extra for v in videos]
+    return {'count': len(videos), 'columns': columns, 'extra': extra}
+
+
+def _decode_videos(data):
+    count = data['count']
+    columns = []
+    for key in VIDEO_FIELDS:
+        column = data['columns'][key]
+        if key in _COUNTER_SET:
+            values = array('q')
+            values.frombytes(column)
+            column = values.tolist()
+        if len(column) != count:
+            raise ValueError(f"快照列 {key} 长度不一致")
+        columns.append(column)
+    # 直接通过 slot 描述符赋值，不经过 __init__ 的逐字段判断；驻留的字符串由 marshal 保持驻留
+    new = VideoRecord.__new__
+    setters = [getattr(VideoRecord, key).__set__ for key in VIDEO_FIELDS]
+    set_extra = VideoRecord._extra.__set__
+    videos = []
+    append = videos.append
+    for row, extra in zip(zip(*columns), data['extra']):
+        record = new(VideoRecord)
+        for setter, value in zip(setters, row):
+            if value is not _MISSING:
+                setter(record, value)
+        set_extra(record, extra)
+        append(record)
+    return videos
+
+
+def save_snapshot(path, generation, videos, users):
+    """把目录写入快照文件，先写临时文件再改名
+
+    generation 为存储的变更代数，加载时与存储当前的代数比较，不同则快照已过期。
+    """
+    payload = marshal.dumps({
+        'videos': _encode_videos(videos),
+        'users': [dict(u) for u in users],
+    })
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                                    dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            generation = marshal.dumps(generation)
+            f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(generation)))
+            f.write(generation)
+            f.write(payload)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def load_snapshot(path, generation):
+    """返回 (视频记录列表, 用户列表)；文件不存在、格式不符或代数不同时返回 None
+
+    快照只由本应用写入，marshal 不能用来读取不可信的数据。
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return None
+            magic, version, size = _HEADER.unpack(header)
+            if (magic, version) != (SNAPSHOT_MAGIC, SNAPSHOT_VERSION):
+                return None
+            # 先只读代数，过期的快照不必读取和解码数据
+            if marshal.loads(f.read(size)) != generation:
+                return None
+            snapshot = marshal.loads(f.read())
+        return _decode_videos(snapshot['videos']), snapshot['users']
+    except (OSError, ValueError, EOFError, TypeError, KeyError):
+        return None
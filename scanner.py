@@ -0,0 +1,127 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def unique_id(base, taken):
+    """不在 taken 中的 id: base、base_1、base_2 ..."""
+    vid, counter = base, 1
+    while vid in taken:
+        vid = f"{base}_{counter}"
+        counter += 1
+    return vid
+
+
+class LibraryScanner:
+    """增量扫描 UPLOAD_FOLDER，把新增或改动过的视频并行处理
+
+    实际的解码工作在 ffprobe/ffmpeg 子进程中进行，这里用按 CPU 核数大小的线程池
+    同时驱动多个子进程；在多线程的 Web 进程中 fork 进程池容易死锁，所以不用进程池。
+    manifest 记录每个文件上次扫描时的 (size, mtime)，未变化的文件直接跳过。
+    结果每 batch_size 个提交一次并同步写入 manifest，中断后再次扫描会从断点继续。
+    """
+
+    def __init__(self, upload_folder, manifest_file, allowed_extensions, analyze,
+                 workers=None, batch_size=50):
+        self.upload_folder = upload_folder
+        self.manifest_file = manifest_file
+        self.allowed_extensions = allowed_extensions
+        # analyze(视频路径, vid) 返回要写入视频记录的字段，失败时返回 None
+        self.analyze = analyze
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_file, 'r') as f:
+                return json.load(f)
+        except:
+            return {}
+
+    def save_manifest(self, manifest):
+        tmp_path = self.manifest_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_file)
+
+    def list_files(self):
+        files = {}
+        with os.scandir(self.upload_folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.split('.')[-1] not in self.allowed_extensions:
+                    continue
+                st = entry.stat()
+                files[entry.name] = [st.st_size, st.st_mtime_ns]
+        return files
+
+    def plan(self, known_filenames):
+        """返回 (需要处理的 [(文件名, 是否新视频)], 文件状态, manifest)"""
+        manifest = self.load_manifest()
+        files = self.list_files()
+        todo = []
+        for filename, state in sorted(files.items()):
+            if manifest.get(filename) == state:
+                continue
+            if filename in known_filenames and filename not in manifest:
+                # 已在目录中但还没有 manifest 记录 (第一次扫描)，不需要重新处理
+                manifest[filename] = state
+                continue
+            todo.append((filename, filename not in known_filenames))
+        return todo, files, manifest
+
+    def run(self, known, commit_batch, progress=None):
+        """known 为目录中已有的 {文件名: 视频 id}
+
+        commit_batch(results) 提交一批结果，每个结果包含 filename, vid, fields (analyze 的返回值), new；
+        返回没有提交的文件名，这些文件不写入 manifest，下次扫描重新处理。
+        """
+        todo, files, manifest = self.plan(known)
+        total = len(todo)
+        if progress:
+            progress(0, total)
+        if not todo:
+            self.save_manifest(manifest)
+            return 0
+
+        done = 0
+        batch = []
+
+        def flush():
+            if not batch:
+                return
+            skipped = set(commit_batch(list(batch)) or ())
+            for result in batch:
+                if result['filename'] not in skipped:
+                    manifest[result['filename']] = files[result['filename']]
+            self.save_manifest(manifest)
+            batch.clear()
+
+        # 新文件的 id 取文件名第一个点之前的部分；a.mp4 和 a.mkv、a.v2.mp4 这样的文件
+        # 会得到相同的 id，已被使用时加序号。id 在分析前确定，缩略图按 id 命名
+        taken = set(known.values())
+        with ThreadPoolExecutor(max_workers=min(self.workers, total)) as pool:
+            futures = {}
+            for filename, is_new in todo:
+                vid = unique_id(filename.split('.')[0], taken) if is_new else known[filename]
+                taken.add(vid)
+                future = pool.submit(self.analyze, os.path.join(self.upload_folder, filename), vid)
+                futures[future] = (filename, vid, is_new)
+            for future in as_completed(futures):
+                filename, vid, is_new = futures[future]
+                try:
+                    fields = future.result()
+                except Exception:
+                    fields = None
+                batch.append({
+                    'filename': filename,
+                    'vid': vid,
+                    'fields': fields or {},
+                    'new': is_new,
+                })
+                done += 1
+                if len(batch) >= self.batch_size:
+                    flush()
+                if progress:
+                    progress(done, total)
+            flush()
+        return total
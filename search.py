@@ -0,0 +1,157 @@
+import heapq
+import math
+import re
+import threading
+from collections import Counter
+
+
+# 连续的中日韩字符，或连续的字母数字
+_TOKEN_RE = re.compile(r'[぀-ヿ㐀-䶿一-鿿豈-﫿가-힯]+|[0-9a-z]+')
+_CJK_RE = re.compile(r'[぀-ヿ㐀-䶿一-鿿豈-﫿가-힯]')
+# 英文单词按前缀建索引，超过这个长度的前缀不再单独索引
+MAX_PREFIX = 16
+
+
+def tokenize(text, prefixes=False):
+    """中文按单字和相邻两字切分，英文/数字按单词切分
+
+    建索引时 prefixes=True，同时索引单词的各个前缀，使 "mine" 能匹配 "minecraft"。
+    """
+    tokens = []
+    for run in _TOKEN_RE.findall(text.lower()):
+        if _CJK_RE.match(run):
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        elif prefixes:
+            tokens.extend(run[:i] for i in range(1, min(len(run), MAX_PREFIX) + 1))
+            if len(run) > MAX_PREFIX:
+                tokens.append(run)
+        else:
+            tokens.append(run[:MAX_PREFIX] if len(run) > MAX_PREFIX else run)
+    return tokens
+
+
+def _query_tokens(query):
+    # 查询时中文只用两字词（单字查询除外），减少候选集
+    tokens = []
+    for run in _TOKEN_RE.findall(query.lower()):
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run[:MAX_PREFIX])
+    return list(dict.fromkeys(tokens))
+
+
+def _document_text(video):
+    filename = video.get('filename', '')
+    return f"{video.get('title', '')} {filename.rsplit('.', 1)[0].replace('_', ' ')}"
+
+
+class SearchIndex:
+    """视频标题/文件名的倒排索引
+
+    posting 表为 token -> {视频 id: 词频}，上传、/update 和标题修改时增量更新。
+    查询要求所有查询词都命中，按相关度加上播放/点赞热度排序后分页返回。
+    """
+
+    def __init__(self, popularity_weight=0.3):
+        self.popularity_weight = popularity_weight
+        self._lock = threading.Lock()
+        self._postings = {}
+        self._docs = {}
+        self._order = []
+
+    def __len__(self):
+        return len(self._docs)
+
+    def rebuild(self, videos):
+        with self._lock:
+            self._postings = {}
+            self._docs = {}
+            self._order = []
+            for video in videos:
+                self._add(video)
+
+    def add(self, video):
+        with self._lock:
+            if video['id'] in self._docs:
+                self._remove(video['id'])
+            self._add(video)
+
+    def update(self, video):
+        text = _document_text(video)
+        with self._lock:
+            doc = self._docs.get(video['id'])
+            if doc is not None and doc[0] == text:
+                return
+            if doc is not None:
+                self._remove(video['id'], keep_order=True)
+            self._add(video, text)
+
+    def remove(self, vid):
+        with self._lock:
+            self._remove(vid)
+
+    def _add(self, video, text=None):
+        vid = video['id']
+        text = _document_text(video) if text is None else text
+        counts = Counter(tokenize(text, prefixes=True))
+        for token, tf in counts.items():
+            self._postings.setdefault(token, {})[vid] = tf
+        if vid not in self._docs:
+            self._order.append(vid)
+        self._docs[vid] = (text, counts)
+
+    def _remove(self, vid, keep_order=False):
+        doc = self._docs.pop(vid, None)
+        if doc is None:
+            return
+        for token in doc[1]:
+            posting = self._postings.get(token)
+            if posting is not None:
+                posting.pop(vid, None)
+                if not posting:
+                    del self._postings[token]
+        if not keep_order:
+            self._order.remove(vid)
+
+    def on_catalog_change(self, action, payload):
+        # 作为 Catalog 的监听器使用
+        if action == 'reload':
+            self.rebuild(payload)
+        elif action == 'add':
+            self.add(payload)
+        elif action == 'update':
+            self.update(payload)
+
+    def search(self, query, page=1, per_page=24, popularity=None):
+        """返回 (当前页的视频 id 列表, 命中总数)
+
+        popularity(vid) 返回 (views, likes)，用于热度加权。
+        """
+        page = max(1, page)
+        start = (page - 1) * per_page
+        tokens = _query_tokens(query)
+        with self._lock:
+            if not tokens:
+                return self._order[start:start + per_page], len(self._order)
+            postings = [self._postings.get(t) for t in tokens]
+            if not all(postings):
+                return [], 0
+            postings.sort(key=len)
+            candidates = [vid for vid in postings[0] if all(vid in p for p in postings[1:])]
+            total_docs = len(self._docs)
+            idf = [math.log(1 + total_docs / len(p)) for p in postings]
+
+        def score(vid):
+            relevance = sum(w * p.get(vid, 0) for w, p in zip(idf, postings))
+            if popularity is not None:
+                views, likes = popularity(vid)
+                relevance += self.popularity_weight * math.log1p(views + 5 * likes)
+            return relevance
+
+        top = heapq.nlargest(start + per_page, candidates, key=score)
+        return top[start:], len(candidates)
@@ -0,0 +1,144 @@
+import hashlib
+import re
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+
+_SESSION_ID_RE = re.compile(r'^[A-Za-z0-9_-]{43}$')
+
+
+def _key(sid):
+    # 数据库中只保存会话 id 的哈希，数据库泄露时不能直接冒用会话
+    return hashlib.blake2b(sid.encode(), digest_size=20).hexdigest()
+
+
+class SessionStore:
+    """服务端会话数据，保存在单独的 SQLite 数据库 (WAL 模式) 中，多进程共享"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        expires REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires);
+    """
+
+    def __init__(self, db_file, purge_every=1000):
+        self.db_file = db_file
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._writes = 0
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, sid):
+        """返回 (数据, 过期时间)，不存在或已过期时返回 None"""
+        row = self._conn().execute(
+            'SELECT data, expires FROM sessions WHERE id = ? AND expires > ?',
+            (_key(sid), time.time())).fetchone()
+        return row
+
+    def save(self, sid, data, expires):
+        self._conn().execute(
+            'INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)',
+            (_key(sid), data, expires))
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            self.purge()
+
+    def delete(self, sid):
+        self._conn().execute('DELETE FROM sessions WHERE id = ?', (_key(sid),))
+
+    def purge(self):
+        """删除过期的会话"""
+        self._conn().execute('DELETE FROM sessions WHERE expires <= ?', (time.time(),))
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.new = sid is None
+        self.modified = False
+        self.regenerated = False
+
+    def regenerate(self):
+        """登录后更换会话 id，防止会话固定攻击"""
+        self.regenerated = True
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """Cookie 中只保存随机的会话 id，会话数据保存在 SessionStore 中
+
+    会话有修改，或者剩余有效期不足一半时才写入数据库，普通请求只有一次主键查询。
+    会话清空后删除服务端记录和 Cookie，登出立即生效。
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and _SESSION_ID_RE.match(sid):
+            row = self.store.get(sid)
+            if row is not None:
+                try:
+                    return ServerSession(self.serializer.loads(row[0]), sid, row[1])
+                except ValueError:
+                    pass
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure,
+                                       samesite=samesite, httponly=httponly)
+            return
+
+        response.vary.add('Cookie')
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        now = time.time()
+        new_sid = session.sid is None or session.regenerated
+        if new_sid:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+            session.sid = secrets.token_urlsafe(32)
+            session.regenerated = False
+
+        if new_sid or session.modified or session.expires - now < lifetime / 2:
+            session.expires = now + lifetime
+            self.store.save(session.sid, self.serializer.dumps(dict(session)), session.expires)
+            # 浏览器会话级的 Cookie 只在 id 变化时设置；持久会话随服务端有效期一起延长
+            if new_sid or session.permanent:
+                response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                                    httponly=httponly, domain=domain, path=path,
+                                    secure=secure, samesite=samesite)
@@ -0,0 +1,160 @@
+import threading
+from collections import OrderedDict, deque
+
+from records import Interner
+
+
+class SocialGraph:
+    """关注关系图和首页关注动态
+
+    关注/粉丝两个方向都保存为 用户 id -> set 的邻接表，查询是否关注、粉丝数都是 O(1)。
+    用户名映射为连续的整数 id，集合中保存整数而不是各自的字符串副本。
+    每个用户的关注动态是一个按时间从新到旧、最多 feed_size 条的视频 id 队列：
+    作者上传新视频时推送到所有粉丝已生成的队列中 (写扩散)；粉丝数超过 fanout_limit 的
+    作者不推送，读取动态时再合并他们最近的视频 (读扩散)。队列在第一次读取时生成，
+    最多保留 max_feeds 个用户的队列，按最近使用淘汰。
+
+    作为 Catalog 的监听器使用，处理 reload / add / follow 事件。
+    """
+
+    def __init__(self, catalog, fanout_limit=10000, feed_size=500, max_feeds=10000):
+        self.catalog = catalog
+        self.fanout_limit = fanout_limit
+        self.feed_size = feed_size
+        self.max_feeds = max_feeds
+        self._lock = threading.Lock()
+        self._ids = Interner()
+        self._following = {}
+        self._followers = {}
+        self._feeds = OrderedDict()
+        # 每次关系或视频变化加一，生成队列期间有变化时不缓存结果
+        self._generation = 0
+
+    # 关系
+    def rebuild(self, pairs):
+        """pairs 为 [(被关注的用户名, 关注者用户名)]"""
+        ids = Interner()
+        following = {}
+        followers = {}
+        for target, follower in pairs:
+            target, follower = ids.id(target), ids.id(follower)
+            following.setdefault(follower, set()).add(target)
+            followers.setdefault(target, set()).add(follower)
+        with self._lock:
+            self._ids = ids
+            self._following = following
+            self._followers = followers
+            self._feeds.clear()
+            self._generation += 1
+
+    def set_following(self, follower, target, added):
+        with self._lock:
+            follower_id, target_id = self._ids.id(follower), self._ids.id(target)
+            if added:
+                self._following.setdefault(follower_id, set()).add(target_id)
+                self._followers.setdefault(target_id, set()).add(follower_id)
+            else:
+                self._following.get(follower_id, set()).discard(target_id)
+                self._followers.get(target_id, set()).discard(follower_id)
+            # 关注的人变了，该用户的动态需要重新合并
+            self._feeds.pop(follower, None)
+            self._generation += 1
+
+    def following(self, username):
+        with self._lock:
+            return frozenset(self._ids.names(self._following.get(self._ids.lookup(username), ())))
+
+    def followers(self, username):
+        with self._lock:
+            return frozenset(self._ids.names(self._followers.get(self._ids.lookup(username), ())))
+
+    def is_following(self, follower, target):
+        with self._lock:
+            return self._ids.lookup(target) in self._following.get(self._ids.lookup(follower), ())
+
+    def follower_count(self, username):
+        with self._lock:
+            return len(self._followers.get(self._ids.lookup(username), ()))
+
+    def _is_pull(self, author_id):
+        return len(self._followers.get(author_id, ())) > self.fanout_limit
+
+    # 动态
+    def publish(self, video):
+        """写扩散: 把新视频推送到作者各粉丝已生成的动态队列"""
+        with self._lock:
+            self._generation += 1
+            author = self._ids.lookup(video.get('author'))
+            if author is None or self._is_pull(author):
+                return
+            for follower in self._ids.names(self._followers.get(author, ())):
+                feed = self._feeds.get(follower)
+                if feed is not None:
+                    feed.appendleft(video['id'])
+
+    def _materialize(self, username):
+        with self._lock:
+            feed = self._feeds.get(username)
+            if feed is not None:
+                self._feeds.move_to_end(username)
+                return feed
+            generation = self._generation
+            authors = self._ids.names(a for a in self._following.get(self._ids.lookup(username), ())
+                                      if not self._is_pull(a))
+
+        # 合并各作者最近的视频，不持有锁，避免与 Catalog 的锁互相等待
+        position = self.catalog.position
+        candidates = []
+        for author in authors:
+            candidates.extend(self.catalog.recent_ids_by_author(author, self.feed_size))
+        candidates.sort(key=position, reverse=True)
+        feed = deque(candidates[:self.feed_size], maxlen=self.feed_size)
+
+        with self._lock:
+            if self._generation == generation:
+                self._feeds[username] = feed
+                while len(self._feeds) > self.max_feeds:
+                    self._feeds.popitem(last=False)
+        return feed
+
+    def feed(self, username, cursor=None, limit=24):
+        """返回 (视频列表, 下一页的 cursor)，cursor 为上一页最后一个视频的 id"""
+        before = None
+        if cursor is not None:
+            before = self.catalog.position(cursor)
+            if before is None:
+                return [], None
+
+        feed = self._materialize(username)
+        position = self.catalog.position
+        ids = []
+        for vid in list(feed):
+            if before is None or position(vid) < before:
+                ids.append(vid)
+                if len(ids) >= limit:
+                    break
+
+        with self._lock:
+            following = self._following.get(self._ids.lookup(username), ())
+            pull_authors = [a for a in following if self._is_pull(a)]
+            if len(ids) < limit and len(feed) == self.feed_size:
+                # 翻页超出了动态队列的长度，更早的视频直接从各作者的列表中读取
+                pull_authors = list(following)
+            pull_authors = self._ids.names(pull_authors)
+        for author in pull_authors:
+            videos, _ = self.catalog.page_videos(cursor, limit, author=author)
+            ids.extend(v['id'] for v in videos)
+
+        ids = sorted(set(ids), key=position, reverse=True)[:limit]
+        videos = [v for v in map(self.catalog.peek_video, ids) if v is not None]
+        next_cursor = ids[-1] if len(ids) == limit else None
+        return videos, next_cursor
+
+    def on_catalog_change(self, action, payload):
+        # 作为 Catalog 的监听器使用
+        if action == 'reload':
+            self.rebuild(self.catalog.follow_pairs())
+        elif action == 'add':
+            self.publish(payload)
+        elif action == 'follow':
+            self.set_following(*payload)
@@ -0,0 +1,828 @@
+import fcntl
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+
+
+# 视频表中单独成列的字段，其余字段序列化后放在 data 列
+VIDEO_COLUMNS = ('id', 'author', 'upload_date', 'views')
+USER_COLUMNS = ('id', 'username')
+
+# 只能通过 increment_views / toggle_member / add_comment 修改的字段，
+# update_video / update_user 写回时保留存储中的值，避免用旧副本覆盖并发的修改
+VIDEO_MANAGED_FIELDS = ('views', 'likes', 'favorites', 'comments', 'comment_count', 'liked_by', 'favorited_by')
+USER_MANAGED_FIELDS = ('followers', 'favorites', 'following')
+
+# 关系: 点赞 (视频 id, 用户名)、收藏 (视频 id, 用户 id)、关注 (被关注的用户名, 关注者用户名)
+# 以及对应的计数字段
+MEMBER_COUNTERS = {
+    'like': 'likes',
+    'favorite': 'favorites',
+    'follow': 'followers',
+}
+# JSON 存储中关系以列表形式保存在记录里，SQLite 存储中放在 members 表
+VIDEO_MEMBER_FIELDS = ('liked_by', 'favorited_by')
+USER_MEMBER_FIELDS = ('favorites', 'following')
+# 评论: JSON 存储中保存在记录的 comments 列表里，SQLite 存储中放在 comments 表，
+# 记录中只保留 comment_count
+VIDEO_COMMENT_FIELD = 'comments'
+COMMENT_COLUMNS = ('id',)
+
+
+def _split_row(record, columns):
+    data = {k: v for k, v in record.items() if k not in columns}
+    return [record.get(c) for c in columns] + [json.dumps(data, ensure_ascii=False)]
+
+
+def _join_row(row, columns):
+    record = dict(zip(columns, row[:len(columns)]))
+    record.update(json.loads(row[len(columns)] or '{}'))
+    return record
+
+
+def _load_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except:
+        return []
+
+
+def _dump_json(path, records):
+    # 先写临时文件再改名，其他进程不会读到写了一半的文件
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                                    dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            # 紧凑格式，不缩进，大目录的文件体积和解析时间都更小
+            json.dump(records, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def _page_comments(comments, cursor, limit):
+    # comments 从旧到新排列，返回从新到旧的一页和下一页的 cursor
+    end = len(comments)
+    if cursor is not None:
+        end = next((i for i in range(len(comments) - 1, -1, -1) if comments[i].get('id') == cursor), None)
+        if end is None:
+            return [], None
+    start = max(0, end - limit)
+    page = comments[start:end][::-1]
+    return page, (page[-1]['id'] if start > 0 and page else None)
+
+
+def _with_comment_count(video):
+    # 旧的 JSON 记录没有 comment_count
+    if video is not None and 'comment_count' not in video:
+        video['comment_count'] = len(video.get(VIDEO_COMMENT_FIELD, []))
+    return video
+
+
+def _preserve(record, current, fields):
+    # 受保护的字段取存储中的当前值
+    record = {k: v for k, v in record.items() if k not in fields}
+    record.update((k, current[k]) for k in fields if k in current)
+    return record
+
+
+def _file_signature(*paths):
+    # 用 (mtime, size) 判断文件是否被修改过
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+class JSONStore:
+    """旧的整文件 JSON 存储，每次写入都会重写整个文件
+
+    写入在 transaction() 中进行: 用 fcntl 文件锁在进程间互斥，事务内读到的是同一份快照，
+    提交时被修改的文件各自写入临时文件后改名。多个修改可以放在同一个事务中一次写入。
+    """
+
+    def __init__(self, data_file, users_file):
+        self.data_file = data_file
+        self.users_file = users_file
+        self.lock_file = data_file + '.lock'
+        # flock 按打开的文件生效，同一进程的多个线程还需要线程锁
+        self._thread_lock = threading.RLock()
+        self._local = threading.local()
+        # 如果用户文件不存在则创建
+        if not os.path.exists(self.users_file):
+            with open(self.users_file, 'w') as f:
+                json.dump([], f)
+
+    def signature(self):
+        return _file_signature(self.data_file, self.users_file)
+
+    def generation(self):
+        # 没有单独的变更计数，文件签名不变即内容不变
+        return self.signature()
+
+    def changes(self, since):
+        """没有变更记录: 代数与 since 相同时返回 (代数, [])，否则返回 None，由调用方整体重新加载"""
+        generation = self.generation()
+        return (generation, []) if generation == since else None
+
+    @contextmanager
+    def transaction(self):
+        if getattr(self._local, 'tx', None) is not None:
+            # 嵌套事务并入外层事务
+            yield
+            return
+        with self._thread_lock, open(self.lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._local.tx = {'records': {}, 'dirty': set()}
+            try:
+                yield
+                tx = self._local.tx
+                for path in tx['dirty']:
+                    _dump_json(path, tx['records'][path])
+            finally:
+                self._local.tx = None
+
+    def _load(self, path):
+        tx = getattr(self._local, 'tx', None)
+        if tx is None:
+            return _load_json(path)
+        if path not in tx['records']:
+            tx['records'][path] = _load_json(path)
+        return tx['records'][path]
+
+    def _save(self, path, records):
+        tx = getattr(self._local, 'tx', None)
+        if tx is None:
+            with self.transaction():
+                self._save(path, records)
+            return
+        tx['records'][path] = records
+        tx['dirty'].add(path)
+
+    # 视频
+    def list_videos(self):
+        return [_with_comment_count(v) for v in self._load(self.data_file)]
+
+    def get_video(self, vid):
+        return next((v for v in self.list_videos() if v['id'] == vid), None)
+
+    def add_video(self, video):
+        """id 已存在时返回 False"""
+        with self.transaction():
+            if self.get_video(video['id']) is not None:
+                return False
+            self.add_videos([video])
+            return True
+
+    def add_videos(self, new_videos):
+        with self.transaction():
+            videos = self.list_videos()
+            videos.extend(new_videos)
+            self._save(self.data_file, videos)
+
+    def update_video(self, video):
+        with self.transaction():
+            videos = self.list_videos()
+            for i, v in enumerate(videos):
+                if v['id'] == video['id']:
+                    videos[i] = _preserve(video, v, VIDEO_MANAGED_FIELDS)
+                    break
+            self._save(self.data_file, videos)
+
+    def list_videos_by_author(self, author):
+        return [v for v in self.list_videos() if v.get('author') == author]
+
+    def increment_views(self, vid, n=1):
+        self.increment_views_many({vid: n})
+
+    def increment_views_many(self, deltas):
+        with self.transaction():
+            videos = self.list_videos()
+            for v in videos:
+                if v['id'] in deltas:
+                    v['views'] = v.get('views', 0) + deltas[v['id']]
+            self._save(self.data_file, videos)
+
+    def count_videos(self):
+        return len(self.list_videos())
+
+    def save_videos(self, videos):
+        self._save(self.data_file, videos)
+
+    def add_comment(self, vid, comment):
+        """返回新的评论数，视频不存在时返回 None"""
+        with self.transaction():
+            videos = self.list_videos()
+            video = next((v for v in videos if v['id'] == vid), None)
+            if video is None:
+                return None
+            video.setdefault(VIDEO_COMMENT_FIELD, []).append(comment)
+            video['comment_count'] = len(video[VIDEO_COMMENT_FIELD])
+            self._save(self.data_file, videos)
+            return video['comment_count']
+
+    def page_comments(self, vid, cursor=None, limit=20):
+        """评论从新到旧分页，返回 (评论列表, 下一页的 cursor)，cursor 为上一页最后一条评论的 id"""
+        video = self.get_video(vid)
+        return _page_comments(video.get(VIDEO_COMMENT_FIELD, []) if video else [], cursor, limit)
+
+    def first_comments(self, vids, limit=20):
+        """一次读取多个视频的第一页评论，返回 {视频 id: (评论列表, 下一页的 cursor)}"""
+        wanted = set(vids)
+        return {v['id']: _page_comments(v.get(VIDEO_COMMENT_FIELD, []), None, limit)
+                for v in self.list_videos() if v['id'] in wanted}
+
+    # 用户
+    def list_users(self):
+        return self._load(self.users_file)
+
+    def get_user(self, user_id):
+        return next((u for u in self.list_users() if u['id'] == user_id), None)
+
+    def get_user_by_name(self, username):
+        return next((u for u in self.list_users() if u['username'] == username), None)
+
+    def add_user(self, user):
+        """用户名已存在时返回 False"""
+        with self.transaction():
+            users = self.list_users()
+            if any(u['username'] == user['username'] for u in users):
+                return False
+            users.append(user)
+            self._save(self.users_file, users)
+            return True
+
+    def update_user(self, user):
+        with self.transaction():
+            users = self.list_users()
+            for i, u in enumerate(users):
+                if u['id'] == user['id']:
+                    users[i] = _preserve(user, u, USER_MANAGED_FIELDS)
+                    break
+            self._save(self.users_file, users)
+
+    def save_users(self, users):
+        self._save(self.users_file, users)
+
+    # 点赞/收藏/关注
+    def _member_list(self, kind, target, member):
+        # 返回 (保存关系的列表, 列表中的元素, 带计数字段的记录)
+        videos = self.list_videos()
+        users = self.list_users()
+        if kind == 'like':
+            video = next((v for v in videos if v['id'] == target), None)
+            return (video.setdefault('liked_by', []) if video else None), member, video
+        if kind == 'favorite':
+            user = next((u for u in users if u['id'] == member), None)
+            video = next((v for v in videos if v['id'] == target), None)
+            return (user.setdefault('favorites', []) if user else None), target, video
+        if kind == 'follow':
+            user = next((u for u in users if u['username'] == member), None)
+            followed = next((u for u in users if u['username'] == target), None)
+            return (user.setdefault('following', []) if user else None), target, followed
+        raise ValueError(f"未知的关系类型: {kind}")
+
+    def toggle_member(self, kind, target, member):
+        """切换关系，返回 (是否为新增, 新的计数)；记录不存在时返回 (None, 0)"""
+        field = MEMBER_COUNTERS[kind]
+        with self.transaction():
+            items, item, counted = self._member_list(kind, target, member)
+            if items is None or counted is None:
+                return None, 0
+            added = item not in items
+            if added:
+                items.append(item)
+            else:
+                items.remove(item)
+            counted[field] = max(0, counted.get(field, 0) + (1 if added else -1))
+            if kind != 'follow':
+                self._save(self.data_file, self.list_videos())
+            if kind != 'like':
+                self._save(self.users_file, self.list_users())
+            return added, counted[field]
+
+    def has_member(self, kind, target, member):
+        items, item, _ = self._member_list(kind, target, member)
+        return bool(items) and item in items
+
+    def list_members(self, kind):
+        """返回 [(target, member)]"""
+        if kind == 'like':
+            return [(v['id'], name) for v in self.list_videos() for name in v.get('liked_by', [])]
+        if kind == 'favorite':
+            return [(vid, u['id']) for u in self.list_users() for vid in u.get('favorites', [])]
+        if kind == 'follow':
+            return [(name, u['username']) for u in self.list_users() for name in u.get('following', [])]
+        raise ValueError(f"未知的关系类型: {kind}")
+
+
+# changes 表保留的最近变更条数，落后更多的进程整体重新加载
+CHANGE_LOG_SIZE = 100000
+
+
+class SQLiteStore:
+    """SQLite (WAL 模式) 存储，按主键读取和逐行更新
+
+    点赞/收藏/关注关系放在 members 表中，以 (kind, target, member) 为主键，
+    切换和查询都是索引查找，不随点赞人数增长。评论逐条追加到 comments 表，
+    视频记录中只维护 comment_count，按 (video_id, seq) 索引从新到旧分页。读-改-写在 BEGIN IMMEDIATE 事务中进行，
+    多个进程并发修改同一条记录时不会丢失更新。
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS videos (
+        id TEXT PRIMARY KEY,
+        author TEXT,
+        upload_date TEXT,
+        views INTEGER NOT NULL DEFAULT 0,
+        data TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_videos_author ON videos(author);
+    CREATE TABLE IF NOT EXISTS users (
+        id TEXT PRIMARY KEY,
+        username TEXT NOT NULL UNIQUE,
+        data TEXT
+    );
+    CREATE TABLE IF NOT EXISTS members (
+        kind TEXT NOT NULL,
+        target TEXT NOT NULL,
+        member TEXT NOT NULL,
+        PRIMARY KEY (kind, target, member)
+    );
+    CREATE INDEX IF NOT EXISTS idx_members_member ON members(kind, member);
+    CREATE TABLE IF NOT EXISTS comments (
+        seq INTEGER PRIMARY KEY,
+        video_id TEXT NOT NULL,
+        id TEXT NOT NULL,
+        data TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_comments_video ON comments(video_id, seq);
+    CREATE INDEX IF NOT EXISTS idx_comments_id ON comments(id);
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    CREATE TABLE IF NOT EXISTS changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        key TEXT NOT NULL
+    );
+    """ + ''.join(
+        # 视频、用户和收藏/关注关系的每一行变化都记入 changes，与修改在同一事务中提交。
+        # 其他进程按 seq 读取之后的变化，只重新读取变化的记录；点赞不在目录缓存中，不记录
+        f"""
+    CREATE TRIGGER IF NOT EXISTS changes_{table}_{event} AFTER {event} ON {table} {when}
+    BEGIN INSERT INTO changes (kind, key) VALUES ({values}); END;"""
+        for table, event, when, values in (
+            ('videos', 'INSERT', '', "'video', NEW.id"),
+            ('videos', 'UPDATE', '', "'video', NEW.id"),
+            ('videos', 'DELETE', '', "'video_delete', OLD.id"),
+            ('users', 'INSERT', '', "'user', NEW.id"),
+            ('users', 'UPDATE', '', "'user', NEW.id"),
+            ('users', 'DELETE', '', "'user_delete', OLD.id"),
+            ('members', 'INSERT', "WHEN NEW.kind != 'like'", "NEW.kind, NEW.member"),
+            ('members', 'DELETE', "WHEN OLD.kind != 'like'", "OLD.kind, OLD.member"),
+        )) + f"""
+    CREATE TRIGGER IF NOT EXISTS changes_prune AFTER INSERT ON changes WHEN NEW.seq % 1000 = 0
+    BEGIN DELETE FROM changes WHERE seq <= NEW.seq - {CHANGE_LOG_SIZE}; END;"""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        # 每个线程一个连接，sqlite3 连接不能跨线程共享
+        self._local = threading.local()
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def signature(self):
+        # WAL 模式下提交先写入 -wal 文件，检查点后才写回主文件
+        return _file_signature(self.db_file, self.db_file + '-wal')
+
+    def generation(self):
+        """变更代数 (changes 表最后的 seq)，由触发器维护；与 signature() 不同，检查点和重启不会改变它"""
+        row = self._conn().execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        return row[0] if row else 0
+
+    def changes(self, since):
+        """返回 (当前代数, [(类型, 键)])，包含 since 之后所有变化过的视频、用户和关系成员；
+        since 之后的记录已被清理时返回 None
+
+        类型为 video / user (视频、用户 id)，favorite (收藏者的用户 id)，follow (关注者的用户名)，
+        video_delete / user_delete (被删除的 id)。
+        """
+        conn = self._conn()
+        # 在同一个读事务中读取代数和变化，两者对应同一个数据库版本
+        own = not conn.in_transaction
+        if own:
+            conn.execute('BEGIN')
+        try:
+            generation = self.generation()
+            if generation == since:
+                return generation, []
+            oldest = conn.execute('SELECT MIN(seq) FROM changes').fetchone()[0]
+            if since is None or since > generation or oldest is None or oldest > since + 1:
+                return None
+            rows = conn.execute(
+                'SELECT kind, key FROM changes WHERE seq > ? AND seq <= ? GROUP BY kind, key ORDER BY MIN(seq)',
+                (since, generation)).fetchall()
+        finally:
+            if own:
+                conn.execute('COMMIT')
+        return generation, rows
+
+    @contextmanager
+    def transaction(self):
+        conn = self._conn()
+        if conn.in_transaction:
+            # 嵌套事务并入外层事务
+            yield
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _write_many(self, statements):
+        with self.transaction():
+            conn = self._conn()
+            for sql, params in statements:
+                conn.execute(sql, params)
+
+    def _video_row(self, video):
+        return _split_row({k: v for k, v in video.items()
+                           if k not in VIDEO_MEMBER_FIELDS and k != VIDEO_COMMENT_FIELD},
+                          VIDEO_COLUMNS)
+
+    def _user_row(self, user):
+        return _split_row({k: v for k, v in user.items() if k not in USER_MEMBER_FIELDS},
+                          USER_COLUMNS)
+
+    # 视频
+    def list_videos(self):
+        rows = self._conn().execute(
+            'SELECT id, author, upload_date, views, data FROM videos ORDER BY rowid')
+        return [_join_row(r, VIDEO_COLUMNS) for r in rows]
+
+    def get_video(self, vid):
+        row = self._conn().execute(
+            'SELECT id, author, upload_date, views, data FROM videos WHERE id = ?',
+            (vid,)).fetchone()
+        return _join_row(row, VIDEO_COLUMNS) if row else None
+
+    def get_videos(self, vids, chunk=500):
+        """按 id 批量读取视频，按加入顺序返回，不存在的 id 跳过"""
+        vids = list(vids)
+        videos = []
+        for i in range(0, len(vids), chunk):
+            part = vids[i:i + chunk]
+            rows = self._conn().execute(
+                'SELECT rowid, id, author, upload_date, views, data FROM videos WHERE id IN '
+                f"({', '.join('?' * len(part))})", part)
+            videos += [(r[0], _join_row(r[1:], VIDEO_COLUMNS)) for r in rows]
+        videos.sort(key=lambda item: item[0])
+        return [v for _, v in videos]
+
+    def add_video(self, video):
+        """id 已存在时返回 False，由主键保证，并发加入同一个 id 时只有一个成功"""
+        try:
+            self._conn().execute(
+                'INSERT INTO videos (id, author, upload_date, views, data) VALUES (?, ?, ?, ?, ?)',
+                self._video_row(video))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def add_videos(self, videos):
+        self._write_many(
+            ('INSERT INTO videos (id, author, upload_date, views, data) VALUES (?, ?, ?, ?, ?)',
+             self._video_row(v))
+            for v in videos)
+
+    def _put_video(self, video):
+        # views 只通过 increment_views 修改，不写入该列
+        vid, author, upload_date, _, data = self._video_row(video)
+        self._conn().execute(
+            'UPDATE videos SET author = ?, upload_date = ?, data = ? WHERE id = ?',
+            (author, upload_date, data, vid))
+
+    def update_video(self, video):
+        with self.transaction():
+            current = self.get_video(video['id'])
+            if current is not None:
+                self._put_video(_preserve(video, current, VIDEO_MANAGED_FIELDS))
+
+    def list_videos_by_author(self, author):
+        rows = self._conn().execute(
+            'SELECT id, author, upload_date, views, data FROM videos WHERE author = ? ORDER BY rowid',
+            (author,))
+        return [_join_row(r, VIDEO_COLUMNS) for r in rows]
+
+    def increment_views(self, vid, n=1):
+        self._conn().execute('UPDATE videos SET views = views + ? WHERE id = ?', (n, vid))
+
+    def increment_views_many(self, deltas):
+        self._write_many(
+            ('UPDATE videos SET views = views + ? WHERE id = ?', (n, vid))
+            for vid, n in deltas.items())
+
+    def count_videos(self):
+        return self._conn().execute('SELECT COUNT(*) FROM videos').fetchone()[0]
+
+    def save_videos(self, videos):
+        statements = [('DELETE FROM videos', ())]
+        statements += [
+            ('INSERT INTO videos (id, author, upload_date, views, data) VALUES (?, ?, ?, ?, ?)',
+             self._video_row(v))
+            for v in videos
+        ]
+        self._write_many(statements)
+
+    def add_comment(self, vid, comment):
+        """追加一条评论并把 comment_count 加一，返回新的评论数，视频不存在时返回 None"""
+        with self.transaction():
+            video = self.get_video(vid)
+            if video is None:
+                return None
+            self._conn().execute(
+                'INSERT INTO comments (video_id, id, data) VALUES (?, ?, ?)',
+                [vid] + _split_row(comment, COMMENT_COLUMNS))
+            video['comment_count'] = video.get('comment_count', 0) + 1
+            self._put_video(video)
+            return video['comment_count']
+
+    def page_comments(self, vid, cursor=None, limit=20):
+        """评论从新到旧分页，返回 (评论列表, 下一页的 cursor)，cursor 为上一页最后一条评论的 id"""
+        conn = self._conn()
+        if cursor is None:
+            rows = conn.execute(
+                'SELECT id, data FROM comments WHERE video_id = ? ORDER BY seq DESC LIMIT ?',
+                (vid, limit + 1)).fetchall()
+        else:
+            rows = conn.execute(
+                'SELECT id, data FROM comments WHERE video_id = ? AND seq < '
+                '(SELECT seq FROM comments WHERE id = ? AND video_id = ?) ORDER BY seq DESC LIMIT ?',
+                (vid, cursor, vid, limit + 1)).fetchall()
+            if not rows and conn.execute('SELECT 1 FROM comments WHERE id = ? AND video_id = ?',
+                                         (cursor, vid)).fetchone() is None:
+                return [], None
+        page = [_join_row(r, COMMENT_COLUMNS) for r in rows[:limit]]
+        return page, (page[-1]['id'] if len(rows) > limit else None)
+
+    def first_comments(self, vids, limit=20, chunk=200):
+        """一次读取多个视频的第一页评论，返回 {视频 id: (评论列表, 下一页的 cursor)}
+
+        每个视频是一个按索引倒序取 limit + 1 条的子查询，用 UNION ALL 合并成一条语句。
+        """
+        vids = list(dict.fromkeys(vids))
+        rows = {vid: [] for vid in vids}
+        conn = self._conn()
+        for i in range(0, len(vids), chunk):
+            part = vids[i:i + chunk]
+            sql = ' UNION ALL '.join(
+                ['SELECT * FROM (SELECT video_id, id, data FROM comments WHERE video_id = ? '
+                 'ORDER BY seq DESC LIMIT ?)'] * len(part))
+            params = [p for vid in part for p in (vid, limit + 1)]
+            for row in conn.execute(sql, params):
+                rows[row[0]].append(row[1:])
+        result = {}
+        for vid, items in rows.items():
+            page = [_join_row(r, COMMENT_COLUMNS) for r in items[:limit]]
+            result[vid] = page, (page[-1]['id'] if len(items) > limit else None)
+        return result
+
+    # 用户
+    def list_users(self):
+        rows = self._conn().execute('SELECT id, username, data FROM users ORDER BY rowid')
+        return [_join_row(r, USER_COLUMNS) for r in rows]
+
+    def get_user(self, user_id):
+        row = self._conn().execute(
+            'SELECT id, username, data FROM users WHERE id = ?', (user_id,)).fetchone()
+        return _join_row(row, USER_COLUMNS) if row else None
+
+    def get_user_by_name(self, username):
+        row = self._conn().execute(
+            'SELECT id, username, data FROM users WHERE username = ?', (username,)).fetchone()
+        return _join_row(row, USER_COLUMNS) if row else None
+
+    def get_users(self, user_ids, chunk=500):
+        """按 id 批量读取用户，不存在的 id 跳过"""
+        user_ids = list(user_ids)
+        users = []
+        for i in range(0, len(user_ids), chunk):
+            part = user_ids[i:i + chunk]
+            rows = self._conn().execute(
+                f"SELECT id, username, data FROM users WHERE id IN ({', '.join('?' * len(part))})", part)
+            users += [_join_row(r, USER_COLUMNS) for r in rows]
+        return users
+
+    def add_user(self, user):
+        """用户名已存在时返回 False，由 username 的唯一索引保证，并发注册同名用户时只有一个成功"""
+        try:
+            self._conn().execute(
+                'INSERT INTO users (id, username, data) VALUES (?, ?, ?)',
+                self._user_row(user))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def _put_user(self, user):
+        user_id, username, data = self._user_row(user)
+        self._conn().execute(
+            'UPDATE users SET username = ?, data = ? WHERE id = ?',
+            (username, data, user_id))
+
+    def update_user(self, user):
+        with self.transaction():
+            current = self.get_user(user['id'])
+            if current is not None:
+                self._put_user(_preserve(user, current, USER_MANAGED_FIELDS))
+
+    def save_users(self, users):
+        statements = [('DELETE FROM users', ())]
+        statements += [
+            ('INSERT INTO users (id, username, data) VALUES (?, ?, ?)',
+             self._user_row(u))
+            for u in users
+        ]
+        self._write_many(statements)
+
+    # 点赞/收藏/关注
+    def toggle_member(self, kind, target, member):
+        """切换关系，返回 (是否为新增, 新的计数)；记录不存在时返回 (None, 0)"""
+        field = MEMBER_COUNTERS[kind]
+        with self.transaction():
+            conn = self._conn()
+            if kind == 'follow':
+                counted = self.get_user_by_name(target)
+            else:
+                counted = self.get_video(target)
+            if counted is None:
+                return None, 0
+            added = conn.execute(
+                'INSERT OR IGNORE INTO members (kind, target, member) VALUES (?, ?, ?)',
+                (kind, target, member)).rowcount == 1
+            if not added:
+                conn.execute(
+                    'DELETE FROM members WHERE kind = ? AND target = ? AND member = ?',
+                    (kind, target, member))
+            counted[field] = max(0, counted.get(field, 0) + (1 if added else -1))
+            if kind == 'follow':
+                self._put_user(counted)
+            else:
+                self._put_video(counted)
+            return added, counted[field]
+
+    def has_member(self, kind, target, member):
+        return self._conn().execute(
+            'SELECT 1 FROM members WHERE kind = ? AND target = ? AND member = ?',
+            (kind, target, member)).fetchone() is not None
+
+    def list_members(self, kind):
+        """返回 [(target, member)]，按加入顺序"""
+        return self._conn().execute(
+            'SELECT target, member FROM members WHERE kind = ? ORDER BY rowid', (kind,)).fetchall()
+
+    def member_targets(self, kind, member):
+        """member 收藏的视频 id / 关注的用户名，按加入顺序"""
+        return [r[0] for r in self._conn().execute(
+            'SELECT target FROM members WHERE kind = ? AND member = ? ORDER BY rowid', (kind, member))]
+
+    # 元数据
+    def get_meta(self, key, default=None):
+        row = self._conn().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self._conn().execute(
+            'INSERT INTO meta (key, value) VALUES (?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET value = excluded.value', (key, value))
+
+
+def migrate_json(store, data_file, users_file):
+    """把旧的 videos.json / users.json 一次性导入 SQLite，已导入过则跳过"""
+    if store.get_meta('json_migrated'):
+        return False
+    videos = _load_json(data_file)
+    users = _load_json(users_file)
+    statements = [
+        ('INSERT OR IGNORE INTO videos (id, author, upload_date, views, data) VALUES (?, ?, ?, ?, ?)',
+         _split_row(v, VIDEO_COLUMNS))
+        for v in videos
+    ]
+    statements += [
+        ('INSERT OR IGNORE INTO users (id, username, data) VALUES (?, ?, ?)',
+         _split_row(u, USER_COLUMNS))
+        for u in users
+    ]
+    statements.append((
+        "INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)",
+        (str(len(videos) + len(users)),)))
+    store._write_many(statements)
+    return True
+
+
+def migrate_members(store):
+    """把记录中的 liked_by / favorites / following 列表移到 members 表，已迁移过则跳过"""
+    if store.get_meta('members_migrated'):
+        return False
+    statements = []
+    for v in store.list_videos():
+        statements += [
+            ('INSERT OR IGNORE INTO members (kind, target, member) VALUES (?, ?, ?)',
+             ('like', v['id'], name))
+            for name in v.get('liked_by', [])
+        ]
+        if any(field in v for field in VIDEO_MEMBER_FIELDS):
+            vid, author, upload_date, _, data = store._video_row(v)
+            statements.append(('UPDATE videos SET data = ? WHERE id = ?', (data, vid)))
+    for u in store.list_users():
+        # 收藏以用户的 favorites 为准，视频上的 favorited_by 只是冗余
+        statements += [
+            ('INSERT OR IGNORE INTO members (kind, target, member) VALUES (?, ?, ?)',
+             ('favorite', vid, u['id']))
+            for vid in u.get('favorites', [])
+        ]
+        statements += [
+            ('INSERT OR IGNORE INTO members (kind, target, member) VALUES (?, ?, ?)',
+             ('follow', name, u['username']))
+            for name in u.get('following', [])
+        ]
+        if any(field in u for field in USER_MEMBER_FIELDS):
+            user_id, username, data = store._user_row(u)
+            statements.append(('UPDATE users SET data = ? WHERE id = ?', (data, user_id)))
+    statements.append((
+        "INSERT OR REPLACE INTO meta (key, value) VALUES ('members_migrated', ?)",
+        (str(len(statements)),)))
+    store._write_many(statements)
+    return True
+
+
+def migrate_comments(store):
+    """把视频记录中的 comments 列表移到 comments 表并写入 comment_count，已迁移过则跳过"""
+    if store.get_meta('comments_migrated'):
+        return False
+    statements = []
+    for v in store.list_videos():
+        comments = v.get(VIDEO_COMMENT_FIELD)
+        if comments is None and 'comment_count' in v:
+            continue
+        statements += [
+            ('INSERT INTO comments (video_id, id, data) VALUES (?, ?, ?)',
+             [v['id']] + _split_row(c, COMMENT_COLUMNS))
+            for c in comments or []
+        ]
+        # 列表中就是全部评论，记录里已有的 comment_count 只在没有列表时保留
+        if comments is not None:
+            v['comment_count'] = len(comments)
+        else:
+            v.setdefault('comment_count', 0)
+        vid, author, upload_date, _, data = store._video_row(v)
+        statements.append(('UPDATE videos SET data = ? WHERE id = ?', (data, vid)))
+    statements.append((
+        "INSERT OR REPLACE INTO meta (key, value) VALUES ('comments_migrated', ?)",
+        (str(len(statements)),)))
+    store._write_many(statements)
+    return True
+
+
+def open_store(config):
+    """根据 STORAGE_BACKEND 配置创建存储后端"""
+    backend = config.get('STORAGE_BACKEND', 'sqlite')
+    if backend == 'json':
+        return JSONStore(config['DATA_FILE'], config['USERS_FILE'])
+    if backend == 'sqlite':
+        store = SQLiteStore(config['DATABASE_FILE'])
+        migrate_json(store, config['DATA_FILE'], config['USERS_FILE'])
+        migrate_members(store)
+        migrate_comments(store)
+        return store
+    raise ValueError(f"未知的存储后端: {backend}")
@@ -0,0 +1,169 @@
+import mimetypes
+import os
+import uuid
+
+from werkzeug.http import http_date
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file
+
+
+VIDEO_MIMETYPES = {
+    'mp4': 'video/mp4',
+    'webm': 'video/webm',
+    'mkv': 'video/x-matroska',
+}
+
+CHUNK_SIZE = 256 * 1024
+# 合并后最多返回的范围数，超过时按整个文件返回 200
+MAX_RANGES = 16
+
+
+def guess_mimetype(path):
+    ext = path.rsplit('.', 1)[-1].lower()
+    return VIDEO_MIMETYPES.get(ext) or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+def file_etag(st):
+    return f"{st.st_size:x}-{st.st_mtime_ns:x}"
+
+
+def _iter_range(f, start, length):
+    try:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def _iter_multipart(path, parts, boundary, mimetype, size):
+    with open(path, 'rb') as f:
+        for start, stop in parts:
+            yield (f"\r\n--{boundary}\r\n"
+                   f"Content-Type: {mimetype}\r\n"
+                   f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n").encode()
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                data = f.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+
+def _multipart_length(parts, boundary, mimetype, size):
+    length = len(f"\r\n--{boundary}--\r\n")
+    for start, stop in parts:
+        length += len(f"\r\n--{boundary}\r\n"
+                      f"Content-Type: {mimetype}\r\n"
+                      f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n")
+        length += stop - start
+    return length
+
+
+def _resolve_ranges(rng, size):
+    # werkzeug 的 Range.ranges 为 [(begin, end)]，end 不包含在内；后缀范围 begin 为负数
+    parts = []
+    for begin, end in rng.ranges:
+        if begin < 0:
+            start, stop = max(0, size + begin), size
+        else:
+            start, stop = begin, size if end is None else min(end, size)
+        if start < stop:
+            parts.append((start, stop))
+    # 排序后合并重叠和相邻的范围，bytes=0-,0-,0- 这样的请求不会把同一段数据发送多次
+    merged = []
+    for start, stop in sorted(parts):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def _if_range_matches(request, etag, mtime):
+    if_range = request.if_range
+    if if_range.etag is not None:
+        # If-Range 只能使用强校验
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return int(mtime) <= if_range.date.timestamp()
+    return True
+
+
+def send_video(request, path, max_age=86400, etag=None, accel_redirect=None, sendfile_header=None,
+               max_ranges=MAX_RANGES):
+    """发送视频文件，支持单个/多个 Range、ETag 和 Last-Modified 条件请求
+
+    多个范围先合并重叠和相邻的部分，合并后仍超过 max_ranges 个时忽略 Range，返回整个文件。
+
+    accel_redirect 不为空时返回 X-Accel-Redirect，由 nginx 读取文件并处理 Range；
+    sendfile_header (例如 'X-Sendfile') 用于 Apache/lighttpd。否则整段到文件末尾的
+    响应使用 wsgi.file_wrapper，gunicorn 等服务器会用 os.sendfile 直接从文件发送。
+    """
+    st = os.stat(path)
+    size = st.st_size
+    etag = etag or file_etag(st)
+    mimetype = guess_mimetype(path)
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(st.st_mtime),
+        'Cache-Control': f'public, max-age={max_age}',
+        'Accept-Ranges': 'bytes',
+    }
+
+    # 条件请求
+    if request.if_none_match:
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers=headers)
+    elif request.if_modified_since is not None:
+        if int(st.st_mtime) <= request.if_modified_since.timestamp():
+            return Response(status=304, headers=headers)
+
+    if accel_redirect:
+        headers['X-Accel-Redirect'] = accel_redirect
+        return Response(status=200, headers=headers, mimetype=mimetype)
+    if sendfile_header:
+        headers[sendfile_header] = path
+        return Response(status=200, headers=headers, mimetype=mimetype)
+
+    rng = request.range
+    if rng is not None and rng.units == 'bytes' and _if_range_matches(request, etag, st.st_mtime):
+        parts = _resolve_ranges(rng, size)
+        if not parts:
+            headers['Content-Range'] = f"bytes */{size}"
+            return Response(status=416, headers=headers)
+
+        if len(parts) == 1:
+            start, stop = parts[0]
+            headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+            headers['Content-Length'] = str(stop - start)
+            f = open(path, 'rb')
+            if stop == size:
+                # 一直到文件末尾，可以交给 file_wrapper (sendfile)
+                f.seek(start)
+                body = wrap_file(request.environ, f, CHUNK_SIZE)
+            else:
+                body = _iter_range(f, start, stop - start)
+            return Response(body, status=206, headers=headers, mimetype=mimetype,
+                            direct_passthrough=True)
+
+        if len(parts) <= max_ranges:
+            boundary = uuid.uuid4().hex
+            headers['Content-Length'] = str(_multipart_length(parts, boundary, mimetype, size))
+            return Response(_iter_multipart(path, parts, boundary, mimetype, size), status=206,
+                            headers=headers,
+                            content_type=f"multipart/byteranges; boundary={boundary}",
+                            direct_passthrough=True)
+        # 范围过多，按没有 Range 的请求返回整个文件
+
+    headers['Content-Length'] = str(size)
+    body = wrap_file(request.environ, open(path, 'rb'), CHUNK_SIZE)
+    return Response(body, status=200, headers=headers, mimetype=mimetype, direct_passthrough=True)
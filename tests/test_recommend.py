@@ -0,0 +1,47 @@
+import random
+import unittest
+
+import recommend
+
+
+def _pairs(seed=1, users=40, items=30, per_user=(1, 25)):
+    rng = random.Random(seed)
+    pairs = []
+    for u in range(users):
+        for i in rng.sample(range(items), rng.randint(*per_user)):
+            pairs.append((f"v{i:03d}", f"user{u:03d}"))
+    # 重复的互动只算一次
+    pairs += pairs[:20]
+    rng.shuffle(pairs)
+    return pairs
+
+
+def _scores(table):
+    return {item: dict(related) for item, related in table.items()}
+
+
+@unittest.skipIf(recommend.np is None, "需要 NumPy")
+class RelatedBackendTest(unittest.TestCase):
+    """NumPy 和纯 Python 两种实现对同样的输入给出相同的相关视频和相似度"""
+
+    def assertSameTable(self, pairs, max_user_items):
+        top_k = 100
+        expected = _scores(recommend._related_python(pairs, top_k, max_user_items))
+        actual = _scores(recommend._related_numpy(pairs, top_k, max_user_items, batch_cells=64))
+        self.assertEqual(set(expected), set(actual))
+        for item, related in expected.items():
+            self.assertEqual(set(related), set(actual[item]), item)
+            for other, score in related.items():
+                self.assertAlmostEqual(score, actual[item][other], places=3, msg=(item, other))
+
+    def test_same_scores_without_cap(self):
+        self.assertSameTable(_pairs(), max_user_items=500)
+
+    def test_same_scores_with_user_cap(self):
+        # 大部分用户互动的视频数超过上限，两种实现必须保留同一批视频
+        pairs = _pairs(seed=2, per_user=(5, 25))
+        self.assertSameTable(pairs, max_user_items=4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+import hashlib
+import os
+import stat
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import media
+
+
+class ThumbnailCache:
+    """按宽度档位生成缩略图的缩小版本 (WebP / JPEG)，保存在磁盘缓存中
+
+    变体在第一次请求时由线程池调用 ffmpeg 生成，同一变体同时只生成一次，其他请求等待同一个结果。
+    缓存文件名包含原图的版本 (mtime, size)，原图替换后旧变体不再命中，由淘汰删除。
+    缓存总大小超过 max_bytes 时按最近使用时间淘汰最旧的文件；使用时间记录在文件的 mtime 上，
+    重启后扫描缓存目录恢复顺序。多个进程共用缓存目录时各自统计，被其他进程删除的变体会重新生成。
+    """
+
+    def __init__(self, source_dir, cache_dir, widths=(160, 320, 640), max_bytes=512 * 1024 * 1024,
+                 workers=2, timeout=10.0, quality=80, touch_interval=300):
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self.widths = sorted(widths)
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.timeout = timeout
+        self.quality = quality
+        self.touch_interval = touch_interval
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._inflight = {}
+        self._pool = None
+        self._pid = None
+        # ffmpeg 没有编译 libwebp 时第一次失败后关闭 WebP
+        self.webp = True
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        # 按 mtime 从旧到新恢复 LRU 顺序，清理很久以前中断留下的临时文件
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+                if name.startswith('.'):
+                    if time.time() - st.st_mtime > 3600:
+                        os.remove(path)
+                    continue
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+        entries.sort()
+        with self._lock:
+            for mtime, name, size in entries:
+                self._entries[name] = [size, mtime]
+                self._bytes += size
+            self._evict()
+
+    def _executor(self):
+        # fork 出来的 worker 进程没有父进程的线程，按 pid 重新创建线程池
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix='thumbnail')
+                    self._inflight = {}
+                    self._pid = os.getpid()
+        return self._pool
+
+    def bucket(self, width):
+        """不小于 width 的最小档位，超过最大档位时取最大档位"""
+        return next((w for w in self.widths if w >= width), self.widths[-1])
+
+    def source_path(self, name):
+        # 只接受缩略图目录下的文件名
+        if not name or '/' in name or '\\' in name or name.startswith('.'):
+            return None
+        return os.path.join(self.source_dir, name)
+
+    def version(self, name):
+        """原图的版本号，用于 URL 和缓存文件名；原图不存在时返回 None"""
+        path = self.source_path(name)
+        try:
+            st = os.stat(path) if path else None
+        except (OSError, ValueError):
+            return None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            return None
+        return hashlib.blake2b(f"{st.st_mtime_ns}:{st.st_size}".encode(), digest_size=6).hexdigest()
+
+    def get(self, name, width, webp=False):
+        """返回 (变体文件路径, 原图版本)；生成失败或超时返回 (None, 版本)，原图不存在返回 (None, None)
+
+        webp 为 True 时优先返回 WebP，WebP 生成失败时返回 JPEG。路径的扩展名即格式。
+        """
+        version = self.version(name)
+        if version is None:
+            return None, None
+        if webp and self.webp:
+            path, finished = self._get(name, version, width, 'webp')
+            if path is not None or not finished:
+                return path, version
+            path, finished = self._get(name, version, width, 'jpg')
+            if path is not None:
+                self.webp = False
+            return path, version
+        return self._get(name, version, width, 'jpg')[0], version
+
+    def _get(self, name, version, width, ext):
+        # 返回 (变体文件路径, 是否已生成完成)；等待超时时为 (None, False)
+        stem = os.path.splitext(name)[0]
+        key = f"{stem}.{version}.{width}.{ext}"
+        path = os.path.join(self.cache_dir, key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                now = time.time()
+                touch = now - entry[1] > self.touch_interval
+                if touch:
+                    entry[1] = now
+        # 可能已被其他进程淘汰，这时重新生成
+        if entry is not None and os.path.exists(path):
+            with self._lock:
+                self.hits += 1
+            if touch:
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+            return path, True
+
+        pool = self._executor()
+        with self._lock:
+            self.misses += 1
+            future = self._inflight.get(key)
+            if future is None:
+                future = pool.submit(self._generate, name, key, width)
+                self._inflight[key] = future
+        try:
+            ok = future.result(self.timeout)
+        except TimeoutError:
+            return None, False
+        except OSError:
+            ok = False
+        return (path if ok else None), True
+
+    def _generate(self, name, key, width):
+        path = os.path.join(self.cache_dir, key)
+        # 扩展名决定输出格式，临时文件保留扩展名
+        tmp_path = os.path.join(self.cache_dir, f".{uuid.uuid4().hex}{os.path.splitext(key)[1]}")
+        try:
+            ok = media.resize_image(self.source_path(name), tmp_path, width, quality=self.quality)
+            if ok:
+                os.replace(tmp_path, path)
+                size = os.path.getsize(path)
+            with self._lock:
+                if not ok:
+                    self.failures += 1
+                    return False
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self._bytes -= old[0]
+                self._entries[key] = [size, time.time()]
+                self._bytes += size
+                self._evict()
+            return True
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _evict(self):
+        # 调用方持有锁
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            key, (size, _) = self._entries.popitem(last=False)
+            self._bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, key))
+            except OSError:
+                pass
+
+    def size(self):
+        """缓存文件的总字节数"""
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,267 @@
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+
+CHUNK_SIZE = 1024 * 1024
+
+_UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadError(Exception):
+    """上传出错，status 为对应的 HTTP 状态码，offset 为服务端已保存的字节数"""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.offset = offset
+
+
+def parse_checksum(value):
+    """解析 'sha256:<hex>' 形式的校验值，返回 (算法, 十六进制摘要)"""
+    if not value:
+        return None
+    algo, sep, digest = value.replace(' ', ':', 1).partition(':')
+    algo = algo.lower()
+    if not sep or algo not in hashlib.algorithms_guaranteed or algo.startswith('shake'):
+        raise UploadError(f"不支持的校验算法: {algo}")
+    digest = digest.strip().lower()
+    if not re.fullmatch(r'[0-9a-f]+', digest):
+        raise UploadError("校验值格式错误")
+    return algo, digest
+
+
+def publish_file(src, folder, filename):
+    """把 src 以不重复的文件名放入 folder，返回最终文件名
+
+    用 os.link 创建目标文件，文件名已存在时失败而不会覆盖，并发上传同名文件时
+    不需要先检查再写入。跨文件系统时退回到 O_EXCL 创建后复制。
+    """
+    name, ext = os.path.splitext(filename)
+    counter = 1
+    while True:
+        target = os.path.join(folder, filename)
+        try:
+            try:
+                os.link(src, target)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                with os.fdopen(fd, 'wb') as dst, open(src, 'rb') as f:
+                    shutil.copyfileobj(f, dst, CHUNK_SIZE)
+            os.chmod(target, 0o644)
+            return filename
+        except FileExistsError:
+            filename = f"{name}_{counter}{ext}"
+            counter += 1
+
+
+class UploadManager:
+    """可断点续传的分片上传
+
+    create 创建上传并按总大小预分配 <id>.part，状态保存在 <id>.json；
+    write 从请求流中按 CHUNK_SIZE 读取，直接 pwrite 到文件的对应偏移，内存占用固定。
+    偏移必须等于已保存的字节数，连接中断后客户端查询偏移再从该位置继续。
+    写入期间对 .part 文件加 flock，多进程部署时同一上传不会被并发写入。
+    全部写完后 complete 校验 (可选) 并用硬链接原子地放入上传目录。
+    """
+
+    def __init__(self, folder, max_size, expire_after=24 * 3600):
+        self.folder = folder
+        self.max_size = max_size
+        self.expire_after = expire_after
+        self._lock = threading.Lock()
+        # 本进程内的增量校验状态: upload_id -> (偏移, hasher)
+        self._hashers = {}
+        os.makedirs(folder, exist_ok=True)
+
+    def _paths(self, upload_id):
+        if not _UPLOAD_ID_RE.match(upload_id or ''):
+            raise UploadError("上传不存在", 404)
+        base = os.path.join(self.folder, upload_id)
+        return base + '.json', base + '.part'
+
+    def _save_state(self, state):
+        state_path, _ = self._paths(state['id'])
+        tmp_path = state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, state_path)
+
+    def get(self, upload_id):
+        state_path, _ = self._paths(upload_id)
+        try:
+            with open(state_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            raise UploadError("上传不存在", 404)
+
+    def create(self, filename, size, owner, checksum=None, metadata=None):
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError("文件大小无效")
+        if size > self.max_size:
+            raise UploadError("文件过大", 413)
+        parsed = parse_checksum(checksum)
+        self.expire()
+
+        upload_id = uuid.uuid4().hex
+        _, data_path = self._paths(upload_id)
+        fd = os.open(data_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            # 预分配磁盘空间，空间不足时在开始上传前就报错
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+        except OSError:
+            os.close(fd)
+            os.remove(data_path)
+            raise UploadError("磁盘空间不足", 507)
+        os.close(fd)
+
+        now = time.time()
+        state = {
+            "id": upload_id,
+            "filename": filename,
+            "size": size,
+            "offset": 0,
+            "owner": owner,
+            "checksum": list(parsed) if parsed else None,
+            "metadata": metadata or {},
+            "created": now,
+            "updated": now,
+        }
+        self._save_state(state)
+        return state
+
+    def _open_locked(self, upload_id):
+        _, data_path = self._paths(upload_id)
+        try:
+            f = open(data_path, 'r+b')
+        except FileNotFoundError:
+            raise UploadError("上传不存在", 404)
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            raise UploadError("该上传正在写入", 409)
+        return f
+
+    def write(self, upload_id, offset, stream, length=None):
+        """把 stream 中的数据写到 offset 处，返回新的偏移
+
+        中途断开时已收到的数据仍会保存，客户端从返回/查询到的偏移继续。
+        """
+        f = self._open_locked(upload_id)
+        try:
+            # 加锁后重新读取状态，其他进程可能刚写入过
+            state = self.get(upload_id)
+            if offset != state['offset']:
+                raise UploadError("偏移量不匹配", 409, offset=state['offset'])
+            remaining = state['size'] - offset
+            if length is not None and length > remaining:
+                raise UploadError("数据超出文件大小", 413, offset=offset)
+
+            hasher = None
+            if state['checksum']:
+                with self._lock:
+                    entry = self._hashers.pop(upload_id, None)
+                if entry and entry[0] == offset:
+                    hasher = entry[1]
+                elif offset == 0:
+                    hasher = hashlib.new(state['checksum'][0])
+
+            fd = f.fileno()
+            written = 0
+            try:
+                while True:
+                    data = stream.read(min(CHUNK_SIZE, remaining - written + 1))
+                    if not data:
+                        break
+                    if written + len(data) > remaining:
+                        raise UploadError("数据超出文件大小", 413)
+                    view = memoryview(data)
+                    while view:
+                        n = os.pwrite(fd, view, offset + written)
+                        written += n
+                        view = view[n:]
+                    if hasher is not None:
+                        hasher.update(data)
+            finally:
+                if written:
+                    os.fdatasync(fd)
+                    state['offset'] = offset + written
+                    state['updated'] = time.time()
+                    self._save_state(state)
+                    if hasher is not None:
+                        with self._lock:
+                            self._hashers[upload_id] = (state['offset'], hasher)
+            return state['offset']
+        finally:
+            f.close()
+
+    def _digest(self, upload_id, state, data_file):
+        with self._lock:
+            entry = self._hashers.pop(upload_id, None)
+        if entry and entry[0] == state['size']:
+            return entry[1].hexdigest()
+        # 分片由其他进程写入或本进程重启过，重新计算
+        hasher = hashlib.new(state['checksum'][0])
+        data_file.seek(0)
+        for chunk in iter(lambda: data_file.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def complete(self, upload_id, target_folder):
+        """校验并把文件放入 target_folder，返回 (最终文件名, 上传状态)"""
+        f = self._open_locked(upload_id)
+        try:
+            state = self.get(upload_id)
+            if state['offset'] != state['size']:
+                raise UploadError("上传未完成", 409, offset=state['offset'])
+            if state['checksum'] and self._digest(upload_id, state, f) != state['checksum'][1]:
+                self._remove(upload_id)
+                raise UploadError("文件校验失败，请重新上传", 422)
+            state_path, data_path = self._paths(upload_id)
+            filename = publish_file(data_path, target_folder, state['filename'])
+            self._remove(upload_id)
+            return filename, state
+        finally:
+            f.close()
+
+    def _remove(self, upload_id):
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+        for path in self._paths(upload_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def abort(self, upload_id):
+        f = self._open_locked(upload_id)
+        try:
+            self._remove(upload_id)
+        finally:
+            f.close()
+
+    def expire(self):
+        """删除超过 expire_after 秒没有写入的上传"""
+        deadline = time.time() - self.expire_after
+        with os.scandir(self.folder) as entries:
+            stale = [e.name[:-5] for e in entries
+                     if e.name.endswith('.json') and e.stat().st_mtime < deadline]
+        for upload_id in stale:
+            try:
+                self.abort(upload_id)
+            except UploadError:
+                pass